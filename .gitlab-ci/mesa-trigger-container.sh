@@ -3,5 +3,5 @@
 set -eu
 
 python3 -m pip install --upgrade pip
-pip install ./executor/client ./valvetraces
+pip install ./executor/client[zstd] ./valvetraces
 wget --progres=dot:mega -O /usr/bin/mcli https://dl.min.io/client/mc/release/linux-amd64/mc && chmod +x /usr/bin/mcli
@@ -1,4 +1,5 @@
 from .client import Job
+from .aio import AsyncJob, run_jobs
 
 
-__all__ = ['Job', ]
+__all__ = ['Job', 'AsyncJob', 'run_jobs', ]
@@ -0,0 +1,231 @@
+from functools import partial
+
+import traceback
+import requests
+import asyncio
+import socket
+import struct
+import json
+
+from .client import Job, Response, logger, submit, enable_tcp_keepalive
+from .message import MessageType, Message, JobStatus
+
+
+class AsyncJob(Job):
+    # How long the executor has to connect back to us when reattaching
+    REATTACH_TIMEOUT = 30
+
+    def __init__(self, *args, output=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Binary file receiving the console output of the job, or None to drop it
+        self.output = output
+
+        self._server = None
+        self._connections = None
+
+    async def _listen(self):
+        # NOTE: The listening socket is kept for the whole job, so that the executor may connect back to it when
+        # reattaching
+        self._connections = asyncio.Queue()
+
+        async def on_connection(reader, writer):
+            await self._connections.put((reader, writer))
+
+        tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_server.bind(('', 0))
+        self._server = await asyncio.start_server(on_connection, sock=tcp_server)
+
+        return tcp_server.getsockname()[1]
+
+    async def _close_server(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _accept(self):
+        reader, writer = await self._connections.get()
+        enable_tcp_keepalive(writer.get_extra_info('socket'))
+        return reader, writer
+
+    async def _wait_for_executor_connection(self, response):
+        loop = asyncio.get_running_loop()
+
+        # Wait for the job to be set up, checking its state every second
+        deadline = loop.time() + self.SETUP_TIMEOUT
+        while True:
+            try:
+                return await asyncio.wait_for(self._accept(), 1)
+            except asyncio.TimeoutError:
+                state = await loop.run_in_executor(None, self._job_state, response.job_id)
+                if state is not None and state.get("state") == "DONE":
+                    logger.error(f"The job {response.job_id} ended before connecting to us: "
+                                 f"{state.get('status')} - {state.get('error_msg')}")
+                    return None
+
+                if loop.time() > deadline:
+                    logger.error(f"The job {response.job_id} did not connect to us within {self.SETUP_TIMEOUT} s")
+                    return None
+
+    async def _reattach(self, response):
+        # NOTE: Only the executors numbering their messages support reattaching
+        if response.reattach_token is None or self.last_seq is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        port = self._server.sockets[0].getsockname()[1]
+        for attempt in range(1, self.REATTACH_ATTEMPTS + 1):
+            logger.warning(f"Lost the connection to the executor, reattaching to the job {response.job_id} "
+                           f"(attempt {attempt}/{self.REATTACH_ATTEMPTS})")
+
+            try:
+                error = await loop.run_in_executor(None, self._request_reattach, response, port)
+                if error is not None:
+                    logger.error(f"The executor refused to reattach to the job: {error}")
+                    return None
+
+                return await asyncio.wait_for(self._accept(), self.REATTACH_TIMEOUT)
+            except (requests.exceptions.RequestException, OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Failed to reattach to the job: {e}")
+
+            await asyncio.sleep(self.REATTACH_DELAY)
+
+        return None
+
+    async def _next_message(self, reader):
+        length = struct.unpack("!I", await reader.readexactly(4))[0]
+        return Message.from_frame(await reader.readexactly(length))
+
+    def _write_output(self, buf):
+        if self.output is not None:
+            self.output.write(buf)
+
+    async def _handle_message(self, msg):
+        # Ignore the messages we already received before reattaching
+        if msg.seq is not None:
+            if self.last_seq is not None and msg.seq <= self.last_seq:
+                return None
+            self.last_seq = msg.seq
+
+        if msg.msg_type == MessageType.CONTROL:
+            self._write_output(msg.message.encode())
+        elif msg.msg_type == MessageType.JOB_IO:
+            self._write_output(msg.buffer)
+        elif msg.msg_type == MessageType.SESSION_END:
+            # NOTE: Downloads are blocking, let them happen in parallel to the other jobs of the loop
+            await asyncio.get_running_loop().run_in_executor(None, self._handle_end_message, msg)
+            return msg.status
+
+        return None
+
+    async def _run_session(self, response):
+        if response.version != 1:
+            raise ValueError("The executor needs to support the version 1 of the protocol")
+
+        connection = await self._wait_for_executor_connection(response)
+        if connection is None:
+            return JobStatus.SETUP_FAIL
+        reader, writer = connection
+
+        try:
+            while True:
+                try:
+                    msg = await self._next_message(reader)
+                except (asyncio.IncompleteReadError, OSError):
+                    writer.close()
+
+                    connection = await self._reattach(response)
+                    if connection is None:
+                        return JobStatus.INCOMPLETE
+                    reader, writer = connection
+                    continue
+
+                try:
+                    status = await self._handle_message(msg)
+                except Exception:
+                    traceback.print_exc()
+                    return JobStatus.INCOMPLETE
+
+                if status is not None:
+                    return status
+        finally:
+            writer.close()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        try:
+            port = await self._listen()
+
+            try:
+                success, response = await loop.run_in_executor(None, partial(submit, f"{self.executor_url}/api/v1/jobs",
+                                                                             partial(self._request_fields, port),
+                                                                             wait_if_busy=self.wait_if_busy))
+            finally:
+                self._close_archive()
+            if not success:
+                return JobStatus.SETUP_FAIL
+
+            return await self._run_session(response)
+        except json.decoder.JSONDecodeError:
+            logger.error("Invalid response from executor server")
+            return JobStatus.SETUP_FAIL
+        except requests.exceptions.ConnectionError:
+            logger.error("Failed to connect to the executor, is it running?")
+            return JobStatus.SETUP_FAIL
+        except Exception:
+            traceback.print_exc()
+            return JobStatus.UNKNOWN
+        finally:
+            await self._close_server()
+
+
+def _submit_jobs(executor_url, jobs, ports, wait_if_busy=False):
+    # The parts of every job get prefixed with the index of the job in the batch. NOTE: They get built again for
+    # every try, like for single jobs
+    def request_fields():
+        fields = dict()
+        for i, (job, port) in enumerate(zip(jobs, ports)):
+            for name, (filename, data, content_type) in job._request_fields(port).items():
+                fields[f"{i}/{name}"] = (filename, data, content_type)
+        return fields
+
+    try:
+        return submit(f"{executor_url}/api/v1/jobs/bulk", request_fields, wait_if_busy=wait_if_busy)
+    finally:
+        for job in jobs:
+            job._close_archive()
+
+
+async def run_jobs(executor_url, jobs, wait_if_busy=False):
+    # Queues all the jobs as one batch, which only gets accepted if all the jobs can start, then returns their status
+    loop = asyncio.get_running_loop()
+
+    try:
+        ports = [await job._listen() for job in jobs]
+
+        try:
+            success, response = await loop.run_in_executor(None, partial(_submit_jobs, executor_url, jobs, ports,
+                                                                         wait_if_busy=wait_if_busy))
+        except requests.exceptions.ConnectionError:
+            logger.error("Failed to connect to the executor, is it running?")
+            success = False
+        if not success:
+            return [JobStatus.SETUP_FAIL] * len(jobs)
+
+        reattach_tokens = response.reattach_tokens or [None] * len(jobs)
+        sessions = [job._run_session(Response(version=response.version, job_id=job_id, reattach_token=token))
+                    for job, job_id, token in zip(jobs, response.job_ids, reattach_tokens)]
+        statuses = await asyncio.gather(*sessions, return_exceptions=True)
+    finally:
+        for job in jobs:
+            await job._close_server()
+
+    # NOTE: A failing session should not take the other jobs of the batch down with it
+    for i, status in enumerate(statuses):
+        if isinstance(status, Exception):
+            logger.error(f"The job {response.job_ids[i]} failed: {status}")
+            statuses[i] = JobStatus.UNKNOWN
+
+    return statuses
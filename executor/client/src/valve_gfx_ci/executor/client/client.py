@@ -1,25 +1,39 @@
 from logging import getLogger, getLevelName, Formatter, StreamHandler
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 from dataclasses import dataclass
+from threading import Thread, Lock
 from tarfile import TarFile
+from urllib.parse import urlsplit, unquote
+from urllib3.fields import RequestField
+from minio import Minio
 
-import subprocess
 import traceback
 import requests
-from requests_toolbelt import MultipartEncoder
+import urllib3
 import tempfile
+import secrets
+import hashlib
+import gzip
 import termios
 import select
 import socket
+import stat
 import json
 import time
 import tty
 import sys
-import shutil
+import pwd
+import grp
 import re
 import os
 
 from .message import MessageType, Message, JobIOMessage, JobStatus
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 logger = getLogger(__name__)
 logger.setLevel(getLevelName('DEBUG'))
@@ -31,13 +45,424 @@ console_handler.setFormatter(log_formatter)
 logger.addHandler(console_handler)
 
 
+# Default part sizes of minio-py (and thus of the executor), of the AWS CLI, and of mcli
+MULTIPART_PART_SIZES = [5 * 1024 * 1024, 8 * 1024 * 1024, 16 * 1024 * 1024]
+
+
+def file_digests(path):
+    # Returns the sha256 and md5 digests of the file, the latter being the ETag of objects uploaded in one part
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+            md5.update(block)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def etag_matches(etag, path, size, md5=None):
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return (md5 or file_digests(path)[1]) == etag
+
+    # Objects uploaded in multiple parts have the md5 of the md5 of their parts as ETag, followed by the number
+    # of parts. The size of the parts is unknown, so try the default ones of the usual clients
+    digest, _, parts = etag.partition("-")
+    parts = int(parts)
+    for part_size in MULTIPART_PART_SIZES:
+        if not (parts - 1) * part_size < size <= parts * part_size:
+            continue
+
+        md5s = bytearray()
+        with open(path, 'rb') as f:
+            for _ in range(parts):
+                part_md5 = hashlib.md5()
+                remaining = part_size
+                while remaining > 0:
+                    block = f.read(min(remaining, 1024 * 1024))
+                    if len(block) == 0:
+                        break
+                    part_md5.update(block)
+                    remaining -= len(block)
+                md5s += part_md5.digest()
+
+        if hashlib.md5(md5s).hexdigest() == digest:
+            return True
+
+    return False
+
+
+def enable_tcp_keepalive(sock, idle=10, interval=5, count=6):
+    # Detect dead connections within a minute, even when nothing gets sent
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, (idle + interval * count) * 1000)
+
+
+class ShareDirectory:
+    def __init__(self, path):
+        self.path = path
+
+        # Digests of the files, along with the size and modification time they had when they got hashed
+        self._digests = dict()
+
+    def files(self):
+        # Regular files of the directory, named as in its tarball
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    yield os.path.relpath(path, self.path).replace(os.sep, "/"), st
+
+    def digests(self, name, st):
+        key = (st.st_size, st.st_mtime_ns)
+        cached_key, digests = self._digests.get(name, (None, None))
+        if cached_key != key:
+            digests = file_digests(os.path.join(self.path, name))
+            self._digests[name] = (key, digests)
+        return digests
+
+    def manifest_entry(self, name, st):
+        try:
+            uname = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError:
+            uname = ""
+        try:
+            gname = grp.getgrgid(st.st_gid).gr_name
+        except KeyError:
+            gname = ""
+
+        return {
+            "path": name,
+            "sha256": self.digests(name, st)[0],
+            "size": st.st_size,
+            "mode": stat.S_IMODE(st.st_mode),
+            "mtime": int(st.st_mtime),
+            "uid": st.st_uid,
+            "uname": uname,
+            "gid": st.st_gid,
+            "gname": gname,
+        }
+
+
+class ArchiveStream:
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path, exclude=None):
+        self.path = path
+        self.exclude = set(exclude) if exclude is not None else set()
+        self.size = 0
+
+        # Keep a copy of what got sent, in case it needs to be sent again
+        self._copy = tempfile.TemporaryFile()
+        self._complete = False
+        self._error = None
+
+    @property
+    def compression(self):
+        return "zstd" if zstandard is not None else "gzip"
+
+    def _pack(self, fd):
+        try:
+            with open(fd, 'wb') as pipe:
+                # NOTE: zstd uses all the CPU cores, gzip only one
+                if zstandard is not None:
+                    compressor = zstandard.ZstdCompressor(threads=-1).stream_writer(pipe)
+                else:
+                    compressor = gzip.GzipFile(fileobj=pipe, mode='wb', compresslevel=6)
+
+                with compressor, TarFile.open(fileobj=compressor, mode='w|') as tar:
+                    tar.add(self.path, arcname="", filter=lambda m: None if m.name in self.exclude else m)
+        except Exception as e:
+            self._error = e
+
+    def chunks(self):
+        if self._complete:
+            self._copy.seek(0)
+            yield from iter(lambda: self._copy.read(self.CHUNK_SIZE), b"")
+            return
+
+        self.size = 0
+        self._copy.seek(0)
+        self._copy.truncate()
+
+        # Pack the directory in the background, while the previous chunks get sent
+        read_fd, write_fd = os.pipe()
+        packer = Thread(target=self._pack, args=(write_fd, ), name="ArchivePacker", daemon=True)
+        packer.start()
+        try:
+            with open(read_fd, 'rb') as pipe:
+                for chunk in iter(lambda: pipe.read(self.CHUNK_SIZE), b""):
+                    self._copy.write(chunk)
+                    self.size += len(chunk)
+                    yield chunk
+        finally:
+            packer.join()
+
+        if self._error is not None:
+            raise self._error
+        self._complete = True
+
+    def close(self):
+        self._copy.close()
+
+
+class JobBucketDownloader:
+    # NOTE: Stay below the size of the connection pool of the MinIO client (10), so that all the connections get reused
+    WORKERS = 8
+
+    CHUNK_SIZE = 1024 * 1024
+
+    # Interrupted downloads get resumed from where they stopped, before being given up on
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, access_url, bucket_name, share_directory):
+        url = urlsplit(access_url)
+        self.client = Minio(url.netloc.rpartition("@")[2], access_key=unquote(url.username or ""),
+                            secret_key=unquote(url.password or ""), secure=url.scheme == "https")
+        self.bucket_name = bucket_name
+        self.share_directory = share_directory
+
+        self._lock = Lock()
+        self.received_bytes = 0
+        self.downloaded_objects = 0
+
+    def _receive(self, obj, f):
+        if f.tell() == obj.size:
+            return
+
+        # NOTE: Resume from what was already received, unless the object changed in the meantime
+        etag = obj.etag.strip('"')
+        response = self.client.get_object(self.bucket_name, obj.object_name, offset=f.tell(),
+                                          request_headers={"If-Match": f'"{etag}"'})
+        try:
+            for chunk in response.stream(self.CHUNK_SIZE):
+                f.write(chunk)
+                with self._lock:
+                    self.received_bytes += len(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+
+        if f.tell() != obj.size:
+            raise IOError(f"Received {f.tell()} out of {obj.size} bytes")
+
+    def fetch(self, obj, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # NOTE: Stream the object to a temporary file, so that failed downloads never leave truncated files behind
+        tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.part")
+        try:
+            with open(tmp_path, 'wb') as f:
+                for attempt in range(1, self.MAX_ATTEMPTS + 1):
+                    try:
+                        self._receive(obj, f)
+                        break
+                    except (urllib3.exceptions.HTTPError, IOError) as e:
+                        if attempt == self.MAX_ATTEMPTS:
+                            raise
+                        logger.warning(f"Failed to download {obj.object_name}, resuming from byte {f.tell()}: {e}")
+                        time.sleep(attempt)
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with self._lock:
+            self.downloaded_objects += 1
+
+    def _is_up_to_date(self, obj, name, path):
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return False
+
+        if not stat.S_ISREG(st.st_mode) or st.st_size != obj.size:
+            return False
+
+        md5 = self.share_directory.digests(name, st)[1]
+        return etag_matches(obj.etag, path, st.st_size, md5=md5)
+
+    def _report_progress(self, objects, size):
+        # NOTE: Update the same line in terminals, and print a line at a time otherwise
+        print(f"\rDownloading the job bucket: {self.downloaded_objects}/{objects} objects, "
+              f"{self.received_bytes / 1e6:.1f}/{size / 1e6:.1f} MB", end="" if sys.stdout.isatty() else "\n",
+              flush=True)
+
+    def mirror(self):
+        root = os.path.realpath(self.share_directory.path)
+
+        # Only download the objects that differ from the local files
+        remote_names = set()
+        up_to_date = 0
+        downloads = []
+        for obj in self.client.list_objects(self.bucket_name, recursive=True):
+            if obj.is_dir:
+                continue
+
+            path = os.path.realpath(os.path.join(root, obj.object_name))
+            if os.path.commonpath([root, path]) != root:
+                logger.warning(f"Ignoring the object {obj.object_name}, which is outside of the share directory")
+                continue
+            name = os.path.relpath(path, root)
+            remote_names.add(name)
+
+            if self._is_up_to_date(obj, name, path):
+                up_to_date += 1
+            else:
+                downloads.append((obj, path))
+
+        size = sum([obj.size for obj, _ in downloads])
+        progress_period = 1 if sys.stdout.isatty() else 10
+        with ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix="JobBucketDownload") as pool:
+            pending = [pool.submit(self.fetch, obj, path) for obj, path in downloads]
+            while len(pending) > 0:
+                done, pending = wait(pending, timeout=progress_period, return_when=FIRST_EXCEPTION)
+                self._report_progress(len(downloads), size)
+
+                # Stop at the first failed download
+                for future in done:
+                    if future.exception() is not None:
+                        for f in pending:
+                            f.cancel()
+                        raise future.exception()
+        if len(downloads) > 0 and sys.stdout.isatty():
+            print()
+
+        # Remove the local files that are no longer in the bucket
+        removed = 0
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if os.path.relpath(path, root) not in remote_names:
+                    os.unlink(path)
+                    removed += 1
+
+        logger.info(f"Downloaded {len(downloads)} objects ({size} bytes) from the job bucket, {up_to_date} were "
+                    f"already up to date, and removed {removed} local files")
+
+
+def multipart_body(boundary, fields):
+    # NOTE: Generate the body as it gets sent, so that the streams get sent without knowing their size beforehand
+    for name, (filename, data, content_type) in fields.items():
+        field = RequestField(name=name, data=b"", filename=filename)
+        field.make_multipart(content_type=content_type)
+        yield f"--{boundary}\r\n{field.render_headers()}".encode()
+
+        if isinstance(data, str):
+            yield data.encode()
+        elif isinstance(data, bytes):
+            yield data
+        else:
+            yield from data.chunks()
+        yield b"\r\n"
+
+    yield f"--{boundary}--\r\n".encode()
+
+
 @dataclass
 class Response:
     version: int = 0
     error_msg: str = None
+    job_id: str = None
+    reattach_token: str = None
+
+    # IDs of the jobs of a batch, and their reattach tokens, in the order they got submitted
+    job_ids: list = None
+    reattach_tokens: list = None
+
+    @classmethod
+    def from_api(cls, fields):
+        valid_fields = {f.name for f in cls.__dataclass_fields__.values()}
+        return cls(**{k: v for k, v in fields.items() if k in valid_fields})
+
+    @classmethod
+    def from_http_response(cls, r):
+        try:
+            ret = r.json()
+        except Exception:
+            return cls(error_msg=r.text)
+
+        version = ret.get("version", 0)
+
+        if version == 0:
+            return cls(error_msg=ret.get("reason"))
+        elif version == 1:
+            return cls.from_api(ret)
+        else:
+            raise ValueError(f"Unsupported response version {version}")
+
+
+def submit(url, fields, wait_if_busy=False):
+    # Returns whether the executor accepted the request, along with its response. The fields may be given as a
+    # function returning them, which gets called before every try so that they stay up to date while waiting
+    boundary = secrets.token_hex(16)
+    first_wait = True
+
+    while True:
+        # NOTE: Generate a new body for every try, as they get consumed
+        r = requests.post(url, data=multipart_body(boundary, fields() if callable(fields) else fields),
+                          headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        response = Response.from_http_response(r)
+
+        # NOTE: Executors set up jobs asynchronously, and return 202 when they accept them
+        if r.status_code in [200, 202]:
+            return True, response
+        elif r.status_code == 409 and wait_if_busy:
+            if first_wait:
+                print("No machines available for the job, waiting: ", end="", flush=True)
+                first_wait = False
+            else:
+                print(".", end="", flush=True)
+            time.sleep(1)
+        else:
+            print(f"\nERROR: Could not queue the work: \"{response.error_msg}\"", file=sys.stderr)
+
+            return False, response
+
+
+def filter_input(buf, control_char, control_char_pressed=False):
+    # Returns what needs to be sent to the job, minus the control chars that are not repeated, along with whether
+    # the input ends with a control char that is waiting for the next key
+    data = bytearray()
+    for c in buf:
+        if c == control_char and not control_char_pressed:
+            control_char_pressed = True
+        else:
+            # Repeating the control char sends it through
+            control_char_pressed = False
+            data.append(c)
+    return bytes(data), control_char_pressed
 
 
 class Job:
+    # NOTE: The executor never stores smaller files in its object pool
+    POOLED_FILE_MIN_SIZE = 64 * 1024
+
+    # Read whatever is available, so that pasted text gets sent in as few messages as possible
+    INPUT_CHUNK_SIZE = 4096
+
+    # Maximum amount of time the output of the job may stay buffered before being displayed
+    OUTPUT_FLUSH_DELAY = 0.02
+
+    CONTROL_CHAR = 0x01  # CTRL+A
+
+    # The executor keeps the job going for a minute after losing the connection to the client
+    REATTACH_ATTEMPTS = 10
+    REATTACH_DELAY = 5
+
+    # Maximum amount of time the executor may take to set up the job before connecting back to us
+    SETUP_TIMEOUT = 30 * 60
+
     def __init__(self, executor_url, job_desc, wait_if_busy=False, callback_host=None,
                  machine_tags=None, machine_id=None, job_id=None, share_directory=None,
                  minio_creds=None, minio_groups=None):
@@ -50,52 +475,102 @@ class Job:
         self.machine_id = machine_id
         self.job_id = job_id
         self.share_directory = share_directory
+        self._share_directory = ShareDirectory(share_directory) if share_directory else None
         self.minio_creds = minio_creds
         self.minio_groups = minio_groups if minio_groups is not None else []
 
-    def _create_archive(self):
-        with (tempfile.NamedTemporaryFile(mode='wb', suffix='tar.gz', delete=False) as fp,
-              TarFile.open(fileobj=fp, mode='w:gz') as tar):
-            tar.add(self.share_directory, arcname="")
-            return fp.name
+        # Sequence number of the last message received from the executor
+        self.last_seq = None
+
+        # Archive of the share directory, kept across the tries to submit the job
+        self._archive = None
 
-    def _parse_response(self, r):
+    def _pooled_files_manifest(self):
+        # Find the files whose content the executor already has, so that they can be left out of the tarball
+        files = [(name, st) for name, st in self._share_directory.files()
+                 if st.st_size >= self.POOLED_FILE_MIN_SIZE and st.st_nlink == 1]
+        if len(files) == 0:
+            return []
+
+        objects = [{"sha256": self._share_directory.digests(name, st)[0], "size": st.st_size} for name, st in files]
         try:
-            ret = r.json()
-        except Exception:
-            return Response(error_msg=r.text)
+            r = requests.post(f"{self.executor_url}/api/v1/objects/lookup", json={"objects": objects})
+        except requests.exceptions.RequestException:
+            traceback.print_exc()
+            return []
+
+        # NOTE: Older executors do not have an object pool
+        if r.status_code != 200:
+            return []
+
+        available = set(r.json().get("available", []))
+        return [self._share_directory.manifest_entry(name, st) for name, st in files
+                if self._share_directory.digests(name, st)[0] in available]
+
+    def _request_fields(self, callback_port):
+        # Returns the parts of the request queuing the job. NOTE: Gets called before every try to submit the job, as
+        # the content of the executor's object pool may change while waiting for a machine
+        metadata = {
+            "version": 1,
+            "job_id": self.job_id,
+            "minio": {
+                "credentials": {},
+                "groups": self.minio_groups
+            },
+            "callback": {
+                "port": callback_port
+            }
+        }
+        if self.callback_host is not None:
+            metadata['callback']['host'] = self.callback_host
+
+        if self.minio_creds is not None:
+            metadata['minio']['credentials'] = {
+                "access_key": self.minio_creds.access_key,
+                "secret_key": self.minio_creds.secret_key
+            }
 
-        version = ret.get("version", 0)
+        if self.machine_id is not None or (self.machine_tags is not None and len(self.machine_tags) > 0):
+            metadata['target'] = {
+                "id": self.machine_id,
+                "tags": self.machine_tags
+            }
 
-        if version == 0:
-            return Response(error_msg=ret.get("reason"))
-        elif version == 1:
-            return Response(**ret)
-        else:
-            raise ValueError(f"Unsupported response version {version}")
+        fields = {
+            'metadata': ('metadata', json.dumps(metadata), 'application/json'),
+            'job': ('job', self.job_desc, 'application/x-yaml')
+        }
 
-    def _setup_connection(self):
-        def queue_job(**kwargs):
-            first_wait = True
+        # NOTE: The server streams the tarball straight into the job bucket, so it needs to be the last part
+        if self.share_directory:
+            manifest = self._pooled_files_manifest()
+            if len(manifest) > 0:
+                fields['job_bucket_initial_state_manifest'] = ('job_bucket_initial_state_manifest',
+                                                               json.dumps({"files": manifest}),
+                                                               'application/json')
 
-            while True:
-                r = requests.post(f"{self.executor_url}/api/v1/jobs", **kwargs)
-                response = self._parse_response(r)
-
-                if r.status_code == 200:
-                    return True, response
-                elif r.status_code == 409 and self.wait_if_busy:
-                    if first_wait:
-                        print("No machines available for the job, waiting: ", end="", flush=True)
-                        first_wait = False
-                    else:
-                        print(".", end="", flush=True)
-                    time.sleep(1)
-                else:
-                    print(f"\nERROR: Could not queue the work: \"{response.error_msg}\"", file=sys.stderr)
+            # Only pack the directory again if the files left out of the archive changed
+            exclude = {f['path'] for f in manifest}
+            if self._archive is None or self._archive.exclude != exclude:
+                if len(manifest) > 0:
+                    print(f"{len(manifest)} files of the share_directory "
+                          f"({sum([f['size'] for f in manifest])} bytes) are already on the executor")
+
+                self._close_archive()
+                self._archive = ArchiveStream(self.share_directory, exclude=exclude)
+                print(f"Packing up and sending the share_directory ({self._archive.compression})")
 
-                    return False, response
+            fields['job_bucket_initial_state_tarball_file'] = ('job_bucket_initial_state_tarball_file',
+                                                               self._archive, 'application/octet-stream')
 
+        return fields
+
+    def _close_archive(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def _setup_connection(self):
         # Set up a TCP server
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_server:
             tcp_server.bind(('', 0))
@@ -103,67 +578,68 @@ class Job:
             local_port = tcp_server.getsockname()[1]
 
             # Queue the job
-            metadata = {
-                "version": 1,
-                "job_id": self.job_id,
-                "minio": {
-                    "credentials": {},
-                    "groups": self.minio_groups
-                },
-                "callback": {
-                    "port": local_port
-                }
-            }
-            if self.callback_host is not None:
-                metadata['callback']['host'] = self.callback_host
-
-            if self.minio_creds is not None:
-                metadata['minio']['credentials'] = {
-                    "access_key": self.minio_creds.access_key,
-                    "secret_key": self.minio_creds.secret_key
-                }
-
-            if self.machine_id is not None or (self.machine_tags is not None and len(self.machine_tags) > 0):
-                metadata['target'] = {
-                    "id": self.machine_id,
-                    "tags": self.machine_tags
-                }
-
-            fields = {
-                'metadata': ('metadata', json.dumps(metadata), 'application/json'),
-                'job': ('job', self.job_desc, 'application/x-yaml')
-            }
-            start_job_file_archive = None
             try:
-                if self.share_directory:
-                    print("Packing up the share_directory")
-                    archive_path = self._create_archive()
-                    archive_stats = os.stat(archive_path)
-                    print("--> Wrote %s bytes into tar archive..." % archive_stats.st_size)
-                    start_job_file_archive = open(archive_path, 'rb')
-                    fields['job_bucket_initial_state_tarball_file'] = ('job_bucket_initial_state_tarball_file',
-                                                                       start_job_file_archive,
-                                                                       'application/octet-stream')
-                m = MultipartEncoder(fields=fields)
-                success, response = queue_job(data=m, headers={'Content-Type': m.content_type})
+                success, response = submit(f"{self.executor_url}/api/v1/jobs", lambda: self._request_fields(local_port),
+                                           wait_if_busy=self.wait_if_busy)
+                if self._archive is not None:
+                    print(f"--> Sent {self._archive.size} bytes of compressed tar archive")
                 if not success:
                     return None, response
             finally:
-                if start_job_file_archive is not None:
-                    start_job_file_archive.close()
+                self._close_archive()
 
-            # We should not have a connection queued, accept it with a timeout
+            # Wait for the executor to connect back to us
             print(f"Waiting for the executor to connect to our local port {local_port}")
+            sock = self._wait_for_executor_connection(tcp_server, response)
+            if sock is None:
+                return None, response
+
+            # Set the resulting socket's timeout to blocking
+            sock.settimeout(None)
+            enable_tcp_keepalive(sock)
+
+        return sock, response
+
+    def _job_state(self, job_id):
+        try:
+            r = requests.get(f"{self.executor_url}/api/v1/job/{job_id}", timeout=10)
+            if r.status_code == 200:
+                return r.json()
+            elif r.status_code == 404:
+                # NOTE: The executor got restarted, or the job fell out of its history: it will never connect to us
+                return {"state": "DONE", "status": JobStatus.SETUP_FAIL.name,
+                        "error_msg": "The executor does not know about this job"}
+        except requests.exceptions.RequestException:
+            traceback.print_exc()
+
+        return None
+
+    def _wait_for_executor_connection(self, tcp_server, response):
+        # Executors not returning a job ID are expected to connect right away
+        if response.job_id is None:
             tcp_server.settimeout(5)
             try:
-                sock, _ = tcp_server.accept()
+                return tcp_server.accept()[0]
             except socket.timeout:
                 raise ValueError("The server failed to initiate a connection")
 
-            # Set the resulting socket's timeout to blocking
-            sock.settimeout(None)
+        # Otherwise, wait for the job to be set up, checking its state every second
+        tcp_server.settimeout(1)
+        deadline = time.monotonic() + self.SETUP_TIMEOUT
+        while True:
+            try:
+                return tcp_server.accept()[0]
+            except socket.timeout:
+                state = self._job_state(response.job_id)
+                if state is not None and state.get("state") == "DONE":
+                    print(f"\nERROR: The job {response.job_id} ended before connecting to us: "
+                          f"{state.get('status')} - {state.get('error_msg')}", file=sys.stderr)
+                    return None
 
-        return sock, response
+                if time.monotonic() > deadline:
+                    print(f"\nERROR: The job {response.job_id} did not connect to us within {self.SETUP_TIMEOUT} s",
+                          file=sys.stderr)
+                    return None
 
     def _read_executor_message_v0(self, job_socket):
         # Local cache
@@ -172,7 +648,7 @@ class Job:
             self.final_lines = final_lines = bytearray()
 
         # Get the data
-        buf = job_socket.recv(4096)
+        buf = job_socket.recv(64 * 1024)
         if len(buf) == 0:
             # The job is over, check the job status!
             try:
@@ -184,7 +660,6 @@ class Job:
                 traceback.print_exc()
 
         sys.stdout.buffer.write(buf)
-        sys.stdout.buffer.flush()
 
         # Keep in memory the final lines, for later parsing
         final_lines += buf
@@ -196,22 +671,81 @@ class Job:
         logger.info("Downloading the job bucket")
         if session_end_msg.job_bucket and self.share_directory:
             bucket = session_end_msg.job_bucket
-            os.environ['MC_HOST_client'] = bucket.minio_access_url
-            subprocess.check_call(["mcli", "--no-color", "mirror",
-                                   "--overwrite", "--remove", f'client/{bucket.bucket_name}',
-                                   self.share_directory])
+            JobBucketDownloader(bucket.minio_access_url, bucket.bucket_name, self._share_directory).mirror()
+
+    def _request_reattach(self, job_response, callback_port):
+        # Returns why the executor refused to connect back to us, if it did
+        callback = {"port": callback_port}
+        if self.callback_host is not None:
+            callback['host'] = self.callback_host
+
+        r = requests.post(f"{self.executor_url}/api/v1/job/{job_response.job_id}/reattach",
+                          json={"callback": callback, "last_seq": self.last_seq,
+                                "reattach_token": job_response.reattach_token}, timeout=30)
+        if r.status_code == 200:
+            return None
+
+        try:
+            return r.json().get("error")
+        except Exception:
+            return r.text
+
+    def _reattach(self, job_response):
+        # NOTE: Only the executors numbering their messages support reattaching
+        if job_response.reattach_token is None or self.last_seq is None:
+            return None
+
+        for attempt in range(1, self.REATTACH_ATTEMPTS + 1):
+            logger.warning(f"Lost the connection to the executor, reattaching to the job {job_response.job_id} "
+                           f"(attempt {attempt}/{self.REATTACH_ATTEMPTS})")
+
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_server:
+                    tcp_server.bind(('', 0))
+                    tcp_server.listen(1)
+
+                    error = self._request_reattach(job_response, tcp_server.getsockname()[1])
+                    if error is not None:
+                        logger.error(f"The executor refused to reattach to the job: {error}")
+                        return None
+
+                    # The executor connects back to us, then replays what we missed
+                    tcp_server.settimeout(30)
+                    sock = tcp_server.accept()[0]
+                    sock.settimeout(None)
+                    enable_tcp_keepalive(sock)
+                    return sock
+            except (requests.exceptions.RequestException, OSError) as e:
+                logger.warning(f"Failed to reattach to the job: {e}")
+
+            time.sleep(self.REATTACH_DELAY)
+
+        return None
 
     def _read_executor_message_v1(self, job_socket):
+        # NOTE: Connection errors are left to the caller, which may reattach to the job
         try:
             msg = Message.next_message(job_socket)
+        except (EOFError, OSError):
+            raise
+        except Exception:
+            traceback.print_exc()
+            return JobStatus.INCOMPLETE
+
+        try:
+            # Ignore the messages we already received before reattaching
+            if msg.seq is not None:
+                if self.last_seq is not None and msg.seq <= self.last_seq:
+                    return None
+                self.last_seq = msg.seq
 
             # TODO: Only display control messages at the end of a new line
             if msg.msg_type == MessageType.CONTROL:
                 print(msg.message, flush=True, end="")
             elif msg.msg_type == MessageType.JOB_IO:
                 sys.stdout.buffer.write(msg.buffer)
-                sys.stdout.buffer.flush()
             elif msg.msg_type == MessageType.SESSION_END:
+                sys.stdout.buffer.flush()
                 self._handle_end_message(msg)
                 return msg.status
         except Exception:
@@ -228,8 +762,12 @@ class Job:
             old_tty_attrs = termios.tcgetattr(sys.stdin)
             tty.setcbreak(sys.stdin)
 
-        control_char = b'\x01'  # CTRL+A
-        control_char_pressed = False
+        self.control_char_pressed = False
+
+        # NOTE: The output of the job gets displayed at most OUTPUT_FLUSH_DELAY seconds after being received
+        flush_deadline = None
+
+        initial_job_socket = job_socket
 
         try:
             while True:
@@ -237,33 +775,51 @@ class Job:
                     readables = [job_socket]
                     if sys.stdin.isatty():
                         readables.append(sys.stdin)
-                    r_fds, w_fds, x_fds = select.select(readables, [], [])
+
+                    timeout = None
+                    if flush_deadline is not None:
+                        timeout = max(0, flush_deadline - time.monotonic())
+                    r_fds, w_fds, x_fds = select.select(readables, [], [], timeout)
 
                     for fd in r_fds:
                         if fd is sys.stdin:
-                            buf = os.read(sys.stdin.fileno(), 1)
-                            msg = JobIOMessage.create(buf)
-                            if buf == control_char:
-                                if control_char_pressed:
-                                    # Repeating the control char sends it through
-                                    msg.send(job_socket)
-                                else:
-                                    control_char_pressed = True
-                            else:
-                                control_char_pressed = False
-                                msg.send(job_socket)
+                            buf = os.read(sys.stdin.fileno(), self.INPUT_CHUNK_SIZE)
+                            buf, self.control_char_pressed = filter_input(buf, self.CONTROL_CHAR,
+                                                                          self.control_char_pressed)
+                            if len(buf) > 0:
+                                try:
+                                    JobIOMessage.create(buf).send(job_socket)
+                                except OSError:
+                                    # NOTE: The loss of the connection gets handled when reading from it
+                                    traceback.print_exc()
                         elif fd is job_socket:
-                            if job_response.version == 0:
-                                ret = self._read_executor_message_v0(job_socket)
-                            else:
-                                ret = self._read_executor_message_v1(job_socket)
+                            try:
+                                if job_response.version == 0:
+                                    ret = self._read_executor_message_v0(job_socket)
+                                else:
+                                    ret = self._read_executor_message_v1(job_socket)
+                            except (EOFError, OSError):
+                                sys.stdout.buffer.flush()
+                                self.close(job_socket)
+
+                                job_socket = self._reattach(job_response)
+                                if job_socket is None:
+                                    return JobStatus.INCOMPLETE
+                                break
 
                             if ret:
                                 return ret
+
+                            if flush_deadline is None:
+                                flush_deadline = time.monotonic() + self.OUTPUT_FLUSH_DELAY
                         else:
                             raise ValueError(f"Received an unexpected fd: {fd}")
+
+                    if flush_deadline is not None and time.monotonic() >= flush_deadline:
+                        sys.stdout.buffer.flush()
+                        flush_deadline = None
                 except KeyboardInterrupt:
-                    if control_char_pressed:
+                    if self.control_char_pressed:
                         logger.info("Exiting the client in response to CTRL+C...")
                         return JobStatus.INCOMPLETE
 
@@ -271,6 +827,12 @@ class Job:
                     msg = JobIOMessage.create(chr(3).encode())
                     msg.send(job_socket)
         finally:
+            sys.stdout.buffer.flush()
+
+            # NOTE: The caller closes the socket it gave us, but not the ones we got by reattaching
+            if job_socket is not initial_job_socket and job_socket is not None:
+                self.close(job_socket)
+
             if sys.stdin.isatty():
                 termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_tty_attrs)
 
@@ -289,12 +851,6 @@ class Job:
             if sock is None:
                 return JobStatus.SETUP_FAIL
 
-            if response.version != 0 and shutil.which('mcli') is None:
-                logger.error("The MinIO client is needed for running the job. "
-                             "You may want to install it locally from "
-                             "https://github.com/minio/mc")
-                return JobStatus.SETUP_FAIL
-
             status = self._forward_inputs_and_outputs(sock, response)
         except json.decoder.JSONDecodeError:
             logger.error("Invalid response from executor server")
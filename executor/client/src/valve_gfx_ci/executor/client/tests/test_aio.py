@@ -0,0 +1,115 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import asyncio
+import socket
+import json
+
+from client.aio import AsyncJob, _submit_jobs, run_jobs
+from client.client import Response
+from client.message import SessionEndMessage, JobStatus
+
+
+def create_jobs(count):
+    return [AsyncJob("http://executor", job_desc=f"job{i}") for i in range(count)]
+
+
+# _submit_jobs
+
+
+def test_submit_jobs__fields_get_prefixed_by_the_index_of_the_job():
+    jobs = create_jobs(2)
+    archive = jobs[1]._archive = MagicMock()
+    jobs[1]._request_fields = MagicMock(return_value={"job_bucket_initial_state_tarball_file": (
+        "job_bucket_initial_state_tarball_file", archive, "application/octet-stream")})
+
+    with patch("client.aio.submit", return_value=(True, Response(version=1))) as submit:
+        assert _submit_jobs("http://executor", jobs, [1234, 5678], wait_if_busy=True) == (True, Response(version=1))
+
+    # The fields get built for every try
+    url, request_fields = submit.call_args.args
+    fields = request_fields()
+    assert url == "http://executor/api/v1/jobs/bulk"
+    assert submit.call_args.kwargs == {"wait_if_busy": True}
+    assert list(fields) == ["0/metadata", "0/job", "1/job_bucket_initial_state_tarball_file"]
+    assert json.loads(fields["0/metadata"][1])["callback"] == {"port": 1234}
+    assert fields["0/job"] == ("job", "job0", "application/x-yaml")
+    jobs[1]._request_fields.assert_called_once_with(5678)
+
+    # The archives get closed once submitted
+    archive.close.assert_called_once_with()
+    assert jobs[1]._archive is None
+
+
+# run_jobs
+
+
+def executor_submitting(statuses, sockets):
+    # Accepts the batch, then connects back to every job to end its session with the wanted status
+    def submit(url, request_fields, wait_if_busy=False):
+        fields = request_fields()
+        for i, status in enumerate(statuses):
+            port = json.loads(fields[f"{i}/metadata"][1])["callback"]["port"]
+            sock = socket.create_connection(("127.0.0.1", port))
+            msg = SessionEndMessage.create(status)
+            msg.seq = 0
+            msg.send(sock)
+            sockets.append(sock)
+
+        return True, Response(version=1, job_ids=[f"job-{i}" for i in range(len(statuses))],
+                              reattach_tokens=[f"token-{i}" for i in range(len(statuses))])
+
+    return submit
+
+
+def test_run_jobs():
+    jobs = create_jobs(2)
+    sockets = []
+
+    with patch("client.aio.submit", side_effect=executor_submitting([JobStatus.PASS, JobStatus.FAIL], sockets)):
+        assert asyncio.run(run_jobs("http://executor", jobs)) == [JobStatus.PASS, JobStatus.FAIL]
+
+    assert [job._server for job in jobs] == [None, None]
+    for sock in sockets:
+        sock.close()
+
+
+def test_run_jobs__rejected_batch():
+    jobs = create_jobs(2)
+
+    with patch("client.aio.submit", return_value=(False, Response(error_msg="Not enough machines"))):
+        assert asyncio.run(run_jobs("http://executor", jobs)) == [JobStatus.SETUP_FAIL, JobStatus.SETUP_FAIL]
+
+    assert [job._server for job in jobs] == [None, None]
+
+
+def test_run_jobs__failing_session():
+    jobs = create_jobs(2)
+    sockets = []
+
+    # A failing session does not take the other jobs of the batch down with it
+    jobs[0]._run_session = AsyncMock(side_effect=ValueError("error"))
+    with patch("client.aio.submit", side_effect=executor_submitting([JobStatus.PASS, JobStatus.PASS], sockets)):
+        assert asyncio.run(run_jobs("http://executor", jobs)) == [JobStatus.UNKNOWN, JobStatus.PASS]
+
+    jobs[0]._run_session.assert_called_once_with(Response(version=1, job_id="job-0", reattach_token="token-0"))
+    for sock in sockets:
+        sock.close()
+
+
+# AsyncJob
+
+
+def test_AsyncJob_wait_for_executor_connection__deadline():
+    job = create_jobs(1)[0]
+    job.SETUP_TIMEOUT = 0
+
+    async def wait():
+        await job._listen()
+        try:
+            return await job._wait_for_executor_connection(Response(job_id="1234"))
+        finally:
+            await job._close_server()
+
+    # The executor is unreachable, and the job never connected to us
+    with patch.object(job, "_job_state", return_value=None):
+        assert asyncio.run(wait()) is None
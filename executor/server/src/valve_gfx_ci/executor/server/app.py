@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
+from collections import defaultdict
 from dataclasses import dataclass
 from datetime import datetime
 
 import traceback
+import secrets
 import flask
 import json
 import time
 
-from .executor import SergentHartman, MachineState
+from .executor import Executor, SergentHartman, MachineState
+from .health import MachineHealth
+from .jobtracker import JobRecord, UnknownJobError
+from .artifactcache import PrefetchRequest
 from .mars import Mars, Machine
-from .minioclient import MinioClient
+from .minioclient import MinioClient, user_groups_cache
+from .multipart import MultipartStream
 from .boots import BootService
 from .message import JobStatus
 from .job import Job, Target
@@ -31,8 +37,35 @@ class CustomJSONEncoder(flask.json.JSONEncoder):
                 "current_loop_count": obj.cur_loop,
                 "statuses": dict([(s.name, val) for s, val in obj.statuses.items()]),
             }
+        elif isinstance(obj, MachineHealth):
+            return {
+                "score": obj.score,
+                "samples": obj.samples,
+                "needs_retraining": obj.needs_retraining,
+            }
         elif isinstance(obj, MachineState):
             return obj.name
+        elif isinstance(obj, PrefetchRequest):
+            return {
+                "url": obj.url,
+                "sha256": obj.sha256,
+                "state": obj.state.name,
+                "error_msg": obj.error_msg,
+                "is_cached": obj.is_cached,
+                "created_at": obj.created_at.isoformat(),
+                "updated_at": obj.updated_at.isoformat(),
+            }
+        elif isinstance(obj, JobRecord):
+            return {
+                "id": obj.id,
+                "name": obj.name,
+                "machine_id": obj.machine_id,
+                "state": obj.state.name,
+                "status": obj.status,
+                "error_msg": obj.error_msg,
+                "created_at": obj.created_at.isoformat(),
+                "updated_at": obj.updated_at.isoformat(),
+            }
         elif isinstance(obj, Machine):
             return {
                 "state": obj.executor.state,
@@ -46,6 +79,8 @@ class CustomJSONEncoder(flask.json.JSONEncoder):
                 "ip_address": obj.ip_address,
                 "is_retired": obj.is_retired,
                 "training": obj.executor.sergent_hartman,
+                "health": obj.executor.health,
+                "hot_standby": obj.executor.hot_standby,
                 "pdu": {
                     "name": obj.pdu,
                     "port_id": obj.pdu_port_id
@@ -78,6 +113,13 @@ def handle_valueError_exception(error):
     return response
 
 
+@app.errorhandler(UnknownJobError)
+def handle_unknown_job_exception(error):
+    response = flask.jsonify({"error": str(error)})
+    response.status_code = 404
+    return response
+
+
 @app.route('/api/v1/machines', methods=['GET'])
 def get_machine_list():
     with app.app_context():
@@ -287,12 +329,23 @@ def cancel_job_machine(machine_id):
 
     m = mars.get_machine_by_id(machine_id, raise_if_missing=True)
 
-    if m.executor.state != MachineState.RUNNING:
+    job_teardown = m.executor.job_teardown
+    if m.executor.state == MachineState.RUNNING:
+        m.executor.cancel_job.set()
+    elif job_teardown is not None and job_teardown.is_alive():
+        # Stop waiting for the client to download the job bucket
+        job_teardown.cancel_job.set()
+    else:
         raise ValueError(f"The machine {machine_id} isn't running a job. "
                          f"Current state is {m.executor.state.name}")
-    else:
-        m.executor.cancel_job.set()
-        return flask.make_response(f"Canceling job in machine {m.ip_address}\n", 200)
+
+    return flask.make_response(f"Canceling job in machine {m.ip_address}\n", 200)
+
+
+def drain_stream(stream, chunk_size=64 * 1024):
+    # Receive what is left of a body that failed to be parsed, so that the client gets our response
+    while len(stream.read(chunk_size)) > 0:
+        continue
 
 
 @dataclass
@@ -301,203 +354,334 @@ class MinIOCredentials:
     secret_key: str
 
 
-@app.route('/api/v1/jobs', methods=['POST'])
-def post_job():
-    def find_suitable_machine(target):
-        with app.app_context():
-            mars = flask.current_app.mars
-
-        wanted_tags = set(target.tags)
-
-        # If the target id is specified, check the tags
-        if target.id is not None:
-            machine = mars.get_machine_by_id(target.id)
-            if machine is None:
-                return None, 404, f"Unknown machine with ID {target.id}"
-            elif not wanted_tags.issubset(machine.tags):
-                return None, 406, (f"The machine {target.id} does not matching tags "
-                                   f"(asked: {wanted_tags}, actual: {machine.tags})")
-            elif machine.executor.state != MachineState.IDLE:
-                return None, 409, (f"The machine {target.id} is unavailable: "
-                                   f"Current state is {machine.executor.state.name}")
-            elif machine.is_retired:
-                return None, 409, (f"The machine {target.id} is retired.")
-            return machine, 200, None
+def find_suitable_machine(target, job, exclude=None):
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    # Machines already picked for other jobs of the same batch
+    exclude = exclude or set()
+
+    wanted_tags = set(target.tags)
+
+    # If the target id is specified, check the tags
+    if target.id is not None:
+        machine = mars.get_machine_by_id(target.id)
+        if machine is None:
+            return None, 404, f"Unknown machine with ID {target.id}"
+        elif not wanted_tags.issubset(machine.tags):
+            return None, 406, (f"The machine {target.id} does not matching tags "
+                               f"(asked: {wanted_tags}, actual: {machine.tags})")
+        elif machine in exclude:
+            return None, 409, f"The machine {target.id} is already used by another job of the batch"
+        elif machine.executor.state != MachineState.IDLE:
+            return None, 409, (f"The machine {target.id} is unavailable: "
+                               f"Current state is {machine.executor.state.name}")
+        elif machine.is_retired:
+            return None, 409, (f"The machine {target.id} is retired.")
+        return machine, 200, None
+    else:
+        found_a_candidate_machine = False
+        idle_machines = []
+        for machine in mars.known_machines:
+            if not wanted_tags.issubset(machine.tags):
+                continue
+            if machine.is_retired:
+                continue
+
+            found_a_candidate_machine = True
+            if machine.executor.state == MachineState.IDLE and machine not in exclude:
+                idle_machines.append(machine)
+
+        # Prefer healthy machines, to limit the amount of retries, then
+        # the ones that are likely to already have the job's artifacts
+        def placement_key(machine):
+            health = machine.executor.health
+            affinity = 0
+            if target.cache_affinity:
+                affinity = machine.executor.cache_affinity_hints.score(job.cache_affinity_keys)
+            return (health.score >= health.retrain_threshold, affinity, health.score)
+
+        if len(idle_machines) > 0:
+            machine = max(idle_machines, key=placement_key)
+            return machine, 200, "success"
+
+        if found_a_candidate_machine:
+            return None, 409, f"All machines matching the tags {wanted_tags} are busy"
         else:
-            found_a_candidate_machine = False
-            for machine in mars.known_machines:
-                if not wanted_tags.issubset(machine.tags):
-                    continue
-                if machine.is_retired:
-                    continue
-
-                found_a_candidate_machine = True
-                if machine.executor.state == MachineState.IDLE:
-                    return machine, 200, "success"
-
-            if found_a_candidate_machine:
-                return None, 409, f"All machines matching the tags {wanted_tags} are busy"
-            else:
-                return None, 406, f"No active machines found matching the tags {wanted_tags}."
-
-    class JobRequest:
-        def __init__(self, request, version, raw_job, target, callback_endpoint,
-                     job_bucket_initial_state_tarball_file=None, job_id=None,
-                     minio_credentials=None, minio_groups=None):
-            self.request = request
-            self.version = version
-            self.raw_job = raw_job
-            self.target = target
-            self.callback_endpoint = callback_endpoint
-            self.minio_credentials = minio_credentials
-            self.minio_groups = minio_groups
-
-            # Clients may specify a starting state for the job bucket,
-            # this will be a tarball that is extracted prior to the
-            # job starting.
-            self.job_bucket_initial_state_tarball_file = job_bucket_initial_state_tarball_file
-
-            # The executor will ensure job IDs are unique, but use the
-            # client-provided prefix for as a naming convention.
-            if job_id is None:
-                now = int(datetime.utcnow().timestamp())
-                job_id = f"untitled-{now}"
-            self.job_id = job_id
-
-            # Callback validation
-            if callback_endpoint[0] is None:
-                raise ValueError("callback's host cannot be None. Leave empty to get the default value")
-            if callback_endpoint[1] is None:
-                raise ValueError("callback's port cannot be None")
-
-        @classmethod
-        def parse(cls, request):
-            if request.mimetype == "application/json":
-                return JSONJobRequest(request)
-            elif request.mimetype == "multipart/form-data":
-                return MultipartJobRequest(request)
-            else:
-                raise ValueError("Unknown job request format")
+            return None, 406, f"No active machines found matching the tags {wanted_tags}."
+
+
+class JobRequest:
+    def __init__(self, request, version, raw_job, job, target, callback_endpoint,
+                 job_bucket_initial_state_tarball_file=None, job_bucket_initial_state_manifest=None,
+                 job_id=None, minio_credentials=None, minio_groups=None):
+        self.request = request
+        self.version = version
+        self.raw_job = raw_job
+        self.job = job
+        self.target = target
+        self.callback_endpoint = callback_endpoint
+        self.minio_credentials = minio_credentials
+        self.minio_groups = minio_groups
+
+        # Clients may specify a starting state for the job bucket,
+        # this will be a tarball that is extracted prior to the
+        # job starting.
+        self.job_bucket_initial_state_tarball_file = job_bucket_initial_state_tarball_file
+
+        # Files left out of the tarball because their content is already in the object pool, as a list of
+        # (member, digest) tuples
+        self.job_bucket_initial_state_manifest = job_bucket_initial_state_manifest or []
+
+        # The executor will ensure job IDs are unique, but use the
+        # client-provided prefix for as a naming convention.
+        if job_id is None:
+            now = int(datetime.utcnow().timestamp())
+            job_id = f"untitled-{now}"
+        self.job_id = job_id
+
+        # Callback validation
+        if callback_endpoint[0] is None:
+            raise ValueError("callback's host cannot be None. Leave empty to get the default value")
+        if callback_endpoint[1] is None:
+            raise ValueError("callback's port cannot be None")
+
+    def receive_body(self, executor=None):
+        pass
+
+    @classmethod
+    def parse(cls, request):
+        if request.mimetype == "application/json":
+            return JSONJobRequest(request)
+        elif request.mimetype == "multipart/form-data":
+            return MultipartJobRequest(request)
+        else:
+            raise ValueError("Unknown job request format")
 
-    # DEPRECATED: To be removed when we are sure all the clients out there have been updated
-    class JSONJobRequest(JobRequest):
-        def __init__(self, request):
-            job_params = request.json
-            metadata = job_params["metadata"]
-            job = Job.from_job(job_params["job"])
 
-            # Use the client-provided host callback if available, or default to the remote addr
-            remote_addr = metadata.get("callback_host", flask.request.remote_addr)
-            endpoint = (remote_addr, metadata.get("callback_port"))
+# DEPRECATED: To be removed when we are sure all the clients out there have been updated
+class JSONJobRequest(JobRequest):
+    def __init__(self, request):
+        job_params = request.json
+        metadata = job_params["metadata"]
+        job = Job.from_job(job_params["job"])
 
-            super().__init__(request=request, version=0, raw_job=job_params["job"],
-                             target=job.target, callback_endpoint=endpoint)
+        # Use the client-provided host callback if available, or default to the remote addr
+        remote_addr = metadata.get("callback_host", flask.request.remote_addr)
+        endpoint = (remote_addr, metadata.get("callback_port"))
 
-    class MultipartJobRequest(JobRequest):
-        def __init__(self, request):
-            metadata_file = request.files.get('metadata')
-            if metadata_file is None:
-                raise ValueError("No metadata file found")
+        super().__init__(request=request, version=0, raw_job=job_params["job"],
+                         job=job, target=job.target, callback_endpoint=endpoint)
 
-            if metadata_file.mimetype != "application/json":
-                raise ValueError("The metadata file has the wrong mimetype: "
-                                 "{metadata_file.mimetype}} instead of application/json")
+
+class MultipartJobRequest(JobRequest):
+    def __init__(self, request, files=None):
+        if files is not None:
+            # The parts got received already, as part of a batch
+            self.parts = None
+            self.files = files
+        else:
+            # Parse the body as it gets received, so that the initial state of the job bucket can be streamed
+            # straight into the bucket rather than being copied locally first
+            self.parts = MultipartStream(request.stream, request.mimetype_params.get("boundary", "").encode())
+
+            self.files = dict()
+            for part in self.parts:
+                self.files[part.name] = part
+
+                # NOTE: The tarball does not get buffered, so it needs to be the last part of the request
+                if part.name == 'job_bucket_initial_state_tarball_file':
+                    break
+                part.buffer()
+
+        metadata_file = self.files.get('metadata')
+        if metadata_file is None:
+            raise ValueError("No metadata file found")
+
+        if metadata_file.mimetype != "application/json":
+            raise ValueError("The metadata file has the wrong mimetype: "
+                             "{metadata_file.mimetype}} instead of application/json")
+
+        try:
+            metadata = json.loads(metadata_file.read())
+        except json.JSONDecodeError as e:
+            raise ValueError(f"The metadata file is not a valid JSON file: {e.msg}")
+
+        version = metadata.get('version')
+        if version == 1:
+            self.parse_v1(request, metadata)
+        else:
+            raise ValueError(f"Invalid request version {version}")
+
+    def parse_v1(self, request, metadata):
+        # Get the job file, and check its mimetype
+        job_file = self.files['job']
+        if job_file.mimetype != "application/x-yaml":
+            raise ValueError("The metadata file has the wrong mimetype: "
+                             "{job_file.mimetype}} instead of application/x-yaml")
+
+        initial_state_tarball_file = self.files.get('job_bucket_initial_state_tarball_file', None)
+        if initial_state_tarball_file and initial_state_tarball_file.mimetype != "application/octet-stream":
+            raise ValueError("The job_bucket_initial_state_tarball file has the wrong mimetype: "
+                             "{initial_state_tarball_file.mimetype}} instead of application/octet-stream")
+
+        manifest = []
+        if manifest_file := self.files.get('job_bucket_initial_state_manifest'):
+            if manifest_file.mimetype != "application/json":
+                raise ValueError("The job_bucket_initial_state_manifest file has the wrong mimetype: "
+                                 f"{manifest_file.mimetype} instead of application/json")
 
             try:
-                metadata = json.loads(metadata_file.read())
+                manifest = MinioClient.parse_archive_manifest(json.loads(manifest_file.read()))
             except json.JSONDecodeError as e:
-                raise ValueError(f"The metadata file is not a valid JSON file: {e.msg}")
-
-            version = metadata.get('version')
-            if version == 1:
-                self.parse_v1(request, metadata)
-            else:
-                raise ValueError(f"Invalid request version {version}")
-
-        def parse_v1(self, request, metadata):
-            # Get the job file, and check its mimetype
-            job_file = request.files['job']
-            if job_file.mimetype != "application/x-yaml":
-                raise ValueError("The metadata file has the wrong mimetype: "
-                                 "{job_file.mimetype}} instead of application/x-yaml")
-
-            initial_state_tarball_file = request.files.get('job_bucket_initial_state_tarball_file', None)
-            if initial_state_tarball_file and initial_state_tarball_file.mimetype != "application/octet-stream":
-                raise ValueError("The job_bucket_initial_state_tarball file has the wrong mimetype: "
-                                 "{initial_state_tarball_file.mimetype}} instead of application/octet-stream")
-
-            # Create a Job object
-            raw_job = job_file.read().decode()
-            job = Job.from_job(raw_job)
-
-            # Get the target that will run the job. Use the job's target by default,
-            # but allow the client to override the target
-            if "target" in metadata:
-                target = metadata.get('target', {})
-                job_target = Target(target.get('id'), target.get('tags', []))
+                raise ValueError(f"The manifest file is not a valid JSON file: {e.msg}")
+
+        # Create a Job object
+        raw_job = job_file.read().decode()
+        job = Job.from_job(raw_job)
+
+        # Get the target that will run the job. Use the job's target by default,
+        # but allow the client to override the target
+        if "target" in metadata:
+            target = metadata.get('target', {})
+            job_target = Target(target.get('id'), target.get('tags', []),
+                                cache_affinity=target.get('cache_affinity', job.target.cache_affinity))
+        else:
+            job_target = job.target
+
+        # Use the client-provided host callback if available, or default to the remote addr
+        callback = metadata.get('callback', {})
+        remote_addr = callback.get("host", request.remote_addr)
+        endpoint = (remote_addr, callback.get("port"))
+
+        # Parse the minio-related arguments request
+        minio = metadata.get('minio', {})
+        minio_credentials = minio.get('credentials', {})
+        credentials = MinIOCredentials(access_key=minio_credentials.get("access_key"),
+                                       secret_key=minio_credentials.get("secret_key"))
+
+        super().__init__(request=request, version=1, raw_job=raw_job,
+                         job=job, target=job_target, callback_endpoint=endpoint,
+                         job_bucket_initial_state_tarball_file=initial_state_tarball_file,
+                         job_bucket_initial_state_manifest=manifest,
+                         job_id=metadata.get('job_id'),
+                         minio_credentials=credentials,
+                         minio_groups=minio.get('groups', []))
+
+    def receive_body(self, executor=None):
+        if self.parts is None:
+            return
+
+        # The executor reads the tarball straight from the request, keep it open until it is done with it
+        tarball = self.job_bucket_initial_state_tarball_file
+        if tarball is not None and executor is not None:
+            while not tarball.wait_closed(timeout=1) and not executor.stop_event.is_set():
+                continue
+
+        # Receive what is left of the body, so that the client gets our response
+        self.parts.drain()
+
+
+class BulkJobRequest:
+    def __init__(self, request):
+        if request.mimetype != "multipart/form-data":
+            raise ValueError("Unknown bulk job request format")
+
+        # NOTE: Parts are named after the index of their job in the batch, e.g. "0/metadata". All the jobs need to be
+        # known before reserving any machine, so the tarballs cannot be streamed and get spooled to disk instead
+        self.parts = MultipartStream(request.stream, request.mimetype_params.get("boundary", "").encode())
+
+        self.files = files = defaultdict(dict)
+        for part in self.parts:
+            index, sep, name = part.name.partition("/")
+            if not sep or not index.isdigit():
+                self.close()
+                raise ValueError(f"The part {part.name} does not belong to any job of the batch")
+            files[int(index)][name] = part
+
+            if name == 'job_bucket_initial_state_tarball_file':
+                part.spool()
             else:
-                job_target = job.target
-
-            # Use the client-provided host callback if available, or default to the remote addr
-            callback = metadata.get('callback', {})
-            remote_addr = callback.get("host", request.remote_addr)
-            endpoint = (remote_addr, callback.get("port"))
-
-            # Parse the minio-related arguments request
-            minio = metadata.get('minio', {})
-            minio_credentials = minio.get('credentials', {})
-            credentials = MinIOCredentials(access_key=minio_credentials.get("access_key"),
-                                           secret_key=minio_credentials.get("secret_key"))
-
-            super().__init__(request=request, version=1, raw_job=raw_job,
-                             target=job_target, callback_endpoint=endpoint,
-                             job_bucket_initial_state_tarball_file=initial_state_tarball_file,
-                             job_id=metadata.get('job_id'),
-                             minio_credentials=credentials,
-                             minio_groups=minio.get('groups', []))
-
-    def check_minio_credentials(job_request):
-        credentials = job_request.minio_credentials
-
-        # If no groups are requested, then exit directly
-        if job_request.minio_groups is None or len(job_request.minio_groups) == 0:
-            return True, ""
-
-        # Some groups are requested, make sure some credentials have been set
-        if credentials is None:
-            return False, "Requested access to some groups, but the credentials are missing"
-
-        # Make sure all the requested groups are in the list of groups the
-        # provided-credentials have access to
+                part.buffer()
+
+        if len(files) == 0:
+            raise ValueError("The batch does not contain any job")
+
         try:
-            timestamp = int(datetime.now().timestamp())
-            client = MinioClient(user=credentials.access_key,
-                                 secret_key=credentials.secret_key,
-                                 alias=f"a_{job_request.job_id}-{timestamp}")
-
-            user_groups = set(client.groups_user_is_in())
-            for group in job_request.minio_groups:
-                if group not in user_groups:
-                    return False, (f"The provided MinIO credentials do not belong to the group {group}")
-
-            return True, ""
-        except ValueError:
-            return False, "Invalid MinIO credentials"
-        finally:
-            try:
-                client.remove_alias()
-            except UnboundLocalError:
-                pass
+            self.job_requests = [MultipartJobRequest(request, files=files[i]) for i in sorted(files)]
+        except Exception:
+            self.close()
+            raise
 
-    parsed = JobRequest.parse(flask.request)
+    def close(self):
+        # Remove the spooled tarballs, which will not get read by any executor
+        for parts in self.files.values():
+            for part in parts.values():
+                part.close()
 
-    ok, error_msg = check_minio_credentials(parsed)
-    if ok:
-        machine, error_code, error_msg = find_suitable_machine(parsed.target)
-        if machine is not None:
-            machine.executor.start_job(parsed)
-    else:
-        error_code = 403
+
+def check_minio_credentials(job_request):
+    credentials = job_request.minio_credentials
+
+    # If no groups are requested, then exit directly
+    if job_request.minio_groups is None or len(job_request.minio_groups) == 0:
+        return True, ""
+
+    # Some groups are requested, make sure some credentials have been set
+    if credentials is None:
+        return False, "Requested access to some groups, but the credentials are missing"
+
+    # Make sure all the requested groups are in the list of groups the
+    # provided-credentials have access to
+    try:
+        user_groups = user_groups_cache.groups(credentials.access_key, credentials.secret_key)
+        if not set(job_request.minio_groups).issubset(user_groups):
+            # The user may have been added to the group since the groups got cached, check again
+            user_groups_cache.invalidate(credentials.access_key)
+            user_groups = user_groups_cache.groups(credentials.access_key, credentials.secret_key)
+
+        for group in job_request.minio_groups:
+            if group not in user_groups:
+                return False, (f"The provided MinIO credentials do not belong to the group {group}")
+
+        return True, ""
+    except ValueError:
+        return False, "Invalid MinIO credentials"
+
+
+@app.route('/api/v1/jobs', methods=['POST'])
+def post_job():
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    try:
+        parsed = JobRequest.parse(flask.request)
+    except Exception:
+        drain_stream(flask.request.stream)
+        raise
+
+    job_record = None
+    executor = None
+    try:
+        ok, error_msg = check_minio_credentials(parsed)
+        if ok:
+            machine, error_code, error_msg = find_suitable_machine(parsed.target, parsed.job)
+            if machine is not None:
+                job_record = mars.jobs.create(name=parsed.job_id, machine_id=machine.id)
+                try:
+                    # Reserve the machine, the rest of the setup will happen in the background
+                    machine.executor.start_job(parsed, job_record)
+                    executor = machine.executor
+                    error_code = 202 if parsed.version >= 1 else 200
+                except ValueError as e:
+                    job_record.finish(JobStatus.SETUP_FAIL, error_msg=str(e))
+                    error_code, error_msg = 409, str(e)
+        else:
+            error_code = 403
+    finally:
+        # NOTE: The initial state of the job bucket gets streamed from the request, so the response only gets sent
+        # once the executor is done extracting it
+        parsed.receive_body(executor=executor)
 
     if parsed.version == 0:
         response = {
@@ -507,13 +691,148 @@ def post_job():
         response = {
             # protocol version
             "version": 1,
-            "error_msg": error_msg
-
-            # TODO: Store the job in memory, and show the ID here
+            "error_msg": error_msg,
+            "job_id": job_record.id if job_record is not None else None,
+            "reattach_token": job_record.reattach_token if job_record is not None else None,
         }
     return flask.make_response(flask.jsonify(response), error_code)
 
 
+@app.route('/api/v1/jobs/bulk', methods=['POST'])
+def post_jobs_bulk():
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    try:
+        parsed = BulkJobRequest(flask.request)
+    except Exception:
+        drain_stream(flask.request.stream)
+        raise
+
+    # Pick the machines of all the jobs before reserving any of them, so that the batch gets queued atomically
+    machines = []
+    error_code, error_msg = 202, None
+    for i, job_request in enumerate(parsed.job_requests):
+        ok, error_msg = check_minio_credentials(job_request)
+        if not ok:
+            error_code, error_msg = 403, f"Job {i}: {error_msg}"
+            break
+
+        machine, error_code, error_msg = find_suitable_machine(job_request.target, job_request.job,
+                                                               exclude=set(machines))
+        if machine is None:
+            error_msg = f"Job {i}: {error_msg}"
+            break
+        machines.append(machine)
+
+    job_records = []
+    if len(machines) == len(parsed.job_requests):
+        job_records = [mars.jobs.create(name=job_request.job_id, machine_id=machine.id)
+                       for job_request, machine in zip(parsed.job_requests, machines)]
+        try:
+            # Reserve all the machines, the rest of the setup will happen in the background
+            Executor.start_jobs([(machine.executor, job_request, job_record) for job_request, machine, job_record
+                                 in zip(parsed.job_requests, machines, job_records)])
+            error_code, error_msg = 202, None
+        except ValueError as e:
+            for job_record in job_records:
+                job_record.finish(JobStatus.SETUP_FAIL, error_msg=str(e))
+            error_code, error_msg = 409, str(e)
+
+    if error_code != 202:
+        parsed.close()
+
+    # Receive what is left of the body, so that the client gets our response
+    parsed.parts.drain()
+
+    response = {
+        # protocol version
+        "version": 1,
+        "error_msg": error_msg,
+        "job_ids": [job_record.id for job_record in job_records],
+        "reattach_tokens": [job_record.reattach_token for job_record in job_records],
+    }
+    return flask.make_response(flask.jsonify(response), error_code)
+
+
+@app.route('/api/v1/jobs', methods=['GET'])
+def get_job_list():
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    return {
+        "jobs": dict([(j.id, j) for j in mars.jobs.jobs])
+    }
+
+
+@app.route('/api/v1/job/<job_id>', methods=['GET'])
+def get_job(job_id):
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    job = mars.jobs.get(job_id, raise_if_missing=True)
+    return CustomJSONEncoder().default(job)
+
+
+@app.route('/api/v1/job/<job_id>/reattach', methods=['POST'])
+def reattach_job(job_id):
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    job = mars.jobs.get(job_id, raise_if_missing=True)
+
+    # Only let the submitter of the job redirect its console
+    token = flask.request.json.get("reattach_token")
+    if not isinstance(token, str) or not secrets.compare_digest(token, job.reattach_token):
+        return flask.make_response(flask.jsonify({"error": "Invalid reattach token"}), 403)
+
+    console = job.console
+    if console is None:
+        return flask.make_response(flask.jsonify({"error": f"The job {job_id} has no console to reattach to"}), 409)
+
+    # Use the client-provided host callback if available, or default to the remote addr
+    callback = flask.request.json.get("callback", {})
+    endpoint = (callback.get("host", flask.request.remote_addr), callback.get("port"))
+    if endpoint[1] is None:
+        raise ValueError("callback's port cannot be None")
+
+    console.reattach(endpoint, last_seq=flask.request.json.get("last_seq"))
+    return flask.jsonify({"version": 1, "job_id": job.id})
+
+
+@app.route('/api/v1/objects/lookup', methods=['POST'])
+def lookup_objects():
+    objects = flask.request.json.get("objects", [])
+    for obj in objects:
+        if not isinstance(obj, dict) or "sha256" not in obj or "size" not in obj:
+            raise ValueError("Every object needs to specify its 'sha256' and 'size'")
+
+    available = MinioClient().lookup_object_pool([(obj["sha256"], obj["size"]) for obj in objects])
+    return flask.jsonify({"available": sorted(available)})
+
+
+@app.route('/api/v1/artifacts/prefetch', methods=['POST'])
+def prefetch_artifacts():
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    artifacts = flask.request.json.get("artifacts", [])
+    for artifact in artifacts:
+        if not isinstance(artifact, dict) or "url" not in artifact:
+            raise ValueError("Every artifact needs to specify its 'url'")
+
+    requests = [mars.prefetcher.prefetch(a["url"], sha256=a.get("sha256")) for a in artifacts]
+    return flask.make_response(flask.jsonify({"artifacts": requests}), 202)
+
+
+@app.route('/api/v1/artifacts/prefetch', methods=['GET'])
+def get_prefetch_status():
+    with app.app_context():
+        mars = flask.current_app.mars
+
+    return flask.jsonify({"artifacts": mars.prefetcher.requests})
+
+
 def run():  # pragma: nocover
     # Make sure the farm name has been set
     if config.FARM_NAME is None:
@@ -0,0 +1,806 @@
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import Future
+from collections import defaultdict, OrderedDict
+from threading import Thread, Event, Lock
+from datetime import datetime
+from queue import Queue, Empty
+from enum import Enum
+
+import traceback
+import requests
+import hashlib
+import json
+import time
+import uuid
+
+from .chunking import ChunkIndex, content_defined_chunks, split_chunks
+from .compression import HEADER_SIZE, detect_compression, recompressed
+from .minioclient import MinioClient
+from .logger import logger
+from . import config
+
+
+@dataclass
+class CachedArtifact:
+    url: str
+    digest: str
+    size: int
+    etag: str = None
+    last_modified: str = None
+    last_used: float = field(default_factory=time.time)
+
+    @property
+    def object_name(self):
+        return BootArtifactCache.object_name(self.digest)
+
+    @property
+    def validators(self):
+        headers = dict()
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class HashingReader:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def read(self, size=-1):
+        if len(self._buffer) == 0:
+            self._buffer = next(self._chunks, b"")
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+
+class InFlightDownload(Future):
+    def __init__(self, max_bandwidth=None):
+        super().__init__()
+
+        # Maximum download speed, in bytes per second
+        self.max_bandwidth = max_bandwidth
+
+    def throttle(self, chunks):
+        start = time.monotonic()
+        received = 0
+        for chunk in chunks:
+            yield chunk
+
+            # NOTE: The limit may get lifted during the download
+            received += len(chunk)
+            if self.max_bandwidth:
+                delay = received / self.max_bandwidth - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class BootArtifactCache:
+    INDEX_OBJECT_NAME = "cas/index.json"
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+    # Origins may serve the chunk index of an artifact next to it, so that we only download the chunks we miss
+    CHUNK_INDEX_SUFFIX = ".chunks.json"
+
+    def __init__(self, minio=None, max_size=None):
+        if max_size is None:
+            max_size = int(config.EXECUTOR_ARTIFACT_CACHE_MAX_SIZE)
+
+        self.max_size = max_size
+
+        self._minio = minio
+        self._lock = Lock()
+
+        # Loads and saves of the index happen without holding the lock, make sure they do not overlap and that older
+        # snapshots never overwrite newer ones
+        self._index_lock = Lock()
+        self._index_generation = 0
+        self._saved_index_generation = 0
+
+        # NOTE: The index is loaded from MinIO on first use, before taking the lock
+        self._artifacts = None
+        self._variants = None
+        self._chunks = None
+        self._materialized = None
+
+        # Number of jobs using every digest, which should thus not be evicted
+        self._in_use = defaultdict(int)
+
+        # Downloads currently in progress, shared by all the jobs needing them
+        self._in_flight = dict()
+
+    @classmethod
+    def object_name(cls, digest):
+        return f"cas/{digest}"
+
+    @classmethod
+    def chunk_object_name(cls, digest):
+        return f"chunks/{digest}"
+
+    @property
+    def minio(self):
+        # Delay the creation of the client until it is needed
+        if self._minio is None:
+            self._minio = MinioClient()
+        return self._minio
+
+    @property
+    def artifacts(self):
+        self._ensure_index()
+        return self._artifacts
+
+    @property
+    def variants(self):
+        # Size of the recompressed versions of the artifacts, per digest and format. The size
+        # is None when the artifact already uses the format.
+        self._ensure_index()
+        return self._variants
+
+    @property
+    def chunks(self):
+        # List of the (sha256, size) of the chunks making up every digest
+        self._ensure_index()
+        return self._chunks
+
+    @property
+    def materialized(self):
+        # Digests stored in full, ready to be booted. The others need to be rebuilt from their chunks first
+        self._ensure_index()
+        return self._materialized
+
+    @property
+    def size(self):
+        self._ensure_index()
+        with self._lock:
+            return self._stored_size()
+
+    def _ensure_index(self):
+        # NOTE: Needs to be called without the lock held, since loading the index needs MinIO I/O
+        if self._artifacts is None:
+            with self._index_lock:
+                if self._artifacts is None:
+                    self._load_index()
+
+    def _load_index(self):
+        artifacts = dict()
+        variants = dict()
+        chunks = dict()
+        materialized = set()
+
+        try:
+            if data := self.minio.load_boot_artifact(self.INDEX_OBJECT_NAME):
+                index = json.loads(data)
+                artifacts = {url: CachedArtifact(**a) for url, a in index.get("artifacts", {}).items()}
+                variants = index.get("variants", {})
+                chunks = {d: [tuple(c) for c in digest_chunks] for d, digest_chunks in index.get("chunks", {}).items()}
+
+                # NOTE: Artifacts cached before the introduction of chunks are all stored in full
+                materialized = set(index.get("materialized", [a.digest for a in artifacts.values()]))
+        except Exception:
+            logger.error(f"Failed to load the boot artifact cache's index, starting from scratch:\n"
+                         f"{traceback.format_exc()}")
+
+        # NOTE: The artifacts get set last, as they tell whether the index got loaded
+        self._variants = variants
+        self._chunks = chunks
+        self._materialized = materialized
+        self._artifacts = artifacts
+
+    def _snapshot_index(self):
+        # NOTE: Needs to be called with the lock held
+        data = json.dumps({
+            "artifacts": {url: asdict(a) for url, a in self.artifacts.items()},
+            "variants": self.variants,
+            "chunks": {digest: [list(c) for c in chunks] for digest, chunks in self.chunks.items()},
+            "materialized": sorted(self.materialized),
+        })
+        self._index_generation += 1
+        return self._index_generation, data.encode()
+
+    def _save_index(self, snapshot):
+        # NOTE: Needs to be called without the lock held, using a snapshot taken with the lock held
+        generation, data = snapshot
+        with self._index_lock:
+            if generation <= self._saved_index_generation:
+                return
+            self.minio.save_boot_artifact(self.INDEX_OBJECT_NAME, data)
+            self._saved_index_generation = generation
+
+    def _chunk_sizes(self):
+        return {sha256: size for chunks in self.chunks.values() for sha256, size in chunks}
+
+    def _stored_size(self):
+        # NOTE: Needs to be called with the lock held
+        sizes = {a.digest: a.size for a in self.artifacts.values()}
+
+        total_size = sum(self._chunk_sizes().values())
+        for digest in self.materialized:
+            total_size += sizes.get(digest, sum([size for _, size in self.chunks.get(digest, [])]))
+            total_size += sum([size for size in self.variants.get(digest, {}).values() if size is not None])
+        return total_size
+
+    def _is_indexed(self, digest):
+        # NOTE: Needs to be called with the lock held
+        return digest in self.chunks or digest in self.materialized
+
+    def _is_available(self, digest):
+        # NOTE: Needs to be called without the lock held, since it may need to check MinIO
+        with self._lock:
+            if digest in self.chunks:
+                return True
+            if digest not in self.materialized:
+                return False
+        return self.minio.boot_artifact_exists(self.object_name(digest))
+
+    def _find_by_digest(self, digest):
+        for artifact in self.artifacts.values():
+            if artifact.digest == digest:
+                return artifact
+
+    def _register(self, artifact, in_use=True):
+        # NOTE: Needs to be called with the lock held. Returns the checkpoint to persist once the lock is released
+        artifact.last_used = time.time()
+        self.artifacts[artifact.url] = artifact
+        if in_use:
+            self._in_use[artifact.digest] += 1
+        return self._checkpoint()
+
+    def _checkpoint(self):
+        # NOTE: Needs to be called with the lock held. Evicts what does not fit in the cache anymore, then returns
+        # the snapshot of the index and the objects to remove, for _persist() to apply once the lock is released
+        removals = self._evict()
+        return self._snapshot_index(), removals
+
+    def _persist(self, checkpoint):
+        # NOTE: Needs to be called without the lock held. The index gets saved before the objects it does not
+        # reference anymore get removed
+        snapshot, removals = checkpoint
+        self._save_index(snapshot)
+        self._remove_objects(removals)
+
+    def _is_referenced(self, object_name, chunk_sizes):
+        # NOTE: Needs to be called with the lock held
+        if object_name.startswith(self.chunk_object_name("")):
+            return object_name[len(self.chunk_object_name("")):] in chunk_sizes
+
+        digest, _, codec = object_name[len(self.object_name("")):].partition(".")
+        if codec:
+            return codec in self.variants.get(digest, {})
+        return digest in self.materialized
+
+    def _remove_objects(self, object_names):
+        # NOTE: Needs to be called without the lock held. Objects that got stored again meanwhile are kept
+        with self._lock:
+            chunk_sizes = self._chunk_sizes()
+            object_names = [n for n in object_names if not self._is_referenced(n, chunk_sizes)]
+
+        for object_name in object_names:
+            self.minio.remove_boot_artifact(object_name)
+
+    def _dematerialize(self, digest):
+        # NOTE: Needs to be called with the lock held. Returns the objects to remove once the lock is released
+        removals = []
+        if digest in self.materialized:
+            self.materialized.discard(digest)
+            removals.append(self.object_name(digest))
+
+        for codec, size in self.variants.pop(digest, {}).items():
+            if size is not None:
+                removals.append(self.object_name(f"{digest}.{codec}"))
+
+        return removals
+
+    def _unused_chunks(self, candidates):
+        # NOTE: Needs to be called with the lock held. Returns the objects of the chunks no artifact uses anymore
+        used = self._chunk_sizes()
+        return [self.chunk_object_name(sha256) for sha256 in set(candidates) - set(used)]
+
+    def _forget(self, digest):
+        # NOTE: Needs to be called with the lock held. Returns the objects to remove once the lock is released
+        removals = self._dematerialize(digest)
+        removals += self._unused_chunks([sha256 for sha256, _ in self.chunks.pop(digest, [])])
+        for url in [url for url, a in self.artifacts.items() if a.digest == digest]:
+            del self.artifacts[url]
+        return removals
+
+    def _evict(self):
+        # NOTE: Needs to be called with the lock held. Returns the objects to remove once the lock is released
+        removals = []
+        last_used = defaultdict(float)
+        for artifact in self.artifacts.values():
+            last_used[artifact.digest] = max(last_used[artifact.digest], artifact.last_used)
+
+        # Never evict artifacts that are being used by a job
+        candidates = [d for d in sorted(last_used, key=lambda d: last_used[d]) if self._in_use.get(d, 0) == 0]
+
+        # Start by removing the full copies of the least recently used artifacts, as they can be rebuilt from
+        # their chunks without downloading anything, then forget about the artifacts altogether
+        for digest in [d for d in candidates if d in self.materialized and d in self.chunks]:
+            if self._stored_size() <= self.max_size:
+                return removals
+
+            logger.info(f"Evicting the full copy of the boot artifact {digest} from the cache")
+            removals += self._dematerialize(digest)
+
+        for digest in candidates:
+            if self._stored_size() <= self.max_size:
+                return removals
+
+            logger.info(f"Evicting the boot artifact {digest} from the cache")
+            removals += self._forget(digest)
+
+        return removals
+
+    @classmethod
+    def _check_digest(cls, url, digest, sha256):
+        if sha256 is not None and digest != sha256.lower():
+            raise ValueError(f"The artifact {url} does not match the expected sha256: "
+                             f"Expected {sha256}, got {digest}")
+
+    def _store(self, reader, sha256=None):
+        # Stream the artifact to a staging object, since its name depends on its content
+        staging_object_name = self.object_name(f"staging/{uuid.uuid4()}")
+        self.minio.save_boot_artifact(staging_object_name, reader)
+
+        try:
+            self._check_digest(staging_object_name, reader.digest, sha256)
+
+            # Identical artifacts served from different URLs are only stored once
+            object_name = self.object_name(reader.digest)
+            if not self.minio.boot_artifact_exists(object_name):
+                self.minio.copy_boot_artifact(staging_object_name, object_name)
+        finally:
+            self.minio.remove_boot_artifact(staging_object_name)
+
+    def _store_chunks(self, chunks, stored):
+        with self._lock:
+            known = set(self._chunk_sizes())
+
+        for chunk in chunks:
+            sha256 = hashlib.sha256(chunk).hexdigest()
+            if sha256 not in known and sha256 not in stored:
+                self.minio.save_boot_artifact(self.chunk_object_name(sha256), chunk)
+                stored.add(sha256)
+            yield sha256, chunk
+
+    def _load_chunks(self, chunks):
+        for sha256, _ in chunks:
+            if (data := self.minio.load_boot_artifact(self.chunk_object_name(sha256))) is None:
+                raise ValueError(f"The chunk {sha256} is missing")
+            yield data
+
+    def _ingest(self, url, response, in_flight=None):
+        blocks = response.iter_content(self.DOWNLOAD_CHUNK_SIZE)
+        if in_flight is not None:
+            blocks = in_flight.throttle(blocks)
+
+        # Split the artifact into chunks while streaming it, so that the next versions may share them
+        chunks = []
+        stored = set()
+
+        def store_chunks():
+            for sha256, chunk in self._store_chunks(content_defined_chunks(blocks), stored):
+                chunks.append((sha256, len(chunk)))
+                yield chunk
+
+        try:
+            reader = HashingReader(store_chunks())
+            self._store(reader)
+        except Exception:
+            with self._lock:
+                removals = self._unused_chunks(stored)
+            self._remove_objects(removals)
+            raise
+
+        logger.info(f"Stored {url} in the boot artifact cache as {reader.digest}: {len(stored)}/{len(chunks)} "
+                    "new chunks")
+        with self._lock:
+            self.chunks[reader.digest] = chunks
+            self.materialized.add(reader.digest)
+
+        return CachedArtifact(url=url, digest=reader.digest, size=reader.size,
+                              etag=response.headers.get("ETag"),
+                              last_modified=response.headers.get("Last-Modified"))
+
+    def _fetch_chunk_index(self, url, response):
+        # Fetching parts of the artifact requires range requests
+        if response.headers.get("Accept-Ranges") != "bytes":
+            return None
+
+        try:
+            r = requests.get(f"{url}{self.CHUNK_INDEX_SUFFIX}")
+            if r.status_code != 200:
+                return None
+            return ChunkIndex.from_dict(r.json())
+        except Exception as e:
+            logger.warning(f"Ignoring the invalid chunk index of {url}: {e}")
+            return None
+
+    def _ingest_from_index(self, url, headers, index, in_flight=None):
+        artifact = CachedArtifact(url=url, digest=index.sha256, size=index.size,
+                                  etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+
+        if self._is_available(index.sha256):
+            return artifact
+
+        with self._lock:
+            known = set(self._chunk_sizes())
+
+        # Group the missing chunks into as few ranges as possible
+        ranges = []
+        for offset, sha256, size in index.offsets:
+            if sha256 in known:
+                continue
+            if len(ranges) > 0 and ranges[-1][0] + sum([s for _, s in ranges[-1][1]]) == offset:
+                ranges[-1][1].append((sha256, size))
+            else:
+                ranges.append((offset, [(sha256, size)]))
+
+        # Make sure all the ranges come from the same version of the artifact
+        range_headers = dict()
+        if validator := headers.get("ETag", headers.get("Last-Modified")):
+            range_headers["If-Range"] = validator
+
+        stored = set()
+        try:
+            for offset, chunks in ranges:
+                size = sum([s for _, s in chunks])
+                range_headers["Range"] = f"bytes={offset}-{offset + size - 1}"
+                with requests.get(url, headers=range_headers, stream=True) as r:
+                    if r.status_code != 206:
+                        raise ValueError(f"Expected a partial response, got the status code {r.status_code}")
+
+                    blocks = r.iter_content(self.DOWNLOAD_CHUNK_SIZE)
+                    if in_flight is not None:
+                        blocks = in_flight.throttle(blocks)
+
+                    data = split_chunks(blocks, [s for _, s in chunks])
+                    for (expected, _), (sha256, _) in zip(chunks, self._store_chunks(data, stored)):
+                        if sha256 != expected:
+                            raise ValueError(f"The chunk at offset {offset} does not match the index")
+
+            logger.info(f"Fetched {len(stored)}/{len(index.chunks)} chunks of {url}")
+
+            # Make sure the artifact can be rebuilt before adding it to the cache
+            self._store(HashingReader(self._load_chunks(index.chunks)), sha256=index.sha256)
+        except Exception:
+            with self._lock:
+                removals = self._unused_chunks(stored)
+            self._remove_objects(removals)
+            raise
+
+        with self._lock:
+            self.chunks[index.sha256] = index.chunks
+            self.materialized.add(index.sha256)
+
+        return artifact
+
+    def _download(self, url, cached=None, in_flight=None):
+        # Revalidate the cached copy, if we have one
+        headers = cached.validators if cached is not None else dict()
+        with requests.get(url, headers=headers, stream=True) as r:
+            if r.status_code == 304 and cached is not None:
+                return cached
+
+            r.raise_for_status()
+            if (index := self._fetch_chunk_index(url, r)) is None:
+                return self._ingest(url, r, in_flight=in_flight)
+
+        # NOTE: The body of the artifact is not needed when we can fetch the chunks we miss
+        try:
+            return self._ingest_from_index(url, r.headers, index, in_flight=in_flight)
+        except Exception:
+            logger.warning(f"Failed to fetch {url} using its chunk index, downloading it in full:\n"
+                           f"{traceback.format_exc()}")
+
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            return self._ingest(url, r, in_flight=in_flight)
+
+    def _materialize(self, digest):
+        with self._lock:
+            materialized = digest in self.materialized
+            chunks = self.chunks.get(digest)
+
+        if materialized and self.minio.boot_artifact_exists(self.object_name(digest)):
+            return
+        if chunks is None:
+            raise KeyError(f"The boot artifact {digest} has no chunks to be rebuilt from")
+
+        logger.info(f"Rebuilding the boot artifact {digest} from its {len(chunks)} chunks")
+        self._store(HashingReader(self._load_chunks(chunks)), sha256=digest)
+
+        with self._lock:
+            self.materialized.add(digest)
+            checkpoint = self._checkpoint()
+        self._persist(checkpoint)
+
+    def _single_flight(self, key, func):
+        with self._lock:
+            task = self._in_flight.get(key)
+            is_worker = task is None
+            if is_worker:
+                task = self._in_flight[key] = InFlightDownload()
+
+        if is_worker:
+            try:
+                task.set_result(func())
+            except Exception as e:
+                task.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+
+        return task.result()
+
+    def is_cached(self, url):
+        self._ensure_index()
+        with self._lock:
+            return url in self.artifacts
+
+    def _acquire(self, url, sha256=None, max_bandwidth=None):
+        # NOTE: Check what MinIO has without holding the lock, then make sure the index still knows about the
+        # artifact before using it, as it may have been evicted meanwhile
+
+        # Pinned artifacts never change, use any copy we already have
+        if sha256 is not None:
+            digest = sha256.lower()
+            with self._lock:
+                known = self._find_by_digest(digest)
+            if known is not None and self._is_available(digest):
+                checkpoint = None
+                with self._lock:
+                    if self._is_indexed(digest):
+                        cached = self.artifacts.get(url)
+                        if cached is None or cached.digest != digest:
+                            cached = CachedArtifact(url=url, digest=digest, size=known.size)
+                        checkpoint = self._register(cached)
+                if checkpoint is not None:
+                    self._persist(checkpoint)
+                    return cached
+
+        with self._lock:
+            cached = self.artifacts.get(url)
+        if cached is not None and not self._is_available(cached.digest):
+            cached = None
+
+        with self._lock:
+            if cached is not None and not self._is_indexed(cached.digest):
+                cached = None
+
+            # Join the download of the artifact if it is already in progress
+            download = self._in_flight.get(url)
+            is_downloader = download is None
+            if is_downloader:
+                download = self._in_flight[url] = InFlightDownload(max_bandwidth=max_bandwidth)
+            elif max_bandwidth is None:
+                # Someone needs the artifact now, stop throttling the download
+                download.max_bandwidth = None
+
+        # NOTE: Download without holding the lock, to allow other artifacts to be acquired meanwhile
+        if is_downloader:
+            try:
+                download.set_result(self._download(url, cached=cached, in_flight=download))
+            except Exception as e:
+                download.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[url]
+
+        artifact = download.result()
+
+        with self._lock:
+            # NOTE: Keep track of unexpected artifacts too, so that they may get evicted
+            is_expected = sha256 is None or artifact.digest == sha256.lower()
+            checkpoint = self._register(artifact, in_use=is_expected)
+        self._persist(checkpoint)
+
+        self._check_digest(url, artifact.digest, sha256)
+        return artifact
+
+    def acquire(self, url, sha256=None, max_bandwidth=None):
+        # Artifacts hosted by our MinIO instance do not need caching
+        if self.minio.is_local_url(url):
+            return url
+
+        self._ensure_index()
+        for attempt in range(2):
+            artifact = self._acquire(url, sha256=sha256, max_bandwidth=max_bandwidth)
+            local_url = self.minio.boot_artifact_url(artifact.object_name)
+
+            try:
+                # The artifact may only be stored as chunks, rebuild it before it gets booted
+                self._single_flight(artifact.digest, lambda: self._materialize(artifact.digest))
+                return local_url
+            except Exception:
+                # Forget about the chunks, so that the artifact gets downloaded again
+                with self._lock:
+                    self.materialized.discard(artifact.digest)
+                    removals = self._unused_chunks([c for c, _ in self.chunks.pop(artifact.digest, [])])
+                self._remove_objects(removals)
+                self.release(local_url)
+
+                if attempt > 0:
+                    raise
+                logger.warning(f"Failed to rebuild the boot artifact {artifact.digest}, downloading it again:\n"
+                               f"{traceback.format_exc()}")
+
+    def _recompress(self, digest, codec):
+        response = self.minio.open_boot_artifact(self.object_name(digest))
+        try:
+            # Nothing to do if the artifact already uses the wanted format
+            header = response.read(HEADER_SIZE)
+            if detect_compression(header) == codec:
+                return None
+
+            variant_object_name = self.object_name(f"{digest}.{codec}")
+            try:
+                with recompressed(response, codec, header=header) as stream:
+                    reader = HashingReader(iter(lambda: stream.read(self.DOWNLOAD_CHUNK_SIZE), b""))
+                    self.minio.save_boot_artifact(variant_object_name, reader)
+            except Exception:
+                if self.minio.boot_artifact_exists(variant_object_name):
+                    self.minio.remove_boot_artifact(variant_object_name)
+                raise
+
+            logger.info(f"Recompressed the boot artifact {digest} using {codec}: {reader.size} bytes")
+            return reader.size
+        finally:
+            response.close()
+            response.release_conn()
+
+    def acquire_variant(self, local_url, codec):
+        # NOTE: The local URL should come from acquire(), so that it does not get evicted meanwhile
+        prefix = self.minio.boot_artifact_url(self.object_name(""))
+        if not local_url.startswith(prefix):
+            # Artifacts that were already hosted locally are left untouched
+            return local_url
+
+        digest = local_url[len(prefix):]
+        key = f"{digest}.{codec}"
+        self._ensure_index()
+        with self._lock:
+            if codec in self.variants.get(digest, {}):
+                size = self.variants[digest][codec]
+                return local_url if size is None else self.minio.boot_artifact_url(self.object_name(key))
+
+        # Join the recompression if it is already in progress
+        size = self._single_flight(key, lambda: self._recompress(digest, codec))
+
+        with self._lock:
+            self.variants.setdefault(digest, dict())[codec] = size
+            checkpoint = self._checkpoint()
+        self._persist(checkpoint)
+
+        return local_url if size is None else self.minio.boot_artifact_url(self.object_name(key))
+
+    def release(self, local_url):
+        prefix = self.minio.boot_artifact_url(self.object_name(""))
+        if not local_url.startswith(prefix):
+            return
+
+        # NOTE: Variants are released through the artifact they are generated from
+        digest = local_url[len(prefix):].split(".")[0]
+        with self._lock:
+            if self._in_use.get(digest, 0) > 1:
+                self._in_use[digest] -= 1
+            else:
+                self._in_use.pop(digest, None)
+
+
+# Shared by all the executors of the farm
+boot_artifact_cache = BootArtifactCache()
+
+
+class PrefetchState(Enum):
+    QUEUED = 0
+    DOWNLOADING = 1
+    WARM = 2
+    FAILED = 3
+
+
+class PrefetchRequest:
+    def __init__(self, cache, url, sha256=None):
+        self.cache = cache
+        self.url = url
+        self.sha256 = sha256
+
+        self.state = PrefetchState.QUEUED
+        self.error_msg = None
+
+        self.created_at = datetime.now()
+        self.updated_at = self.created_at
+
+    @property
+    def is_pending(self):
+        return self.state in [PrefetchState.QUEUED, PrefetchState.DOWNLOADING]
+
+    @property
+    def is_cached(self):
+        # NOTE: Warm artifacts may have been evicted since then
+        return self.cache.is_cached(self.url)
+
+    def set_state(self, state, error_msg=None):
+        self.state = state
+        self.error_msg = error_msg
+        self.updated_at = datetime.now()
+
+
+class ArtifactPrefetcher(Thread):
+    HISTORY_SIZE = 100
+
+    def __init__(self, cache=None, max_bandwidth=None):
+        super().__init__(name='ArtifactPrefetcher', daemon=True)
+
+        if max_bandwidth is None:
+            max_bandwidth = int(config.EXECUTOR_ARTIFACT_PREFETCH_BANDWIDTH)
+
+        self.cache = cache if cache is not None else boot_artifact_cache
+
+        # Maximum download speed, in bytes per second. 0 means unlimited
+        self.max_bandwidth = max_bandwidth
+
+        self._lock = Lock()
+        self._requests = OrderedDict()
+        self._queue = Queue()
+
+        self.stop_event = Event()
+
+    @property
+    def requests(self):
+        with self._lock:
+            return list(self._requests.values())
+
+    def prefetch(self, url, sha256=None):
+        with self._lock:
+            # Do not queue the same artifact twice
+            if (request := self._requests.get(url)) is not None and request.is_pending:
+                return request
+
+            request = PrefetchRequest(self.cache, url, sha256=sha256)
+            self._requests.pop(url, None)
+            self._requests[url] = request
+
+            # Forget about the oldest requests that completed
+            finished = [u for u, r in self._requests.items() if not r.is_pending]
+            for u in finished[:max(0, len(self._requests) - self.HISTORY_SIZE)]:
+                del self._requests[u]
+
+        self._queue.put(request)
+        return request
+
+    def process(self, request):
+        request.set_state(PrefetchState.DOWNLOADING)
+        try:
+            local_url = self.cache.acquire(request.url, sha256=request.sha256,
+                                           max_bandwidth=self.max_bandwidth or None)
+
+            # Keep the artifact in the cache, but allow it to be evicted
+            self.cache.release(local_url)
+
+            request.set_state(PrefetchState.WARM)
+        except Exception as e:
+            logger.error(f"Failed to prefetch {request.url}: {e}")
+            request.set_state(PrefetchState.FAILED, error_msg=str(e))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                request = self._queue.get(timeout=1)
+            except Empty:
+                continue
+
+            self.process(request)
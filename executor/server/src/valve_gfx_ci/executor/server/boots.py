@@ -285,6 +285,18 @@ initrd --name initrd {bootconfig.initrd}
 
 echo Booting!
 boot
+"""
+
+    @classmethod
+    def _gen_ipxe_standby_script(cls, poll_period=5):
+        # NOTE: Relative URLs are resolved by iPXE using the URL of the current script
+        return f"""#!ipxe
+
+echo Waiting for a job...
+
+:poll
+sleep {poll_period}
+chain --replace --autofree boot.ipxe?platform=${{platform}}&buildarch=${{buildarch}} || goto poll
 """
 
     def ipxe_boot_script(self, machine=None, platform=None, buildarch=None):
@@ -293,6 +305,10 @@ boot
         if machine is not None and machine.executor is not None:
             bootconfig = machine.executor.boot_config_query(platform=platform, buildarch=buildarch)
 
+            # Keep warm machines waiting until a job gets assigned to them
+            if bootconfig is None and machine.executor.hot_standby:
+                return self._gen_ipxe_standby_script()
+
         if bootconfig is None:
             bootconfig = self.default_boot_config
 
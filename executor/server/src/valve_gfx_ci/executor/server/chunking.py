@@ -0,0 +1,105 @@
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+import hashlib
+import json
+import sys
+
+
+# Content-defined chunking: Every byte value is randomly marked as being a potential boundary or not, and a chunk
+# ends after CHUNK_RUN_LENGTH consecutive marked bytes. For random data, this happens every 2^(CHUNK_RUN_LENGTH + 1)
+# bytes on average (~256 KiB), on top of the minimum size. Since boundaries only depend on the surrounding content,
+# inserting or removing data only changes the chunks around the modification.
+CHUNK_MIN_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 1024 * 1024
+CHUNK_RUN_LENGTH = 17
+
+# NOTE: The table needs to be the same everywhere for the chunks to be shared, so derive it from a fixed seed
+_seed = hashlib.sha256(b"valve-gfx-ci boot artifact chunks").digest()
+_BOUNDARY_TABLE = bytes([ord("1") if (_seed[b // 8] >> (b % 8)) & 1 else ord("0") for b in range(256)])
+_BOUNDARY_MARKER = b"1" * CHUNK_RUN_LENGTH
+
+
+def _chunk_size(data):
+    # NOTE: Translating the data and looking for the marker runs at C speed, unlike a rolling hash computed in python
+    window = data[:CHUNK_MAX_SIZE].translate(_BOUNDARY_TABLE)
+    pos = window.find(_BOUNDARY_MARKER, max(0, CHUNK_MIN_SIZE - CHUNK_RUN_LENGTH))
+    return pos + CHUNK_RUN_LENGTH if pos >= 0 else len(window)
+
+
+def content_defined_chunks(blocks):
+    buf = bytearray()
+    for block in blocks:
+        buf += block
+
+        # Only cut chunks when enough data is available to find the next boundary
+        while len(buf) >= CHUNK_MAX_SIZE:
+            size = _chunk_size(buf)
+            yield bytes(buf[:size])
+            del buf[:size]
+
+    while len(buf) > 0:
+        size = _chunk_size(buf)
+        yield bytes(buf[:size])
+        del buf[:size]
+
+
+def split_chunks(blocks, sizes):
+    blocks = iter(blocks)
+    buf = bytearray()
+    for size in sizes:
+        while len(buf) < size:
+            if (block := next(blocks, None)) is None:
+                raise ValueError(f"Got {len(buf)} bytes when expecting a chunk of {size} bytes")
+            buf += block
+
+        yield bytes(buf[:size])
+        del buf[:size]
+
+
+@dataclass
+class ChunkIndex:
+    sha256: str
+    size: int
+
+    # List of (sha256, size) of the chunks making up the artifact
+    chunks: List[Tuple[str, int]] = field(default_factory=list)
+
+    @property
+    def offsets(self):
+        offset = 0
+        for sha256, size in self.chunks:
+            yield offset, sha256, size
+            offset += size
+
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            chunks = [(str(sha256).lower(), int(size)) for sha256, size in data["chunks"]]
+            index = cls(sha256=str(data["sha256"]).lower(), size=int(data["size"]), chunks=chunks)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid chunk index: {e}") from e
+
+        if sum([size for _, size in index.chunks]) != index.size:
+            raise ValueError("Invalid chunk index: The size of the chunks does not match the size of the artifact")
+
+        return index
+
+    def to_dict(self):
+        return {"sha256": self.sha256, "size": self.size, "chunks": [list(c) for c in self.chunks]}
+
+    @classmethod
+    def from_stream(cls, f, block_size=CHUNK_MAX_SIZE):
+        artifact_hash = hashlib.sha256()
+        chunks = []
+        for chunk in content_defined_chunks(iter(lambda: f.read(block_size), b"")):
+            artifact_hash.update(chunk)
+            chunks.append((hashlib.sha256(chunk).hexdigest(), len(chunk)))
+
+        return cls(sha256=artifact_hash.hexdigest(), size=sum([size for _, size in chunks]), chunks=chunks)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    # Generate the chunk index of an artifact, to be served next to it by the origin
+    with open(sys.argv[1], "rb") as f:
+        print(json.dumps(ChunkIndex.from_stream(f).to_dict()))
@@ -0,0 +1,116 @@
+from contextlib import contextmanager
+from threading import Thread
+
+import subprocess
+import shutil
+
+
+# Compression formats supported by Linux for the initramfs, their magic number, and how to decompress them
+DECOMPRESSORS = {
+    "xz": (b"\xfd7zXZ\x00", ["xz", "-dc"]),
+    "gzip": (b"\x1f\x8b", ["gzip", "-dc"]),
+    "bzip2": (b"BZh", ["bzip2", "-dc"]),
+    "zstd": (b"\x28\xb5\x2f\xfd", ["zstd", "-q", "-dc"]),
+    "lz4": (b"\x02\x21\x4c\x18", ["lz4", "-q", "-dc"]),
+}
+
+# Formats that are fast to decompress by the DUTs' kernel
+COMPRESSORS = {
+    "zstd": ["zstd", "-q", "-c", "-T0", "-19"],
+    # NOTE: Linux only supports the legacy lz4 frame format
+    "lz4": ["lz4", "-q", "-c", "-l", "-12"],
+}
+
+HEADER_SIZE = max([len(magic) for magic, _ in DECOMPRESSORS.values()])
+
+
+def detect_compression(header):
+    for name, (magic, _) in DECOMPRESSORS.items():
+        if header.startswith(magic):
+            return name
+
+
+class PrefixedStream:
+    def __init__(self, prefix, stream):
+        # Give back the header that got read to detect the compression, before the rest of the stream
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size=-1):
+        if len(self._prefix) == 0:
+            return self._stream.read(size)
+
+        if size is None or size < 0:
+            data = self._prefix + self._stream.read()
+            self._prefix = b""
+        else:
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+        return data
+
+
+@contextmanager
+def _pipeline(src, commands, header=b"", chunk_size=1024 * 1024):
+    processes = []
+    for cmd in commands:
+        stdin = processes[-1].stdout if len(processes) > 0 else subprocess.PIPE
+        processes.append(subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE))
+
+        # Let the previous process get a SIGPIPE if the next one exits
+        if stdin != subprocess.PIPE:
+            stdin.close()
+
+    def feed(sink):
+        try:
+            sink.write(header)
+            shutil.copyfileobj(src, sink, chunk_size)
+        except OSError:
+            # The pipeline exited early, which will be reported by its exit code
+            pass
+        finally:
+            try:
+                sink.close()
+            except OSError:  # pragma: nocover
+                pass
+
+    feeder = Thread(target=feed, args=(processes[0].stdin, ), daemon=True)
+    feeder.start()
+
+    try:
+        yield processes[-1].stdout
+    except Exception:
+        for p in processes:
+            p.kill()
+        raise
+    finally:
+        processes[-1].stdout.close()
+        for p in processes:
+            p.wait()
+        feeder.join()
+
+    for cmd, p in zip(commands, processes):
+        if p.returncode != 0:
+            raise ValueError(f"The command '{' '.join(cmd)}' failed with the exit code {p.returncode}")
+
+
+@contextmanager
+def recompressed(src, codec, header=b"", chunk_size=1024 * 1024):
+    if codec not in COMPRESSORS:
+        raise ValueError(f"Unsupported compression format '{codec}'")
+
+    # Decompress the source first, unless it is not compressed
+    commands = []
+    if (src_format := detect_compression(header)) is not None:
+        commands.append(DECOMPRESSORS[src_format][1])
+    commands.append(COMPRESSORS[codec])
+
+    with _pipeline(src, commands, header=header, chunk_size=chunk_size) as f:
+        yield f
+
+
+@contextmanager
+def decompressed(src, header=b"", chunk_size=1024 * 1024):
+    if (src_format := detect_compression(header)) is None:
+        raise ValueError("Unknown compression format")
+
+    with _pipeline(src, [DECOMPRESSORS[src_format][1]], header=header, chunk_size=chunk_size) as f:
+        yield f
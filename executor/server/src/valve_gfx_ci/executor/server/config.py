@@ -21,6 +21,19 @@ configurables = {
     'SERGENT_HARTMAN_BOOT_COUNT': '100',
     'SERGENT_HARTMAN_QUALIFYING_BOOT_COUNT': '100',
     'SERGENT_HARTMAN_REGISTRATION_RETRIAL_DELAY': '120',
+    'EXECUTOR_HEALTH_WINDOW': '20',
+    'EXECUTOR_HEALTH_MIN_SAMPLES': '10',
+    'EXECUTOR_HEALTH_RETRAIN_THRESHOLD': '0.5',
+    'EXECUTOR_CACHE_AFFINITY_HISTORY': '3',
+    'EXECUTOR_JOB_HISTORY_SIZE': '1000',
+    'EXECUTOR_HOT_STANDBY_POWER_BUDGET': '0',
+    'EXECUTOR_ARTIFACT_CACHE_MAX_SIZE': '21474836480',
+    'EXECUTOR_ARTIFACT_PREFETCH_BANDWIDTH': '10485760',
+    'EXECUTOR_CREDENTIALS_POOL_SIZE': '2',
+    'EXECUTOR_GC_RATE_LIMIT': '5',
+    'EXECUTOR_GC_SWEEP_PERIOD': '3600',
+    'EXECUTOR_CONSOLE_REPLAY_BUFFER_SIZE': '4194304',
+    'EXECUTOR_CONSOLE_REATTACH_TIMEOUT': '60',
     'GITLAB_URL': 'https://gitlab.freedesktop.org',
     'GITLAB_CONF_FILE': '/mnt/tmp/gitlab-runner/config.toml',
     'GITLAB_CONF_TEMPLATE_FILE': template('gitlab_runner_config.toml.j2'),
@@ -34,6 +47,8 @@ configurables = {
     'MINIO_ROOT_USER': 'minioadmin',
     'MINIO_ROOT_PASSWORD': 'minio-root-password',
     'MINIO_ADMIN_ALIAS': 'local',
+    'MINIO_OBJECT_POOL_BUCKET': 'objects',
+    'EXECUTOR_MINIO_GROUPS_CACHE_TTL': '300',
     'PRIVATE_INTERFACE': 'private',
     'BOOTS_DEFAULT_KERNEL': 'http://ci-gateway:9000/boot/default_kernel',
     'BOOTS_DEFAULT_INITRD': 'http://ci-gateway:9000/boot/default_boot2container.cpio.xz',
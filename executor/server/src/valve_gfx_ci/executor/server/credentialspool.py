@@ -0,0 +1,91 @@
+from queue import Queue, Empty
+from threading import Thread, Event
+
+import secrets
+import re
+
+from .logger import logger
+from . import config
+
+
+class CredentialsPool(Thread):
+    # How long to wait before retrying to recycle a user that failed to be
+    RETRY_DELAY = 10
+
+    def __init__(self, minio, name, size=None):
+        super().__init__(name=f'CredentialsPool-{name}', daemon=True)
+
+        if size is None:
+            size = int(config.EXECUTOR_CREDENTIALS_POOL_SIZE)
+
+        self.minio = minio
+
+        # NOTE: The users are re-used across restarts of the executor, so their names need to be stable
+        prefix = re.sub(r'[^a-zA-Z0-9\-]', '-', f"pool-{name}")
+        self.user_names = [f"{prefix}-{i}" for i in range(size)]
+
+        # Users ready to be handed out, along with their current secret key
+        self._ready = Queue()
+
+        # Users that need their secret key rotated before being re-used, along with whether their previous job's
+        # accesses already got revoked. Since we have no idea what happened to the users before we started, start by
+        # recycling all of them
+        self._recycle = Queue()
+        for user_name in self.user_names:
+            self._recycle.put((user_name, False))
+
+        self.stop_event = Event()
+
+    def get(self):
+        # NOTE: Never wait for a user, the caller is expected to create one if none are ready
+        try:
+            return self._ready.get_nowait()
+        except Empty:
+            return None
+
+    def revoke(self, user_name):
+        # Drop all the accesses the user was given by its previous job
+        self.minio.unset_user_policy(user_name)
+        for group_name in self.minio.groups_user_is_in(user_name):
+            self.minio.remove_user_from_group(user_name, group_name)
+
+    def release(self, user_name):
+        if user_name not in self.user_names:
+            return False
+
+        # NOTE: The previous job still knows the secret key of the user, so revoke its accesses right away and only
+        # leave the rotation of the key to the background. If that fails, the recycling will try again
+        try:
+            self.revoke(user_name)
+            revoked = True
+        except Exception as e:
+            logger.error(f"Failed to revoke the accesses of the MinIO user {user_name}: {e}")
+            revoked = False
+
+        self._recycle.put((user_name, revoked))
+        return True
+
+    def recycle(self, user_name, revoked=False):
+        # NOTE: Adding an existing user changes its secret key, which locks out whoever used it before. It also
+        # creates the users that do not exist yet, which MinIO would not let us revoke the accesses of
+        password = secrets.token_hex(16)
+        self.minio.add_user(user_name, password)
+
+        if not revoked:
+            self.revoke(user_name)
+
+        self._ready.put((user_name, password))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                user_name, revoked = self._recycle.get(timeout=1)
+            except Empty:
+                continue
+
+            try:
+                self.recycle(user_name, revoked=revoked)
+            except Exception as e:
+                logger.error(f"Failed to recycle the MinIO user {user_name}: {e}")
+                self.stop_event.wait(self.RETRY_DELAY)
+                self._recycle.put((user_name, revoked))
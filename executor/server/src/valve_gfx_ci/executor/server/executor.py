@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
-from threading import Thread, Event
-from collections import defaultdict, namedtuple
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict, namedtuple, deque
+from contextlib import ExitStack
 from urllib.parse import urlsplit, urlparse
 from enum import Enum, IntEnum
 
@@ -10,6 +12,13 @@ from .message import LogLevel, JobIOMessage, ControlMessage, SessionEndMessage,
 from .pdu import PDUState
 from .message import JobStatus
 from .job import Job
+from .jobtracker import JobState
+from .health import JobOutcome, MachineHealth
+from .standby import hot_standby_budget
+from .artifactcache import boot_artifact_cache
+from .credentialspool import CredentialsPool
+from .garbagecollector import garbage_collector
+from .replaybuffer import ReplayBuffer
 from .logger import logger
 from .minioclient import MinioClient, MinIOPolicyStatement, generate_policy
 from . import config
@@ -17,11 +26,9 @@ from .boots import BootConfig
 
 import traceback
 import requests
-import tempfile
 import secrets
 import random
 import select
-import shutil
 import socket
 import json
 import time
@@ -46,6 +53,17 @@ def str_to_int(string, default):
         return default
 
 
+def enable_tcp_keepalive(sock, idle=10, interval=5, count=6):
+    # Detect dead connections within a minute, even when nothing gets sent
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, (idle + interval * count) * 1000)
+
+
 class JobConsoleState(IntEnum):
     CREATED = 0
     ACTIVE = 1
@@ -70,6 +88,15 @@ class JobConsole(Thread):
         self.client_sock = None
         self.salad_sock = self.connect_to_salad()
 
+        # Messages sent to the client are kept for a while, so that clients losing their connection may reattach
+        # to the console and get what they missed. Only the console thread replaces or closes the client sockets
+        self.replay_buffer = ReplayBuffer()
+        self.reattach_timeout = int(config.EXECUTOR_CONSOLE_REATTACH_TIMEOUT)
+        self._client_lock = Lock()
+        self._pending_client = None
+        self._stale_client_socks = []
+        self._detached_at = None
+
         # Job-long state
         self._state = JobConsoleState.CREATED
         self.start_time = None
@@ -101,6 +128,9 @@ class JobConsole(Thread):
         self.last_activity_from_machine = None
         self.last_activity_from_client = None
 
+        # Number of lines of console output which are the DUT echoing back a command we typed
+        self.pending_echo_lines = 0
+
         self.console_patterns.reset_per_boot_state()
         self.needs_reboot = self.console_patterns.needs_reboot
 
@@ -113,11 +143,113 @@ class JobConsole(Thread):
 
     def close_client(self):
         if self.client_version:
+            with self._client_lock:
+                socks = self._stale_client_socks + [self.client_sock]
+                if self._pending_client is not None:
+                    socks.append(self._pending_client[0])
+                self._stale_client_socks = []
+                self._pending_client = None
+
+            for sock in socks:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                    sock.close()
+                except (OSError, AttributeError):
+                    pass
+
+    def _detach_client(self, reason):
+        # Keep the job going while waiting for the client to reattach
+        with self._client_lock:
+            # NOTE: Nobody is going to reattach to a console that is over
+            if self.client_sock is None or self._state == JobConsoleState.OVER:
+                return
+
             try:
                 self.client_sock.shutdown(socket.SHUT_RDWR)
-                self.client_sock.close()
             except OSError:
                 pass
+            self._stale_client_socks.append(self.client_sock)
+            self.client_sock = None
+            self._detached_at = time.monotonic()
+
+        self.log(f"{reason}, waiting up to {self.reattach_timeout} s for it to reattach\n")
+
+    def _send_to_client(self, msg):
+        if self.client_version == 0:
+            self.client_sock.send(msg)
+            return
+
+        with self._client_lock:
+            frame = self.replay_buffer.push(msg)
+            if self.client_sock is None:
+                return
+
+            try:
+                self.client_sock.sendall(frame)
+                return
+            except OSError:
+                pass
+
+        # NOTE: The message is in the replay buffer, it will get sent again when the client reattaches
+        self._detach_client("Failed to send a message to the client")
+
+    def reattach(self, client_endpoint, last_seq=None):
+        if self.client_version != 1:
+            raise ValueError("Only clients using the version 1 of the protocol can reattach")
+        elif self.state >= JobConsoleState.OVER:
+            raise ValueError("The console of the job is already over")
+
+        try:
+            sock = socket.create_connection(client_endpoint, timeout=10)
+        except OSError as e:
+            raise ValueError(f"Failed to connect to the client endpoint {client_endpoint}: {e}") from None
+        sock.settimeout(None)
+        enable_tcp_keepalive(sock)
+
+        # NOTE: The console thread does the swap, as it may be waiting on the previous socket
+        with self._client_lock:
+            if self._pending_client is not None:
+                self._stale_client_socks.append(self._pending_client[0])
+            self._pending_client = (sock, last_seq)
+
+    def _process_client_changes(self):
+        with self._client_lock:
+            for sock in self._stale_client_socks:
+                sock.close()
+            self._stale_client_socks = []
+
+            if self._pending_client is None:
+                return
+            sock, last_seq = self._pending_client
+            self._pending_client = None
+
+            if self.client_sock is not None:
+                try:
+                    self.client_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.client_sock.close()
+            self.client_sock = sock
+            self._detached_at = None
+
+            # Send the client what it missed, before any other message
+            frames, lost = self.replay_buffer.frames_after(last_seq)
+            try:
+                if lost > 0:
+                    ControlMessage.create(f"WARNING: {lost} messages got lost while the client was disconnected\n",
+                                          severity=LogLevel.WARN).send(sock)
+                for frame in frames:
+                    sock.sendall(frame)
+
+                if self.state >= JobConsoleState.TEAR_DOWN:
+                    sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                self._stale_client_socks.append(sock)
+                self.client_sock = None
+                self._detached_at = time.monotonic()
+                return
+
+        self.log(f"The client reattached to the console, and got {len(frames)} messages replayed\n")
 
     def close(self):
         self.set_state(JobConsoleState.OVER)
@@ -157,15 +289,12 @@ class JobConsole(Thread):
                 if self.client_version == 0:
                     self.log(f"<-- End of the session: {self.console_patterns.job_status} -->\n")
                 elif self.client_version == 1:
-                    try:
-                        status = JobStatus.from_str(self.console_patterns.job_status)
-                        SessionEndMessage.create(job_bucket=kwargs.get('job_bucket'),
-                                                 status=status).send(self.client_sock)
-                    except (ConnectionResetError, BrokenPipeError, OSError):
-                        traceback.print_exc()
+                    status = JobStatus.from_str(self.console_patterns.job_status)
+                    self._send_to_client(SessionEndMessage.create(job_bucket=kwargs.get('job_bucket'),
+                                                                  status=status))
                 try:
                     self.client_sock.shutdown(socket.SHUT_WR)
-                except (ConnectionResetError, BrokenPipeError, OSError):
+                except (ConnectionResetError, BrokenPipeError, OSError, AttributeError):
                     pass
 
         elif state == JobConsoleState.OVER:
@@ -177,10 +306,13 @@ class JobConsole(Thread):
         if self.client_version:
             logger.info(f"Connecting to the client endpoint {self.client_endpoint}")
             self.client_sock = socket.create_connection(self.client_endpoint)
+            enable_tcp_keepalive(self.client_sock)
         super().start()
 
     def match_console_patterns(self, buf):
+        # Returns whether the buffer completed a line which is not the echo of a command we typed
         patterns_matched = set()
+        has_new_lines = False
 
         # Process the buffer, line by line
         to_process = self.line_buffer + buf
@@ -191,6 +323,10 @@ class JobConsole(Thread):
                 line = to_process[cur:idx+1]
                 logger.info(f"{self.machine_id} -> {bytes(line)}")
                 patterns_matched |= self.console_patterns.process_line(line)
+                if self.pending_echo_lines > 0:
+                    self.pending_echo_lines -= 1
+                else:
+                    has_new_lines = True
                 cur = idx + 1
             else:
                 break
@@ -203,6 +339,8 @@ class JobConsole(Thread):
         # Check if the state changed
         self.needs_reboot = self.console_patterns.needs_reboot
 
+        return has_new_lines
+
     def log(self, msg, log_level=LogLevel.INFO):
         # Ignore messages with a log level lower than the minimum set
         if log_level < self.log_level:
@@ -219,9 +357,9 @@ class JobConsole(Thread):
         if self.client_version:
             try:
                 if self.client_version == 0:
-                    self.client_sock.send(log_msg.encode())
+                    self._send_to_client(log_msg.encode())
                 elif self.client_version == 1:
-                    ControlMessage.create(log_msg, severity=log_level).send(self.client_sock)
+                    self._send_to_client(ControlMessage.create(log_msg, severity=log_level))
             except OSError:
                 pass
 
@@ -229,15 +367,31 @@ class JobConsole(Thread):
         self.set_state(JobConsoleState.OVER)
         self.join()
 
+    def send_to_dut(self, buf):
+        self.salad_sock.send(buf)
+
+    def type_command(self, cmd):
+        # NOTE: The DUT echoes back what we type, which should not be mistaken for it being active
+        self.pending_echo_lines = cmd.count("\n") + 1
+        self.send_to_dut(f"{cmd}\n".encode())
+
     def run(self):
         self.set_state(JobConsoleState.ACTIVE)
 
         while self.state < JobConsoleState.OVER:
+            self._process_client_changes()
+            client_sock = self.client_sock
+
             fds = []
             if self.state < JobConsoleState.TEAR_DOWN:
                 fds.extend([self.salad_sock.fileno()])
-            if self.client_version:
-                fds.extend([self.client_sock.fileno()])
+            if self.client_version and client_sock is not None:
+                fds.extend([client_sock.fileno()])
+            elif self.client_version and self._detached_at is not None and \
+                    time.monotonic() - self._detached_at > self.reattach_timeout:
+                self.log("The client did not reattach in time, closing the console\n")
+                self.close()
+                continue
 
             # Make sure all the FDs are valid, or exit!
             if any([fd < 0 for fd in fds]):
@@ -256,31 +410,32 @@ class JobConsole(Thread):
 
                         # Match the console patterns
                         try:
-                            self.match_console_patterns(buf)
+                            has_new_lines = self.match_console_patterns(buf)
                         except Exception:
                             self.log(traceback.format_exc())
+                            has_new_lines = b'\n' in buf
 
                         # Update the last console activity if we already had activity,
-                        # or when we get the first newline character as serial
-                        # consoles may sometimes send unwanted characters at power up
-                        if self.last_activity_from_machine is not None or b'\n' in buf:
+                        # or when we get the first new line as serial consoles may
+                        # sometimes send unwanted characters at power up
+                        if self.last_activity_from_machine is not None or has_new_lines:
                             self.last_activity_from_machine = datetime.now()
 
                         # Forward to the client
                         if self.client_version:
                             if self.client_version == 0:
-                                self.client_sock.send(buf)
+                                self._send_to_client(buf)
                             elif self.client_version == 1:
-                                JobIOMessage.create(buf).send(self.client_sock)
+                                self._send_to_client(JobIOMessage.create(buf))
 
                         # The message got forwarded, close the session if it ended
                         if self.console_patterns.session_has_ended:
                             self.set_state(JobConsoleState.DUT_DONE)
 
-                    elif self.client_sock and fd == self.client_sock.fileno():
+                    elif client_sock and fd == client_sock.fileno():
                         # DUT's stdin: Client -> Salad
                         if self.client_version == 0:
-                            buf = self.client_sock.recv(8192)
+                            buf = client_sock.recv(8192)
                             if len(buf) == 0:
                                 self.close()
 
@@ -288,10 +443,18 @@ class JobConsole(Thread):
                             self.salad_sock.send(buf)
                         elif self.client_version == 1:
                             try:
-                                msg = Message.next_message(self.client_sock)
-                                if msg.msg_type == MessageType.JOB_IO:
-                                    self.salad_sock.send(msg.buffer)
+                                msg = Message.next_message(client_sock)
                             except EOFError:
+                                # NOTE: The socket may have been shut down by another thread, to detach the client
+                                with self._client_lock:
+                                    detached = client_sock is not self.client_sock
+                                    if not detached:
+                                        # The client closed its socket on purpose, do not wait for it to reattach
+                                        self._stale_client_socks.append(client_sock)
+                                        self.client_sock = None
+                                if detached:
+                                    continue
+
                                 # Do not warn when we are expecting the client to close its socket
                                 if self.state < JobConsoleState.TEAR_DOWN:
                                     self.log(traceback.format_exc())
@@ -300,6 +463,14 @@ class JobConsole(Thread):
 
                                 # Clean up everything on our side
                                 self.close()
+                                msg = None
+                            except OSError as e:
+                                # NOTE: Unlike closing its socket, losing the connection is not the client's choice
+                                self._detach_client(f"Lost the connection to the client: {e}")
+                                continue
+
+                            if msg is not None and msg.msg_type == MessageType.JOB_IO:
+                                self.salad_sock.send(msg.buffer)
 
                         self.last_activity_from_client = datetime.now()
                 except (ConnectionResetError, BrokenPipeError, OSError):
@@ -396,30 +567,70 @@ class SergentHartman:
         return config.EXECUTOR_REGISTRATION_JOB or config.EXECUTOR_BOOTLOOP_JOB
 
 
+class CacheAffinityHints:
+    def __init__(self, history=None):
+        if history is None:
+            history = int(config.EXECUTOR_CACHE_AFFINITY_HISTORY)
+
+        self._jobs = deque(maxlen=history)
+
+    def add(self, keys):
+        self._jobs.append(frozenset(keys))
+
+    def clear(self):
+        self._jobs.clear()
+
+    def score(self, keys):
+        hints = set()
+        for job_keys in list(self._jobs):
+            hints |= job_keys
+        return len(hints & set(keys))
+
+
 class JobBucket:
     Credentials = namedtuple('Credentials', ['username', 'password', 'policy_name'])
 
-    def __init__(self, minio, bucket_name, initial_state_tarball_file=None):
+    def __init__(self, minio, bucket_name, initial_state_tarball_file=None, initial_state_manifest=None,
+                 credentials_pool=None, garbage_collector=garbage_collector):
         self.minio = minio
         self.name = bucket_name
+        self.credentials_pool = credentials_pool
+        self.garbage_collector = garbage_collector
 
         self._credentials = dict()
+        self._created = False
 
-        if initial_state_tarball_file:
-            self.initial_state_tarball_file = tempfile.NamedTemporaryFile("w+b")
-            shutil.copyfileobj(initial_state_tarball_file, self.initial_state_tarball_file)
-            self.initial_state_tarball_file.seek(0)
-        else:
-            self.initial_state_tarball_file = None
+        # NOTE: The tarball gets streamed from the HTTP request that sent it, which stays open until we close it
+        self.initial_state_tarball_file = initial_state_tarball_file
 
-        self.minio.make_bucket(bucket_name)
+        # Files of the initial state that need to be copied from the object pool, rather than from the tarball
+        self.initial_state_manifest = initial_state_manifest or []
+
+        # NOTE: Register the bucket before creating it, so that it can't be mistaken for an orphaned one
+        self.garbage_collector.register_bucket(bucket_name)
+        try:
+            self.minio.make_bucket(bucket_name)
+        except Exception:
+            self.garbage_collector.unregister_bucket(bucket_name)
+            raise
+        self._created = True
 
     def remove(self):
-        self.minio.remove_bucket(self.name)
+        # NOTE: Buckets that failed to be created hand their tarball over to the next attempt
+        if not self._created:
+            return
+
+        if self.initial_state_tarball_file:
+            self.initial_state_tarball_file.close()
+
+        # NOTE: The actual removal happens in the background, so that it does not block the executor
+        self.garbage_collector.remove_bucket(self.name)
+        self._created = False
 
         for credentials in self._credentials.values():
-            self.minio.remove_user_policy(credentials.policy_name, credentials.username)
-            self.minio.remove_user(credentials.username)
+            if not self._release_user(credentials.username):
+                self.garbage_collector.remove_policy(credentials.policy_name)
+        self._credentials.clear()
 
     def __del__(self):
         try:
@@ -430,8 +641,23 @@ class JobBucket:
     def credentials(self, role):
         return self._credentials.get(role)
 
+    def _release_user(self, user_name):
+        # Pooled users lose their accesses and get recycled, the others get removed. Returns whether the user was pooled
+        if self.credentials_pool is not None and self.credentials_pool.release(user_name):
+            return True
+
+        self.garbage_collector.remove_user(user_name)
+        return False
+
     def create_owner_credentials(self, role, user_name=None, password=None,
                                  groups=None, whitelisted_ips=None):
+        # Prefer users from the pool, which already exist
+        pooled_user = None
+        if user_name is None and password is None and self.credentials_pool is not None:
+            pooled_user = self.credentials_pool.get()
+        if pooled_user is not None:
+            user_name, password = pooled_user
+
         if user_name is None:
             user_name = f"{self.name}-{role}"
 
@@ -446,7 +672,8 @@ class JobBucket:
 
         policy_name = f"policy_{user_name}"
 
-        self.minio.add_user(user_name, password)
+        if pooled_user is None:
+            self.minio.add_user(user_name, password)
 
         policy_statements = [
             MinIOPolicyStatement(buckets=[self.name], source_ips=whitelisted_ips)
@@ -460,7 +687,7 @@ class JobBucket:
         try:
             self.minio.apply_user_policy(policy_name, user_name, policy_statements)
         except Exception as e:
-            self.minio.remove_user(user_name)
+            self._release_user(user_name)
             raise e from None
 
         # Add the user to the wanted list of groups
@@ -473,8 +700,15 @@ class JobBucket:
         return credentials
 
     def setup(self):
-        if self.initial_state_tarball_file:
-            self.minio.extract_archive(self.initial_state_tarball_file, self.name)
+        try:
+            if len(self.initial_state_manifest) > 0:
+                self.minio.seed_from_object_pool(self.name, self.initial_state_manifest)
+
+            if self.initial_state_tarball_file:
+                self.minio.extract_archive(self.initial_state_tarball_file, self.name)
+        finally:
+            if self.initial_state_tarball_file:
+                self.initial_state_tarball_file.close()
 
     def access_url(self, role=None):
         endpoint = urlparse(self.minio.url)
@@ -487,20 +721,61 @@ class JobBucket:
         return f'{endpoint.scheme}://{credentials}{endpoint.netloc}'
 
     @classmethod
-    def from_job_request(cls, minio, request, machine):
+    def from_job_request(cls, minio, request, machine, credentials_pool=None):
         # Generate a job id
         bucket_name = MinioClient.create_valid_bucket_name(f"job-{machine.id}-{request.job_id}")
 
         try:
             # BUG: It seems like this is not a reliable way to detect re-use of existing buckets...
             return cls(minio, bucket_name=bucket_name,
-                       initial_state_tarball_file=request.job_bucket_initial_state_tarball_file)
+                       initial_state_tarball_file=request.job_bucket_initial_state_tarball_file,
+                       initial_state_manifest=request.job_bucket_initial_state_manifest,
+                       credentials_pool=credentials_pool)
         except ValueError:
             # The bucket already exists, let's try to make it more unique!
             now = int(datetime.utcnow().timestamp())
             rand_int = random.randrange(10e6)
             return cls(minio, bucket_name=f"{bucket_name}-{now}-{rand_int}",
-                       initial_state_tarball_file=request.job_bucket_initial_state_tarball_file)
+                       initial_state_tarball_file=request.job_bucket_initial_state_tarball_file,
+                       initial_state_manifest=request.job_bucket_initial_state_manifest,
+                       credentials_pool=credentials_pool)
+
+
+class JobTeardown(Thread):
+    def __init__(self, machine_id, job_console, job_bucket, job_record, status, timeout, stop_event, cancel_job):
+        super().__init__(name=f'TeardownThread-{machine_id}')
+
+        self.job_console = job_console
+        self.job_bucket = job_bucket
+        self.job_record = job_record
+        self.status = status
+        self.timeout = timeout
+        self.stop_event = stop_event
+        self.cancel_job = cancel_job
+
+    def run(self):
+        try:
+            # Wait for the client to close the connection, the job to be cancelled, or the teardown timeout to expire
+            while (self.job_console.state < JobConsoleState.OVER and
+                   not self.stop_event.is_set() and
+                   not self.cancel_job.is_set() and
+                   not self.timeout.has_expired):
+                # Wait a little bit before checking again
+                time.sleep(0.1)
+
+            if self.cancel_job.is_set():
+                self.job_console.log("The job got cancelled during its tear down\n", LogLevel.WARN)
+
+            self.job_console.log(f"Completed the tear down procedure in {self.timeout.active_for} s\n")
+            self.timeout.stop()
+        finally:
+            self.job_console.close()
+
+            if self.job_record is not None:
+                self.job_record.finish(self.status)
+
+            # Drop our reference to the bucket, which removes it
+            self.job_bucket = None
 
 
 class Executor(Thread):
@@ -512,17 +787,36 @@ class Executor(Thread):
         self.state = MachineState.WAIT_FOR_CONFIG
         self.minio = MinioClient()
 
+        # MinIO users ready to be handed out to jobs, so that creating them isn't part of the setup of jobs
+        self.credentials_pool = CredentialsPool(self.minio, machine.id)
+        self.credentials_pool.start()
+
         # Training / Qualifying process
         self.sergent_hartman = SergentHartman(machine)
 
+        # Health of the machine, based on the outcome of production jobs
+        self.health = MachineHealth()
+
+        # Artifacts and containers that are likely cached on the machine
+        self.cache_affinity_hints = CacheAffinityHints()
+
+        # Is the machine kept powered and polling for a job while idle?
+        self.hot_standby = False
+
         # Outside -> Inside communication
+        self._reservation_lock = Lock()
         self.job_ready = Event()
+        self.job_request = None
+        self.job_record = None
         self.job_config = None
         self.job_console = None
         self.job_bucket = None
         self.boot_config = None
         self.cancel_job = Event()
 
+        # Tear down of the last job, which may still be running while the machine executes the next one
+        self.job_teardown = None
+
         # Remote artifacts (typically over HTTPS) are stored in our
         # local minio instance which is exposed over HTTP to the
         # private LAN. This makes such artifacts amenable to PXE
@@ -539,72 +833,270 @@ class Executor(Thread):
         self.log(f"The machine queried the boot configuration as a {platform} / {buildarch} platform\n")
         return self.boot_config
 
-    def start_job(self, job_request):
-        if self.state != MachineState.IDLE:
-            raise ValueError(f"The machine isn't idle: Current state is {self.state.name}")
-
-        # Prepare the job bucket
-        self.job_bucket = JobBucket.from_job_request(self.minio, job_request, self.machine)
-        if self.job_bucket:
-            self.job_bucket.create_owner_credentials("dut", groups=job_request.minio_groups,
-                                                     whitelisted_ips=[f'{self.machine.ip_address}/32'])
-
-        # Bit nasty to render twice, but better than duplicating
-        # template render in the various call-sites within
-        # executor. Rendering it up front reduces the chances for
-        # mistakes. (Meta-point: using an HTTP query to specify the
-        # "target" could avoid this duplication of work, and might
-        # actually make more sense)
-        job = Job.render_with_resources(job_request.raw_job, self.machine, self.job_bucket)
-        logger.debug("rendered job:\n%s", job)
-
+    def _reserve(self, job_request, job_record):
+        # NOTE: Needs to be called with the reservation lock held
         self.state = MachineState.QUEUED
         self.job_request = job_request
-        self.job_config = job
-        self.job_console = JobConsole(self.machine.id,
-                                      client_endpoint=job_request.callback_endpoint,
-                                      console_patterns=self.job_config.console_patterns,
-                                      client_version=job_request.version)
+        self.job_record = job_record
+
+        # NOTE: Use the keys of the job as submitted, to match the ones used for placement
+        self.cache_affinity_hints.add(job_request.job.cache_affinity_keys)
+
         self.job_ready.set()
 
+    def start_job(self, job_request, job_record):
+        # Only reserve the machine here, the setup of the job is done by the executor's thread
+        with self._reservation_lock:
+            if self.state != MachineState.IDLE:
+                raise ValueError(f"The machine isn't idle: Current state is {self.state.name}")
+
+            self._reserve(job_request, job_record)
+
+    @classmethod
+    def start_jobs(cls, reservations):
+        # Reserve the machines of all the (executor, job_request, job_record) tuples, or none of them
+        executors = [executor for executor, _, _ in reservations]
+        if len(set(executors)) != len(executors):
+            raise ValueError("A machine cannot be reserved for more than one job")
+
+        # NOTE: Always take the locks in the same order, so that concurrent batches cannot deadlock
+        with ExitStack() as stack:
+            for executor in sorted(executors, key=lambda e: e.machine.id):
+                stack.enter_context(executor._reservation_lock)
+
+            for executor in executors:
+                if executor.state != MachineState.IDLE:
+                    raise ValueError(f"The machine {executor.machine.id} isn't idle: "
+                                     f"Current state is {executor.state.name}")
+
+            for executor, job_request, job_record in reservations:
+                executor._reserve(job_request, job_record)
+
+    def _setup_job(self):
+        job_request = self.job_request
+        self.job_record.set_state(JobState.SETUP)
+
+        try:
+            # Prepare the job bucket
+            self.job_bucket = JobBucket.from_job_request(self.minio, job_request, self.machine,
+                                                         credentials_pool=self.credentials_pool)
+            if self.job_bucket:
+                self.job_bucket.create_owner_credentials("dut", groups=job_request.minio_groups,
+                                                         whitelisted_ips=[f'{self.machine.ip_address}/32'])
+
+            # Bit nasty to render twice, but better than duplicating
+            # template render in the various call-sites within
+            # executor. Rendering it up front reduces the chances for
+            # mistakes. (Meta-point: using an HTTP query to specify the
+            # "target" could avoid this duplication of work, and might
+            # actually make more sense)
+            job = Job.render_with_resources(job_request.raw_job, self.machine, self.job_bucket)
+            logger.debug("rendered job:\n%s", job)
+
+            self.job_config = job
+            self.job_console = JobConsole(self.machine.id,
+                                          client_endpoint=job_request.callback_endpoint,
+                                          console_patterns=self.job_config.console_patterns,
+                                          client_version=job_request.version)
+            self.job_record.console = self.job_console
+        except Exception as e:
+            self.job_record.finish(JobStatus.SETUP_FAIL, error_msg=str(e))
+            raise e from None
+
+        self.job_record.set_state(JobState.RUNNING)
+
+    def _enter_hot_standby(self):
+        # Retired machines are neither kept powered nor counted in the budget
+        if self.machine.is_retired:
+            if self.hot_standby:
+                logger.info(f"The machine {self.machine.id} got retired, leaving hot standby")
+                self._leave_hot_standby()
+                self.machine.pdu_port.set(PDUState.OFF)
+            return
+
+        if self.hot_standby:
+            return
+
+        # NOTE: Powering up the machine would wait for its minimum off time, delaying the moment it becomes idle.
+        # We get called again at every poll for a job, so just try again later
+        pdu_port = self.machine.pdu_port
+        if (datetime.now() - pdu_port.last_shutdown).total_seconds() < pdu_port.min_off_time:
+            return
+
+        if not hot_standby_budget.acquire(self.machine.id, self.machine.hot_standby_power):
+            return
+
+        # With no boot configuration set, the machine will keep polling for one
+        logger.info(f"Keeping the machine {self.machine.id} in hot standby")
+        self.boot_config = None
+        try:
+            pdu_port.set(PDUState.ON)
+        except Exception:
+            hot_standby_budget.release(self.machine.id)
+            logger.error(f"Failed to power up the machine {self.machine.id} for hot standby:\n"
+                         f"{traceback.format_exc()}")
+            return
+        self.hot_standby = True
+
+    def _leave_hot_standby(self):
+        if not self.hot_standby:
+            return
+
+        self.hot_standby = False
+        hot_standby_budget.release(self.machine.id)
+
     def log(self, msg, log_level=LogLevel.INFO):
         if self.job_console is not None:
             self.job_console.log(msg, log_level=log_level)
 
-    def _cache_remote_artifact(self, artifact_name, start_url, continue_url):
-        artifact_prefix = f"{artifact_name}-{self.machine.id}"
+    def _cache_remote_artifact(self, url, sha256=None, recompress=None):
+        self.log(f'Caching {url} into minio...\n')
+        local_url = boot_artifact_cache.acquire(url, sha256=sha256)
 
-        # Assume the remote artifacts already exist locally
-        self.remote_url_to_local_cache_mapping[start_url] = start_url
-        self.remote_url_to_local_cache_mapping[continue_url] = continue_url
-
-        def cache_it(url, suffix):
-            if self.minio.is_local_url(url):
-                logger.debug(f"Ignore caching {url} as it is already hosted by our minio cache")
-                return
-            self.remote_url_to_local_cache_mapping[url] = f"{config.MINIO_URL}/boot/{artifact_prefix}-{suffix}"
-            self.log(f'Caching {url} into minio...\n')
-            self.minio.save_boot_artifact(start_url, f"{artifact_prefix}-start")
+        if recompress is not None:
+            try:
+                local_url = boot_artifact_cache.acquire_variant(local_url, recompress)
+            except Exception:
+                self.log(f"Failed to recompress {url} using {recompress}, using the original:\n"
+                         f"{traceback.format_exc()}", LogLevel.WARN)
 
-        cache_it(start_url, 'start')
-        if start_url != continue_url:
-            cache_it(continue_url, 'continue')
+        self.remote_url_to_local_cache_mapping[url] = local_url
 
     def _cache_remote_artifacts(self):
-        deploy_strt = self.job_config.deployment_start
-        deploy_cnt = self.job_config.deployment_start
+        # Deduplicate the artifacts shared by the start and continue deployments
+        artifacts = dict()
+        for deployment in [self.job_config.deployment_start, self.job_config.deployment_continue]:
+            artifacts.setdefault(deployment.kernel_url, (deployment.kernel_sha256, None))
+            artifacts.setdefault(deployment.initramfs_url, (deployment.initramfs_sha256,
+                                                            deployment.initramfs_recompress))
+
+        # Cache the kernel and initramfs, and initialize the job bucket
+        # concurrently. The machine is enforcing its minimum off time
+        # in the meantime.
+        with ThreadPoolExecutor(max_workers=len(artifacts) + 1,
+                                thread_name_prefix=f"SetupThread-{self.machine.id}") as pool:
+            logger.info("Caching the kernels and initramfs...")
+            tasks = [pool.submit(self._cache_remote_artifact, url, sha256, recompress)
+                     for url, (sha256, recompress) in artifacts.items() if url is not None]
+
+            if self.job_bucket:
+                logger.info("Initializing the job bucket with the client's data")
+                tasks.append(pool.submit(self.job_bucket.setup))
+
+            # Re-raise the first exception, if any
+            for task in as_completed(tasks):
+                task.result()
+
+    def _release_remote_artifacts(self):
+        # Allow the boot artifacts of the job to be evicted from the cache
+        for local_url in self.remote_url_to_local_cache_mapping.values():
+            boot_artifact_cache.release(local_url)
+        self.remote_url_to_local_cache_mapping = {}
+
+    def _boot_loop(self, timeouts):
+        # Keep on resuming until success, timeouts' retry limits is hit, or the entire executor is going down
+        deployment = self.job_config.deployment_start
+        warm_reboot = False
+        while (not self.stop_event.is_set() and
+               not self.cancel_job.is_set() and
+               not timeouts.overall.has_expired and
+               self.job_console.state < JobConsoleState.DUT_DONE):
+            self.job_console.reset_per_boot_state()
+
+            # Make sure the machine shuts down, unless it is already polling for its boot
+            # configuration or is about to reboot by itself
+            if not self.hot_standby and not warm_reboot:
+                self.machine.pdu_port.set(PDUState.OFF)
 
-        logger.info("Caching the kernel...")
-        self._cache_remote_artifact("kernel", deploy_strt.kernel_url,
-                                    deploy_cnt.kernel_url)
+            # Set up the deployment
+            self.log("Setting up the boot configuration\n")
+            cache_mapping = self.remote_url_to_local_cache_mapping
+            self.boot_config = BootConfig(kernel=cache_mapping.get(deployment.kernel_url),
+                                          initrd=cache_mapping.get(deployment.initramfs_url),
+                                          cmdline=deployment.kernel_cmdline)
+
+            if warm_reboot:
+                # The DUT is still running, ask it to boot the deployment by itself. If it fails
+                # to do so, the first_console_activity timeout will get us back to a power cycle.
+                self.log("Asking the DUT to reboot into the next deployment, without a power cycle\n")
+                cmd = deployment.warm_reboot_command(kernel_url=self.boot_config.kernel,
+                                                     initramfs_url=self.boot_config.initrd)
+                self.job_console.type_command(cmd)
+            elif self.hot_standby:
+                # The machine will pick up the boot configuration at its next poll. Any
+                # further boot will go through a full power cycle.
+                self.log("The machine is in hot standby, booting without a power cycle\n")
+                self._leave_hot_standby()
+            else:
+                self.log(f"Power up the machine, enforcing {self.machine.pdu_port.min_off_time} "
+                         "seconds of down time\n")
+                self.machine.pdu_port.set(PDUState.ON)
 
-        logger.info("Caching the initramfs...")
-        self._cache_remote_artifact("initramfs", deploy_strt.initramfs_url,
-                                    deploy_cnt.initramfs_url)
+            # Start the boot, and enable the timeouts!
+            self.log("Boot the machine\n")
+            timeouts.boot_cycle.start()
+            timeouts.first_console_activity.start()
+            timeouts.console_activity.stop()
 
-        if self.job_bucket:
-            logger.info("Initializing the job bucket with the client's data")
-            self.job_bucket.setup()
+            # Reset all the watchdogs, since they are not supposed to remain active between rounds
+            for wd in timeouts.watchdogs.values():
+                wd.stop()
+
+            while (self.job_console.state < JobConsoleState.DUT_DONE and
+                   not self.job_console.needs_reboot and
+                   not self.stop_event.is_set() and
+                   not self.cancel_job.is_set() and
+                   not timeouts.has_expired):
+                # Update the activity timeouts, based on when was the
+                # last time we sent it data
+                if self.job_console.last_activity_from_machine is not None:
+                    timeouts.first_console_activity.stop()
+                    timeouts.console_activity.reset(when=self.job_console.last_activity_from_machine)
+
+                # Wait a little bit before checking again
+                time.sleep(0.1)
+
+            # Increase the retry count of the timeouts that expired, and
+            # abort the job if we exceeded their limits.
+            abort = False
+            expired_timeouts = timeouts.expired_list
+            for timeout in expired_timeouts:
+                retry = timeout.retry()
+                decision = "Try again!" if retry else "Abort!"
+                self.log(f"Hit the timeout {timeout} --> {decision}\n", LogLevel.ERROR)
+                abort = abort or not retry
+
+            # Check if the DUT asked us to reboot
+            if self.job_console.needs_reboot:
+                retry = timeouts.boot_cycle.retry()
+                retries_str = f"{timeouts.boot_cycle.retried}/{timeouts.boot_cycle.retries}"
+                dec = f"Boot cycle {retries_str}, go ahead!" if retry else "Exceeded boot loop count, aborting!"
+                self.log(f"The DUT asked us to reboot: {dec}\n", LogLevel.WARN)
+                abort = abort or not retry
+
+            if abort:
+                # We have reached a timeout retry limit, time to stop!
+                self.job_console.set_state(JobConsoleState.DUT_DONE)
+            else:
+                # Stop all the timeouts, except the overall
+                timeouts.first_console_activity.stop()
+                timeouts.console_activity.stop()
+                timeouts.boot_cycle.stop()
+
+                # We went through one boot cycle, use the "continue" deployment
+                deployment = self.job_config.deployment_continue
+
+            # Let the DUT reboot by itself when it asked for it, if the job allows it
+            warm_reboot = (not abort and
+                           self.job_console.needs_reboot and
+                           len(expired_timeouts) == 0 and
+                           deployment.warm_reboot is not None)
+            if not warm_reboot:
+                # Cut the power
+                self.machine.pdu_port.set(PDUState.OFF)
+
+        # Make sure the machine does not keep on running if we stopped before its warm reboot
+        self.machine.pdu_port.set(PDUState.OFF)
 
     def run(self):
         def session_init():
@@ -616,6 +1108,10 @@ class Executor(Thread):
             # Pick a job
             if self.sergent_hartman.is_available and not self.machine.ready_for_service:
                 self.state = MachineState.TRAINING
+                self._leave_hot_standby()
+
+                # The training jobs may reset the machine's caches
+                self.cache_affinity_hints.clear()
 
                 self.job_config = self.sergent_hartman.next_task()
                 self.job_console = JobConsole(self.machine.id,
@@ -625,17 +1121,34 @@ class Executor(Thread):
             else:
                 self.sergent_hartman.reset()
 
-                # Wait for a job to be set
-                self.state = MachineState.IDLE
+                # Keep the machine warm while waiting, if the power budget allows it
+                self._enter_hot_standby()
+
+                # Wait for a job to be set, without overriding a reservation
+                with self._reservation_lock:
+                    if not self.job_ready.is_set():
+                        self.state = MachineState.IDLE
                 if not self.job_ready.wait(1):
                     return False
                 self.job_ready.clear()
-                self.cancel_job.clear()
+
+                # NOTE: The tear down of the previous job may still be running, and keeps its own cancellation event
+                self.cancel_job = Event()
 
                 self.state = MachineState.RUNNING
 
-            # Cut the power to the machine, we do not need it
-            self.machine.pdu_port.set(PDUState.OFF)
+                # Cut the power first, so that the machine's minimum off time
+                # elapses while we are setting up the job
+                if not self.hot_standby:
+                    self.machine.pdu_port.set(PDUState.OFF)
+
+                # Create the job bucket, render the job, ...
+                self._setup_job()
+
+            # Cut the power to the machine, we do not need it... unless it is
+            # already waiting for its boot configuration
+            if not self.hot_standby:
+                self.machine.pdu_port.set(PDUState.OFF)
 
             # Mark the start time to now()
             self.job_start_time = datetime.now()
@@ -652,16 +1165,32 @@ class Executor(Thread):
                 status = JobStatus.from_str(self.job_config.console_patterns.job_status)
                 cooldown_delay_s = int(self.sergent_hartman.report(status))
 
+            if self.job_record is not None:
+                if self.job_config is not None:
+                    status = JobStatus.from_str(self.job_config.console_patterns.job_status)
+                else:
+                    status = JobStatus.SETUP_FAIL
+                self.job_record.finish(status)
+                self.job_record = None
+
+            # Let the request that sent the job complete, if the job bucket did not get to read its tarball
+            if self.job_request is not None and self.job_request.job_bucket_initial_state_tarball_file:
+                self.job_request.job_bucket_initial_state_tarball_file.close()
+
+            self.job_request = None
             self.job_config = None
+            self._release_remote_artifacts()
 
             # Signal to the job that we reached the end of the execution
             if self.job_console is not None:
                 self.job_console.close()
                 self.job_console = None
                 self.boot_config = None
-                if self.job_bucket:
-                    del self.job_bucket
-                    self.job_bucket = None
+
+            # NOTE: The job bucket may exist without a console if the setup failed
+            if self.job_bucket:
+                del self.job_bucket
+                self.job_bucket = None
 
             # Interruptible sleep
             for i in range(cooldown_delay_s):
@@ -688,82 +1217,7 @@ class Executor(Thread):
             self.log(f"Completed setup of the infrastructure, after {timeouts.infra_setup.active_for} s\n")
             timeouts.infra_setup.stop()
 
-            # Keep on resuming until success, timeouts' retry limits is hit, or the entire executor is going down
-            deployment = self.job_config.deployment_start
-            while (not self.stop_event.is_set() and
-                   not self.cancel_job.is_set() and
-                   not timeouts.overall.has_expired and
-                   self.job_console.state < JobConsoleState.DUT_DONE):
-                self.job_console.reset_per_boot_state()
-
-                # Make sure the machine shuts down
-                self.machine.pdu_port.set(PDUState.OFF)
-
-                # Set up the deployment
-                self.log("Setting up the boot configuration\n")
-                cache_mapping = self.remote_url_to_local_cache_mapping
-                self.boot_config = BootConfig(kernel=cache_mapping.get(deployment.kernel_url),
-                                              initrd=cache_mapping.get(deployment.initramfs_url),
-                                              cmdline=deployment.kernel_cmdline)
-
-                self.log(f"Power up the machine, enforcing {self.machine.pdu_port.min_off_time} seconds of down time\n")
-                self.machine.pdu_port.set(PDUState.ON)
-
-                # Start the boot, and enable the timeouts!
-                self.log("Boot the machine\n")
-                timeouts.boot_cycle.start()
-                timeouts.first_console_activity.start()
-                timeouts.console_activity.stop()
-
-                # Reset all the watchdogs, since they are not supposed to remain active between rounds
-                for wd in timeouts.watchdogs.values():
-                    wd.stop()
-
-                while (self.job_console.state < JobConsoleState.DUT_DONE and
-                       not self.job_console.needs_reboot and
-                       not self.stop_event.is_set() and
-                       not self.cancel_job.is_set() and
-                       not timeouts.has_expired):
-                    # Update the activity timeouts, based on when was the
-                    # last time we sent it data
-                    if self.job_console.last_activity_from_machine is not None:
-                        timeouts.first_console_activity.stop()
-                        timeouts.console_activity.reset(when=self.job_console.last_activity_from_machine)
-
-                    # Wait a little bit before checking again
-                    time.sleep(0.1)
-
-                # Cut the power
-                self.machine.pdu_port.set(PDUState.OFF)
-
-                # Increase the retry count of the timeouts that expired, and
-                # abort the job if we exceeded their limits.
-                abort = False
-                for timeout in timeouts.expired_list:
-                    retry = timeout.retry()
-                    decision = "Try again!" if retry else "Abort!"
-                    self.log(f"Hit the timeout {timeout} --> {decision}\n", LogLevel.ERROR)
-                    abort = abort or not retry
-
-                # Check if the DUT asked us to reboot
-                if self.job_console.needs_reboot:
-                    retry = timeouts.boot_cycle.retry()
-                    retries_str = f"{timeouts.boot_cycle.retried}/{timeouts.boot_cycle.retries}"
-                    dec = f"Boot cycle {retries_str}, go ahead!" if retry else "Exceeded boot loop count, aborting!"
-                    self.log(f"The DUT asked us to reboot: {dec}\n", LogLevel.WARN)
-                    abort = abort or not retry
-
-                if abort:
-                    # We have reached a timeout retry limit, time to stop!
-                    self.job_console.set_state(JobConsoleState.DUT_DONE)
-                else:
-                    # Stop all the timeouts, except the overall
-                    timeouts.first_console_activity.stop()
-                    timeouts.console_activity.stop()
-                    timeouts.boot_cycle.stop()
-
-                    # We went through one boot cycle, use the "continue" deployment
-                    deployment = self.job_config.deployment_continue
+            self._boot_loop(timeouts)
 
             # We either reached the end of the job, or the client got disconnected
             if self.job_console.state == JobConsoleState.DUT_DONE and not self.cancel_job.is_set():
@@ -772,9 +1226,22 @@ class Executor(Thread):
                     self.log("The machine has been marked as unfit for service\n")
                     self.machine.ready_for_service = False
 
+                # Keep track of how well production jobs are doing on this machine
+                if not self.sergent_hartman.is_active:
+                    status = JobStatus.from_str(self.job_config.console_patterns.job_status)
+                    self.health.report(JobOutcome.from_timeouts(status, timeouts))
+
+                    if self.health.needs_retraining:
+                        self.log(f"The machine's health score dropped to {self.health.score:.2f}, "
+                                 "sending it back to training\n", LogLevel.WARN)
+                        self.health.reset()
+                        self.machine.ready_for_service = False
+
                 # Tearing down the job
                 self.log("The job has finished executing, starting tearing down\n")
                 timeouts.infra_teardown.start()
+                if self.job_record is not None:
+                    self.job_record.set_state(JobState.TEARDOWN)
 
                 # Delay to make sure messages are read before the end of the job
                 time.sleep(CONSOLE_DRAINING_DELAY)
@@ -784,17 +1251,19 @@ class Executor(Thread):
                 self.log("Creating credentials to the job bucket for the client\n")
                 self.job_console.set_state(JobConsoleState.TEAR_DOWN, job_bucket=self.job_bucket)
 
-                # Wait for the client to close the connection
+                # Let the client download the job bucket in the background, so
+                # that the machine can be used by another job in the meantime
                 self.log("Waiting for the client to download the job bucket\n")
-                while (self.job_console.state < JobConsoleState.OVER and
-                       not self.cancel_job.is_set() and
-                       not self.stop_event.is_set() and
-                       not timeouts.infra_teardown.has_expired):
-                    # Wait a little bit before checking again
-                    time.sleep(0.1)
-
-                self.log(f"Completed the tear down procedure in {timeouts.infra_teardown.active_for} s\n")
-                timeouts.infra_teardown.stop()
+                status = JobStatus.from_str(self.job_config.console_patterns.job_status)
+                self.job_teardown = JobTeardown(self.machine.id, self.job_console, self.job_bucket, self.job_record,
+                                                status=status, timeout=timeouts.infra_teardown,
+                                                stop_event=self.stop_event, cancel_job=self.cancel_job)
+                self.job_teardown.start()
+
+                # The teardown thread now owns the console, the bucket and the job record
+                self.job_console = None
+                self.job_bucket = None
+                self.job_record = None
             else:
                 self.log("The job is over, skipping sharing the job bucket with the client")
 
@@ -826,3 +1295,6 @@ class Executor(Thread):
                 traceback.print_exc()
 
             # TODO: Keep the state of the job in memory for later querying
+
+        self._leave_hot_standby()
+        self.credentials_pool.stop_event.set()
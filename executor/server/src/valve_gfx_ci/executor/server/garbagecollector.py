@@ -0,0 +1,169 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from threading import Thread, Event, Condition, Lock
+from typing import Callable
+
+import heapq
+import time
+
+from .minioclient import MinioClient
+from .logger import logger
+from . import config
+
+
+@dataclass(order=True)
+class GarbageCollectionTask:
+    due_at: float
+    description: str = field(compare=False)
+    func: Callable = field(compare=False)
+
+    # Name of the bucket the task is about, if any
+    bucket_name: str = field(default=None, compare=False)
+
+    attempts: int = field(default=0, compare=False)
+
+
+class GarbageCollector(Thread):
+    # Prefix of all the job buckets, as generated by JobBucket.from_job_request()
+    JOB_BUCKET_PREFIX = "job-"
+
+    # Failed tasks get retried with an exponential backoff, before being given up on
+    RETRY_DELAY = 1
+    RETRY_MAX_DELAY = 300
+    MAX_ATTEMPTS = 10
+
+    def __init__(self, minio=None, rate_limit=None, sweep_period=None):
+        super().__init__(name='GarbageCollector', daemon=True)
+
+        if rate_limit is None:
+            rate_limit = float(config.EXECUTOR_GC_RATE_LIMIT)
+        if sweep_period is None:
+            sweep_period = int(config.EXECUTOR_GC_SWEEP_PERIOD)
+
+        self._minio = minio
+
+        # Maximum amount of tasks executed per second. 0 means unlimited
+        self.rate_limit = rate_limit
+
+        # How often to look for job buckets that got orphaned (crash, failed removals, ...)
+        self.sweep_period = sweep_period
+
+        # Number of registrations of every bucket in use. A job may try to create a bucket which already exists,
+        # which should not drop the registration of the bucket's actual owner
+        self._lock = Lock()
+        self._in_use = defaultdict(int)
+
+        self._tasks_cond = Condition()
+        self._tasks = []
+
+        self.stop_event = Event()
+
+    @property
+    def minio(self):
+        # Delay the creation of the client until it is needed
+        if self._minio is None:
+            self._minio = MinioClient()
+        return self._minio
+
+    @property
+    def pending_tasks(self):
+        with self._tasks_cond:
+            return sorted(self._tasks)
+
+    def _schedule(self, task):
+        with self._tasks_cond:
+            heapq.heappush(self._tasks, task)
+            self._tasks_cond.notify()
+
+    def register_bucket(self, bucket_name):
+        # Buckets in use are never removed by the sweeps
+        with self._lock:
+            self._in_use[bucket_name] += 1
+
+    def unregister_bucket(self, bucket_name):
+        with self._lock:
+            if self._in_use.get(bucket_name, 0) > 1:
+                self._in_use[bucket_name] -= 1
+            else:
+                self._in_use.pop(bucket_name, None)
+
+    def remove_bucket(self, bucket_name):
+        self.unregister_bucket(bucket_name)
+
+        self._schedule(GarbageCollectionTask(due_at=time.monotonic(), description=f"Remove the bucket {bucket_name}",
+                                             func=lambda: self.minio.remove_bucket(bucket_name),
+                                             bucket_name=bucket_name))
+
+    def remove_user(self, user_name):
+        self._schedule(GarbageCollectionTask(due_at=time.monotonic(), description=f"Remove the user {user_name}",
+                                             func=lambda: self.minio.remove_user(user_name)))
+
+    def remove_policy(self, policy_name):
+        self._schedule(GarbageCollectionTask(due_at=time.monotonic(), description=f"Remove the policy {policy_name}",
+                                             func=lambda: self.minio.remove_policy(policy_name)))
+
+    def sweep(self):
+        try:
+            bucket_names = self.minio.list_buckets()
+        except Exception as e:
+            logger.error(f"Failed to list the buckets: {e}")
+            return
+
+        with self._lock:
+            orphans = [n for n in bucket_names if n.startswith(self.JOB_BUCKET_PREFIX) and n not in self._in_use]
+
+        # Do not queue the buckets that are already pending removal
+        pending = set([t.bucket_name for t in self.pending_tasks])
+        for bucket_name in orphans:
+            if bucket_name not in pending:
+                logger.info(f"Found the orphaned job bucket {bucket_name}, removing it")
+                self.remove_bucket(bucket_name)
+
+    def process(self, task):
+        # The bucket may have been re-used since the removal got queued
+        if task.bucket_name is not None:
+            with self._lock:
+                if task.bucket_name in self._in_use:
+                    return
+
+        task.attempts += 1
+        try:
+            task.func()
+        except Exception as e:
+            if task.attempts >= self.MAX_ATTEMPTS:
+                logger.error(f"{task.description}: Giving up after {task.attempts} attempts: {e}")
+                return
+
+            delay = min(self.RETRY_DELAY * 2 ** (task.attempts - 1), self.RETRY_MAX_DELAY)
+            logger.warning(f"{task.description}: Attempt {task.attempts} failed, retrying in {delay} s: {e}")
+            task.due_at = time.monotonic() + delay
+            self._schedule(task)
+
+    def _next_task(self, timeout):
+        with self._tasks_cond:
+            if len(self._tasks) > 0 and self._tasks[0].due_at <= time.monotonic():
+                return heapq.heappop(self._tasks)
+
+            # Wait for a task to be queued or become due
+            if len(self._tasks) > 0:
+                timeout = min(timeout, self._tasks[0].due_at - time.monotonic())
+            self._tasks_cond.wait(timeout)
+
+    def run(self):
+        next_sweep = time.monotonic()
+        while not self.stop_event.is_set():
+            if time.monotonic() >= next_sweep:
+                self.sweep()
+                next_sweep = time.monotonic() + self.sweep_period
+
+            if (task := self._next_task(timeout=1)) is None:
+                continue
+
+            self.process(task)
+
+            if self.rate_limit > 0:
+                self.stop_event.wait(1 / self.rate_limit)
+
+
+# Shared by all the executors of the farm
+garbage_collector = GarbageCollector()
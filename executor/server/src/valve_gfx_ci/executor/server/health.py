@@ -0,0 +1,83 @@
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from threading import Lock
+
+from .message import JobStatus
+from . import config
+
+
+@dataclass
+class JobOutcome:
+    status: JobStatus
+    boot_retries: int = 0
+    timeouts_hit: int = 0
+    date: datetime = field(default_factory=datetime.now)
+
+    # Statuses that tell us the machine did not manage to run the job to
+    # completion. A FAIL is the test suite's problem, not the machine's.
+    UNHEALTHY_STATUSES = {JobStatus.INCOMPLETE, JobStatus.UNKNOWN, JobStatus.SETUP_FAIL}
+
+    # How much every retry costs, with the score of a job being in [0, 1]
+    RETRY_PENALTY = 0.25
+
+    @property
+    def score(self):
+        if self.status in self.UNHEALTHY_STATUSES:
+            return 0.0
+
+        penalty = (self.boot_retries + self.timeouts_hit) * self.RETRY_PENALTY
+        return max(0.0, 1.0 - penalty)
+
+    @classmethod
+    def from_timeouts(cls, status, timeouts):
+        boot_retries = timeouts.boot_cycle.retried
+        timeouts_hit = sum([t.retried for t in timeouts]) - boot_retries
+        return cls(status=status, boot_retries=boot_retries, timeouts_hit=timeouts_hit)
+
+
+class MachineHealth:
+    def __init__(self, window=None, min_samples=None, retrain_threshold=None):
+        if window is None:
+            window = int(config.EXECUTOR_HEALTH_WINDOW)
+
+        if min_samples is None:
+            min_samples = int(config.EXECUTOR_HEALTH_MIN_SAMPLES)
+
+        if retrain_threshold is None:
+            retrain_threshold = float(config.EXECUTOR_HEALTH_RETRAIN_THRESHOLD)
+
+        self.window = window
+        self.min_samples = min_samples
+        self.retrain_threshold = retrain_threshold
+
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.outcomes = deque(maxlen=self.window)
+
+    def report(self, outcome):
+        with self._lock:
+            self.outcomes.append(outcome)
+
+    @property
+    def samples(self):
+        return len(self.outcomes)
+
+    @property
+    def score(self):
+        with self._lock:
+            outcomes = list(self.outcomes)
+
+        # Machines without history are assumed to be healthy, since they
+        # passed the qualification process
+        if len(outcomes) == 0:
+            return 1.0
+
+        return sum([o.score for o in outcomes]) / len(outcomes)
+
+    @property
+    def needs_retraining(self):
+        return self.samples >= self.min_samples and self.score < self.retrain_threshold
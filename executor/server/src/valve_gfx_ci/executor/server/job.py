@@ -1,11 +1,12 @@
 from enum import Enum
 from datetime import datetime, timedelta
-from marshmallow import Schema, fields, post_load
+from marshmallow import Schema, fields, post_load, validate
 from marshmallow.exceptions import ValidationError
 from jinja2 import Template
 import yaml
 import re
 
+from .compression import COMPRESSORS
 from . import config
 
 
@@ -13,6 +14,7 @@ class Target:
     class Schema(Schema):
         id = fields.Str()
         tags = fields.List(fields.Str())
+        cache_affinity = fields.Bool()
 
         @post_load
         def make(self, data, **kwargs):
@@ -22,10 +24,13 @@ class Target:
 
             return Target(**data)
 
-    def __init__(self, id: str = None, tags: list[str] = None):
+    def __init__(self, id: str = None, tags: list[str] = None, cache_affinity: bool = True):
         self.id = id
         self.tags = tags if tags is not None else []
 
+        # Prefer machines that recently ran jobs using the same artifacts
+        self.cache_affinity = cache_affinity
+
     def __str__(self):
         return f"<Target: id={self.id}, tags={self.tags}>"
 
@@ -369,20 +374,64 @@ def _multiline_string(lines):
 
 
 class Deployment:
-    def __init__(self, kernel_url=None, initramfs_url=None, kernel_cmdline=None):
+    def __init__(self, kernel_url=None, initramfs_url=None, kernel_cmdline=None, warm_reboot=None,
+                 kernel_sha256=None, initramfs_sha256=None, initramfs_recompress=None):
         self.kernel_url = kernel_url
         self.kernel_cmdline = kernel_url
         self.initramfs_url = initramfs_url
 
+        # Optional digests of the artifacts, to skip revalidating them
+        self.kernel_sha256 = kernel_sha256
+        self.initramfs_sha256 = initramfs_sha256
+
+        # Optional format the initramfs should be recompressed to, for faster boots
+        self.initramfs_recompress = initramfs_recompress
+
+        # Command sent to the DUT's console to reboot into this deployment without a power cycle
+        self.warm_reboot = warm_reboot
+
     def update(self, data):
+        # NOTE: A digest only applies to the URL it was set with
         if (kernel_url := data.get('kernel', {}).get('url')) is not None:
             self.kernel_url = kernel_url
+            self.kernel_sha256 = None
+
+        if (kernel_sha256 := data.get('kernel', {}).get('sha256')) is not None:
+            self.kernel_sha256 = kernel_sha256
 
         if (kernel_cmdline := data.get('kernel', {}).get('cmdline')) is not None:
             self.kernel_cmdline = kernel_cmdline
 
         if (initramfs_url := data.get('initramfs', {}).get('url')) is not None:
             self.initramfs_url = initramfs_url
+            self.initramfs_sha256 = None
+
+        if (initramfs_sha256 := data.get('initramfs', {}).get('sha256')) is not None:
+            self.initramfs_sha256 = initramfs_sha256
+
+        if (initramfs_recompress := data.get('initramfs', {}).get('recompress')) is not None:
+            self.initramfs_recompress = initramfs_recompress
+
+        if (warm_reboot := data.get('warm_reboot')) is not None:
+            self.warm_reboot = warm_reboot
+
+    def warm_reboot_command(self, kernel_url, initramfs_url):
+        if self.warm_reboot is None:
+            return None
+
+        # NOTE: Do not use str.format(), as shell commands may contain curly braces
+        cmd = self.warm_reboot
+        cmd = cmd.replace("{kernel_url}", str(kernel_url))
+        cmd = cmd.replace("{initramfs_url}", str(initramfs_url))
+        cmd = cmd.replace("{kernel_cmdline}", str(self.kernel_cmdline))
+        return cmd
+
+    @property
+    def container_images(self):
+        if self.kernel_cmdline is None:
+            return set()
+
+        return set(re.findall(r'docker://([^\s"]+)', self.kernel_cmdline))
 
     def __str__(self):
         return f"""<Deployment:
@@ -398,6 +447,7 @@ class Job:
             class DeploymentSchema(Schema):
                 class KernelSchema(Schema):
                     url = fields.Str()
+                    sha256 = fields.Str()
                     cmdline = fields.Method("get_cmdline", deserialize="load_cmdline")
 
                     def get_cmdline(self, obj):  # pragma: nocover
@@ -408,9 +458,18 @@ class Job:
 
                 class InitramfsSchema(Schema):
                     url = fields.Str()
+                    sha256 = fields.Str()
+                    recompress = fields.Str(validate=validate.OneOf(COMPRESSORS.keys()))
 
                 kernel = fields.Nested(KernelSchema())
                 initramfs = fields.Nested(InitramfsSchema())
+                warm_reboot = fields.Method("get_warm_reboot", deserialize="load_warm_reboot")
+
+                def get_warm_reboot(self, obj):  # pragma: nocover
+                    return obj.warm_reboot
+
+                def load_warm_reboot(self, value):
+                    return _multiline_string(value)
 
             start = fields.Nested(DeploymentSchema(), required=True)
             cont = fields.Nested(DeploymentSchema(), data_key="continue", attribute="continue")
@@ -462,6 +521,14 @@ class Job:
         self.deployment_start = deployment_start
         self.deployment_continue = deployment_continue
 
+    @property
+    def cache_affinity_keys(self):
+        keys = set()
+        for deployment in [self.deployment_start, self.deployment_continue]:
+            keys.update({url for url in [deployment.kernel_url, deployment.initramfs_url] if url is not None})
+            keys.update(deployment.container_images)
+        return keys
+
     @classmethod
     def from_job(cls, job_yml, bucket=None):
         j = yaml.safe_load(job_yml)
@@ -552,8 +619,10 @@ class Job:
         kernel_url:     {self.deployment_start.kernel_url}
         initramfs_url:  {self.deployment_start.initramfs_url}
         kernel_cmdline: {self.deployment_start.kernel_cmdline}
+        warm_reboot:    {self.deployment_start.warm_reboot}
 
     continue deployment:
         kernel_url:     {self.deployment_continue.kernel_url}
         initramfs_url:  {self.deployment_continue.initramfs_url}
-        kernel_cmdline: {self.deployment_continue.kernel_cmdline}>"""
+        kernel_cmdline: {self.deployment_continue.kernel_cmdline}
+        warm_reboot:    {self.deployment_continue.warm_reboot}>"""
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from datetime import datetime
+from enum import IntEnum
+from threading import Lock
+
+import secrets
+import uuid
+
+from . import config
+
+
+class JobState(IntEnum):
+    QUEUED = 0
+    SETUP = 1
+    RUNNING = 2
+    TEARDOWN = 3
+    DONE = 4
+
+
+class UnknownJobError(ValueError):
+    pass
+
+
+class JobRecord:
+    def __init__(self, name, machine_id, job_id=None):
+        self.id = job_id if job_id is not None else str(uuid.uuid4())
+        self.name = name
+        self.machine_id = machine_id
+
+        self.state = JobState.QUEUED
+        self.status = None
+        self.error_msg = None
+
+        self.created_at = datetime.now()
+        self.updated_at = self.created_at
+
+        # Console of the job, which clients may reattach to until the job is over. Only the submitter of the job
+        # gets the token needed to reattach
+        self.console = None
+        self.reattach_token = secrets.token_hex(16)
+
+    @property
+    def is_finished(self):
+        return self.state == JobState.DONE
+
+    def set_state(self, state):
+        if state < self.state:
+            raise ValueError("The state can only move forward")
+
+        self.state = state
+        self.updated_at = datetime.now()
+
+    def finish(self, status, error_msg=None):
+        if self.is_finished:
+            return
+
+        self.status = status
+        self.error_msg = error_msg
+        self.console = None
+        self.set_state(JobState.DONE)
+
+    def __str__(self):
+        return f"<Job {self.id}: name={self.name}, machine={self.machine_id}, state={self.state.name}>"
+
+
+class JobTracker:
+    def __init__(self, history_size=None):
+        if history_size is None:
+            history_size = int(config.EXECUTOR_JOB_HISTORY_SIZE)
+
+        self.history_size = history_size
+
+        self._lock = Lock()
+        self._jobs = OrderedDict()
+
+    @property
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def get(self, job_id, raise_if_missing=False):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and raise_if_missing:
+            raise UnknownJobError(f"Unknown job ID '{job_id}'")
+        return job
+
+    def create(self, name, machine_id):
+        job = JobRecord(name=name, machine_id=machine_id)
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_old_jobs()
+
+        return job
+
+    def _forget_old_jobs(self):
+        # Drop the oldest finished jobs, never the active ones
+        finished = [j.id for j in self._jobs.values() if j.is_finished]
+        for job_id in finished[:max(0, len(self._jobs) - self.history_size)]:
+            del self._jobs[job_id]
@@ -17,6 +17,9 @@ from .boots import split_mac_addr
 from .logger import logger
 from .pdu import PDU
 from .executor import Executor
+from .jobtracker import JobTracker
+from .artifactcache import ArtifactPrefetcher
+from .garbagecollector import garbage_collector
 from . import config
 from . import gitlab
 
@@ -82,6 +85,7 @@ class ConfigDUT:
     pdu: str = None
     pdu_port_id: str = None
     pdu_off_delay: float = 30
+    hot_standby_power: float = None
     ready_for_service: bool = False
     is_retired: bool = False
     first_seen: datetime = field(default_factory=lambda: datetime.now())
@@ -321,6 +325,12 @@ class Mars(Thread):
         self._machines = {}
         self._discover_data = {}
 
+        # Jobs submitted to any of the machines
+        self.jobs = JobTracker()
+
+        # Background warming of the boot artifact cache
+        self.prefetcher = ArtifactPrefetcher()
+
         self.stop_event = Event()
 
     @property
@@ -419,6 +429,8 @@ class Mars(Thread):
 
     def stop(self, wait=True):
         self.stop_event.set()
+        self.prefetcher.stop_event.set()
+        garbage_collector.stop_event.set()
 
         # Signal all the executors we want to stop
         for machine in self.known_machines:
@@ -430,9 +442,16 @@ class Mars(Thread):
     def join(self):
         for machine in self.known_machines:
             machine.executor.join()
+        if self.prefetcher.is_alive():
+            self.prefetcher.join()
+        if garbage_collector.is_alive():
+            garbage_collector.join()
         super().join()
 
     def run(self):
+        self.prefetcher.start()
+        garbage_collector.start()
+
         # Make sure the config file exists
         Path(config.MARS_DB_FILE).touch(exist_ok=True)
 
@@ -57,6 +57,9 @@ class Message:
     payload: str
     date: datetime = field(default_factory=datetime.utcnow)
 
+    # Sequence number of the messages sent by the executor, so that clients may resume from the last one received
+    seq: int = None
+
     @classmethod
     def recv(cls, sock, length):
         buf = bytearray(length)
@@ -74,24 +77,35 @@ class Message:
         return buf
 
     @classmethod
-    def next_message(self, sock):
-        length = struct.unpack("!I", self.recv(sock, 4))[0]
-        frame = self.recv(sock, length)
+    def next_message(cls, sock):
+        length = struct.unpack("!I", cls.recv(sock, 4))[0]
+        return cls.from_frame(cls.recv(sock, length))
 
+    @classmethod
+    def from_frame(cls, frame):
+        # NOTE: The frame is expected to be stripped of its length
         msg = json.loads(frame.decode())
         MessageTypeClass = MessageType(msg.get("msg_type")).message_class
 
         return MessageTypeClass(msg.get("payload"),
-                                date=datetime.fromisoformat(msg.get('date')))
+                                date=datetime.fromisoformat(msg.get('date')),
+                                seq=msg.get("seq"))
 
-    def send(self, sock):
-        payload = json.dumps({
+    @property
+    def frame(self):
+        msg = {
             "msg_type": self.msg_type.value,
             "date": self.date.isoformat(),
             "payload": self.payload
-        }).encode()
+        }
+        if self.seq is not None:
+            msg["seq"] = self.seq
+
+        payload = json.dumps(msg).encode()
+        return struct.pack("!I", len(payload)) + payload
 
-        return sock.send(struct.pack("!I", len(payload)) + payload)
+    def send(self, sock):
+        return sock.send(self.frame)
 
 
 class ControlMessage(Message):
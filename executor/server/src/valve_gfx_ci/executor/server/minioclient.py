@@ -1,20 +1,34 @@
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit, urlunsplit, urlencode, quote
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
-from tarfile import TarFile
+from tarfile import TarFile, TarInfo
 from minio import Minio
 from minio.helpers import check_bucket_name
+from minio.commonconfig import CopySource, REPLACE
+from minio.credentials import Credentials
+from minio.deleteobjects import DeleteObject
+from minio.signer import sign_v4_s3
+from minio.helpers import sha256_hash
+from minio import time as minio_time
 from minio.error import S3Error
+from threading import BoundedSemaphore, Lock
 from typing import List
+from contextlib import nullcontext
+from io import BytesIO
 
 import subprocess
+import requests
+import hashlib
 import struct
+import time
 import ipaddress
 import tempfile
-import requests
 import json
 import re
 
+from .compression import HEADER_SIZE, PrefixedStream, decompressed, detect_compression
 from . import config
 
 
@@ -64,15 +78,45 @@ def generate_policy(statements):
 # TODO: rename the methods to be on the form $object_$operation
 # to make auto-completion work more efficiently.
 class MinioClient():
+    BOOT_BUCKET = 'boot'
+
+    # Streams of unknown length get uploaded in parts of this size, in parallel
+    BOOT_ARTIFACT_PART_SIZE = 16 * 1024 * 1024
+    BOOT_ARTIFACT_PARALLEL_UPLOADS = 4
+
+    # Members of archives smaller than the minimum part size get uploaded concurrently, while the bigger ones
+    # get streamed using multipart uploads
+    ARCHIVE_SMALL_MEMBER_SIZE = 5 * 1024 * 1024
+    # NOTE: Stay below the size of the connection pool of the client (10), so that all the connections get reused
+    ARCHIVE_UPLOAD_WORKERS = 8
+
+    # Members of archives at least this big get stored in the object pool, and copied from there by the server.
+    # Smaller ones are as cheap to upload as to copy.
+    OBJECT_POOL_MIN_SIZE = 64 * 1024
+
+    # Objects of the pool expire 30 days after their last modification (see the bucket's lifecycle rule). The ones
+    # found by a lookup get refreshed, unless they were modified recently, so that they cannot expire before the
+    # job that needs them seeds its bucket
+    OBJECT_POOL_REFRESH_AGE = timedelta(days=1)
+
+    # Compression formats of archives that need to be decompressed by an external tool
+    ARCHIVE_PIPED_FORMATS = ["zstd", "lz4"]
+
+    ADMIN_API_PATH = "/minio/admin/v3"
+    ADMIN_API_REGION = "us-east-1"
+    ADMIN_API_TIMEOUT = 30
+
     def __init__(self,
                  url=config.MINIO_URL,
                  user=config.MINIO_ROOT_USER,
                  secret_key=config.MINIO_ROOT_PASSWORD,
-                 alias=config.MINIO_ADMIN_ALIAS):
+                 alias=config.MINIO_ADMIN_ALIAS,
+                 object_pool_bucket=config.MINIO_OBJECT_POOL_BUCKET):
         self.url = url
         self.user = user
         self.secret_key = secret_key
         self.alias = alias
+        self.object_pool_bucket = object_pool_bucket if object_pool_bucket else None
 
         self._client = Minio(
             endpoint=urlparse(url).netloc,
@@ -81,34 +125,107 @@ class MinioClient():
             secure=False,
         )
 
-        # Some operations can only be used using the commandline tool,
-        # so initialize it
-        if alias is not None:
+        # NOTE: The admin API gets called directly, re-using the same connections for all the requests
+        self._credentials = Credentials(user, secret_key)
+        self._admin_session = requests.Session()
+
+        self._alias_set = False
+
+    def _mcli(self, *args):
+        assert self.alias is not None
+
+        # Some operations can only be used using the commandline tool, so initialize it on first use
+        if not self._alias_set:
             try:
                 subprocess.check_call(
-                    ["mcli", "-q", "--no-color", "alias", "set", self.alias, url,
+                    ["mcli", "-q", "--no-color", "alias", "set", self.alias, self.url,
                      self.user, self.secret_key])
             except subprocess.CalledProcessError:  # pragma: nocover
                 raise ValueError("Invalid credentials") from None
+            self._alias_set = True
+
+        subprocess.check_call(["mcli", "-q", "--no-color", *args])
 
     def remove_alias(self):
-        if self.alias is not None:
+        if self._alias_set:
             subprocess.check_call(["mcli", "-q", "--no-color", "alias", "rm", self.alias])
+            self._alias_set = False
+
+    def _admin_request(self, method, operation, params=None, body=b""):
+        url = urlsplit(f"{self.url}{self.ADMIN_API_PATH}/{operation}")
+        if params:
+            # NOTE: The parameters need to be sorted, as they would be when computing the signature
+            url = url._replace(query=urlencode(sorted(params.items()), quote_via=quote))
+
+        date = minio_time.utcnow()
+        headers = {
+            "Host": url.netloc,
+            "x-amz-date": minio_time.to_amz_date(date),
+            "x-amz-content-sha256": sha256_hash(body),
+        }
+        headers = sign_v4_s3(method, url, self.ADMIN_API_REGION, headers, self._credentials,
+                             headers["x-amz-content-sha256"], date)
+
+        r = self._admin_session.request(method, urlunsplit(url), data=body, headers=headers,
+                                        timeout=self.ADMIN_API_TIMEOUT)
+        if r.status_code == 403:
+            try:
+                code = r.json().get("Code")
+            except ValueError:
+                code = None
+            if code in ["InvalidAccessKeyId", "SignatureDoesNotMatch"]:
+                raise ValueError("Invalid credentials")
+        r.raise_for_status()
+
+        return r
 
     def is_local_url(self, url):
         return url.startswith(f"{self.url}/")
 
-    def save_boot_artifact(self, remote_artifact_url, minio_object_name):
-        minio_bucket_name = 'boot'
-        with tempfile.NamedTemporaryFile("wb") as temp_download_area, \
-             requests.get(remote_artifact_url, stream=True) as r:
-            r.raise_for_status()
-            # Read all the available data, then write to disk
-            for chunk in r.iter_content(None):
-                temp_download_area.write(chunk)
-            temp_download_area.flush()
-            self._client.fput_object(minio_bucket_name, minio_object_name,
-                                     temp_download_area.name)
+    def boot_artifact_url(self, object_name):
+        return f"{self.url}/{self.BOOT_BUCKET}/{object_name}"
+
+    def boot_artifact_exists(self, object_name):
+        try:
+            self._client.stat_object(self.BOOT_BUCKET, object_name)
+            return True
+        except S3Error:
+            return False
+
+    def save_boot_artifact(self, object_name, data, length=None):
+        if isinstance(data, bytes):
+            length = len(data)
+            data = BytesIO(data)
+
+        if length is None:
+            self._client.put_object(self.BOOT_BUCKET, object_name, data, -1,
+                                    part_size=self.BOOT_ARTIFACT_PART_SIZE,
+                                    num_parallel_uploads=self.BOOT_ARTIFACT_PARALLEL_UPLOADS)
+        else:
+            self._client.put_object(self.BOOT_BUCKET, object_name, data, length)
+
+    def copy_boot_artifact(self, src_object_name, dst_object_name):
+        # NOTE: Server-side copies are limited to 5 GiB, which is plenty for boot artifacts
+        self._client.copy_object(self.BOOT_BUCKET, dst_object_name, CopySource(self.BOOT_BUCKET, src_object_name))
+
+    def open_boot_artifact(self, object_name):
+        # NOTE: The caller is expected to close and release the connection of the response
+        return self._client.get_object(self.BOOT_BUCKET, object_name)
+
+    def load_boot_artifact(self, object_name):
+        try:
+            response = self.open_boot_artifact(object_name)
+        except S3Error:
+            return None
+
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def remove_boot_artifact(self, object_name):
+        self._client.remove_object(self.BOOT_BUCKET, object_name)
 
     def _build_mc_attrs_str(self, tarball_member):
         ti = tarball_member.get_info()
@@ -141,17 +258,186 @@ class MinioClient():
         mode = int.from_bytes(struct.pack('<I', gomode), byteorder='little')
         return f"gid:{ti['gid']}/gname:{ti['gname']}/mode:{mode}/mtime:{int(ti['mtime'])}/uid:{ti['uid']}/uname:{ti['uname']}"  # noqa
 
+    def _copy_from_object_pool(self, bucket_name, object_name, digest, metadata):
+        self._client.copy_object(bucket_name, object_name, CopySource(self.object_pool_bucket, digest),
+                                 metadata=metadata, metadata_directive=REPLACE)
+
+    def _upload_archive_member(self, bucket_name, object_name, data, length, metadata, digest=None, **kwargs):
+        if digest is None:
+            self._client.put_object(bucket_name, object_name, data, length, metadata=metadata, **kwargs)
+            return
+
+        # Only upload the content if it isn't already in the pool
+        try:
+            self._copy_from_object_pool(bucket_name, object_name, digest, metadata)
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                raise
+
+            # NOTE: Concurrent uploads of the same content are harmless, as they store the same data
+            self._client.put_object(self.object_pool_bucket, digest, data, length, **kwargs)
+            self._copy_from_object_pool(bucket_name, object_name, digest, metadata)
+
+    def lookup_object_pool(self, objects):
+        # Returns the digests of the given (digest, size) objects that the object pool contains
+        if self.object_pool_bucket is None:
+            return set()
+
+        # NOTE: Smaller objects never get stored in the pool
+        digests = [d for d, size in objects if int(size) >= self.OBJECT_POOL_MIN_SIZE]
+        for digest in digests:
+            if not isinstance(digest, str) or re.fullmatch(r"[0-9a-f]{64}", digest) is None:
+                raise ValueError(f"Invalid sha256 digest: {digest}")
+
+        def exists(digest):
+            try:
+                stat = self._client.stat_object(self.object_pool_bucket, digest)
+                if datetime.now(timezone.utc) - stat.last_modified > self.OBJECT_POOL_REFRESH_AGE:
+                    # NOTE: Copying an object onto itself requires replacing its metadata
+                    self._client.copy_object(self.object_pool_bucket, digest,
+                                             CopySource(self.object_pool_bucket, digest),
+                                             metadata={"refreshed-at": str(int(time.time()))},
+                                             metadata_directive=REPLACE)
+                return True
+            except S3Error as e:
+                if e.code != "NoSuchKey":
+                    raise
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.ARCHIVE_UPLOAD_WORKERS, thread_name_prefix="ObjectPoolLookup") as pool:
+            return {digest for digest, found in zip(digests, pool.map(exists, digests)) if found}
+
+    @classmethod
+    def parse_archive_manifest(cls, manifest):
+        # The manifest lists the files left out of an archive because their content is in the object pool, and
+        # returns them as (member, digest) tuples
+        files = manifest.get("files") if isinstance(manifest, dict) else None
+        if not isinstance(files, list):
+            raise ValueError("The manifest does not contain a list of files")
+
+        members = []
+        for entry in files:
+            if not isinstance(entry, dict):
+                raise ValueError(f"Invalid file in the manifest: {entry}")
+
+            path = entry.get("path")
+            if not isinstance(path, str) or len(path) == 0 or path.startswith("/") or ".." in path.split("/"):
+                raise ValueError(f"Invalid path in the manifest: {path}")
+
+            digest = entry.get("sha256")
+            if not isinstance(digest, str) or re.fullmatch(r"[0-9a-f]{64}", digest) is None:
+                raise ValueError(f"Invalid sha256 digest for the file {path}: {digest}")
+
+            member = TarInfo(path)
+            try:
+                member.size = int(entry.get("size", 0))
+                member.mode = int(entry.get("mode", 0o644))
+                member.mtime = int(entry.get("mtime", 0))
+                member.uid = int(entry.get("uid", 0))
+                member.gid = int(entry.get("gid", 0))
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid attributes for the file {path} in the manifest") from None
+            member.uname = str(entry.get("uname", ""))
+            member.gname = str(entry.get("gname", ""))
+
+            members.append((member, digest))
+
+        return members
+
+    def seed_from_object_pool(self, bucket_name, members):
+        if len(members) > 0 and self.object_pool_bucket is None:
+            raise ValueError("Can't seed the bucket from the object pool, as it is disabled")
+
+        def copy(member, digest):
+            metadata = {
+                'X-Amz-Meta-Mc-Attrs': self._build_mc_attrs_str(member)
+            }
+
+            try:
+                self._copy_from_object_pool(bucket_name, member.name, digest, metadata)
+            except S3Error as e:
+                if e.code != "NoSuchKey":
+                    raise
+                raise ValueError(f"The content of {member.name} is no longer in the object pool") from None
+
+        # NOTE: The copies happen server-side, so they are cheap to run concurrently
+        with ThreadPoolExecutor(max_workers=self.ARCHIVE_UPLOAD_WORKERS,
+                                thread_name_prefix=f"SeedBucket-{bucket_name}") as pool:
+            for _ in pool.map(lambda m: copy(*m), members):
+                pass
+
+    def _extract_members(self, archive_fileobj, bucket_name):
+        errors = []
+
+        # Limit the amount of members kept in memory while waiting to be uploaded
+        slots = BoundedSemaphore(2 * self.ARCHIVE_UPLOAD_WORKERS)
+
+        def upload(name, data, metadata, digest):
+            try:
+                self._upload_archive_member(bucket_name, name, BytesIO(data), len(data), metadata, digest=digest)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.ARCHIVE_UPLOAD_WORKERS,
+                                thread_name_prefix=f"ExtractArchive-{bucket_name}") as pool:
+            # NOTE: Read the archive as a stream, so that members get uploaded as they are received
+            with TarFile.open(fileobj=archive_fileobj, mode='r|*') as archive:
+                while (member := archive.next()) is not None:
+                    # Stop at the first failed upload
+                    if len(errors) > 0:
+                        break
+
+                    # Ignore everything that isn't a file
+                    if not member.isfile():
+                        continue
+                    metadata = {
+                        'X-Amz-Meta-Mc-Attrs': self._build_mc_attrs_str(member)
+                    }
+
+                    pooled = self.object_pool_bucket is not None and member.size >= self.OBJECT_POOL_MIN_SIZE
+
+                    if member.size < self.ARCHIVE_SMALL_MEMBER_SIZE:
+                        data = archive.extractfile(member).read()
+                        digest = hashlib.sha256(data).hexdigest() if pooled else None
+                        slots.acquire()
+                        pool.submit(upload, member.name, data, metadata, digest)
+                    elif pooled:
+                        # NOTE: The content needs to be hashed before knowing whether it needs to be uploaded,
+                        # so spool it to the disk rather than keeping it in memory
+                        with tempfile.TemporaryFile() as f:
+                            h = hashlib.sha256()
+                            src = archive.extractfile(member)
+                            for block in iter(lambda: src.read(1024 * 1024), b""):
+                                h.update(block)
+                                f.write(block)
+                            f.seek(0)
+
+                            self._upload_archive_member(bucket_name, member.name, f, member.size, metadata,
+                                                        digest=h.hexdigest(), num_parallel_uploads=1)
+                    else:
+                        self._upload_archive_member(bucket_name, member.name, archive.extractfile(member),
+                                                    member.size, metadata, num_parallel_uploads=1)
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _open_archive(self, archive_fileobj):
+        # NOTE: tarfile only supports gzip, bzip2 and xz, let the commandline tools decompress the other formats
+        header = archive_fileobj.read(HEADER_SIZE)
+        if detect_compression(header) in self.ARCHIVE_PIPED_FORMATS:
+            return decompressed(archive_fileobj, header=header)
+        else:
+            return nullcontext(PrefixedStream(header, archive_fileobj))
+
     def extract_archive(self, archive_fileobj, bucket_name):
-        with TarFile.open(fileobj=archive_fileobj, mode='r') as archive:
-            while (member := archive.next()) is not None:
-                # Ignore everything that isn't a file
-                if not member.isfile():
-                    continue
-                metadata = {
-                    'X-Amz-Meta-Mc-Attrs': self._build_mc_attrs_str(member)
-                }
-                self._client.put_object(bucket_name, member.name, archive.extractfile(member),
-                                        member.size, num_parallel_uploads=1, metadata=metadata)
+        with self._open_archive(archive_fileobj) as stream:
+            self._extract_members(stream, bucket_name)
+
+            # Read the padding following the end of the archive, so that the decompressor can complete
+            while len(stream.read(1024 * 1024)) > 0:
+                continue
 
     def make_bucket(self, bucket_name):
         try:
@@ -159,63 +445,63 @@ class MinioClient():
         except S3Error:
             raise ValueError("The bucket already exists") from None
 
-    # NOTE: Using minioclient's remove_bucket requires first to empty the
-    # bucket. Use the CLI version for now.
+    def list_buckets(self):
+        return [b.name for b in self._client.list_buckets()]
+
     def remove_bucket(self, bucket_name):
-        assert self.alias is not None
+        # NOTE: Buckets need to be emptied before being removed. The objects get removed in batches of 1000.
+        objects = self._client.list_objects(bucket_name, recursive=True)
+        errors = self._client.remove_objects(bucket_name, (DeleteObject(o.object_name) for o in objects))
 
-        subprocess.check_call(["mcli", "-q", "--no-color", "rb", "--force",
-                               f'{self.alias}/{bucket_name}'])
+        # NOTE: The removal is lazy, and happens while iterating over the errors
+        for error in errors:
+            raise ValueError(f"Failed to remove the object {error.name}: {error.message}")
 
-    def add_user(self, user_id, password):
-        assert self.alias is not None
+        self._client.remove_bucket(bucket_name)
 
-        subprocess.check_call(["mcli", "-q", "--no-color", "admin", "user", "add",
-                               self.alias, user_id, password])
+    def add_user(self, user_id, password):
+        # NOTE: The admin API requires the secret key to be encrypted (argon2id + DARE), so use the commandline
+        # tool rather than carrying the crypto dependencies
+        self._mcli("admin", "user", "add", self.alias, user_id, password)
 
     def remove_user(self, user_id):
-        assert self.alias is not None
-
-        subprocess.check_call(["mcli", "-q", "--no-color", "admin", "user", "remove",
-                               self.alias, user_id])
+        self._admin_request("DELETE", "remove-user", params={"accessKey": user_id})
 
     def groups_user_is_in(self, user_id=None):
-        assert self.alias is not None
-
         if user_id is None:
             user_id = self.user
 
-        output = subprocess.check_output(["mcli", "-q", "--no-color", "--json", "admin",
-                                          "user", "info", self.alias, user_id])
-        return json.loads(output).get('memberOf', [])
+        r = self._admin_request("GET", "user-info", params={"accessKey": user_id})
+        return r.json().get('memberOf') or []
 
     def add_user_to_group(self, user_id, group_name):
-        assert self.alias is not None
+        body = json.dumps({"group": group_name, "members": [user_id], "isRemove": False}).encode()
+        self._admin_request("PUT", "update-group-members", body=body)
+
+    def remove_user_from_group(self, user_id, group_name):
+        body = json.dumps({"group": group_name, "members": [user_id], "isRemove": True}).encode()
+        self._admin_request("PUT", "update-group-members", body=body)
 
-        subprocess.check_call(["mcli", "-q", "--no-color", "admin", "group", "add",
-                               self.alias, group_name, user_id])
+    def _set_user_policy(self, policy_name, user_id):
+        self._admin_request("PUT", "set-user-or-group-policy",
+                            params={"policyName": policy_name, "userOrGroup": user_id, "isGroup": "false"})
 
     def apply_user_policy(self, policy_name, user_id, policy_statements):
-        assert self.alias is not None
+        policy = generate_policy(policy_statements)
+        self._admin_request("PUT", "add-canned-policy", params={"name": policy_name},
+                            body=json.dumps(policy).encode())
+        self._set_user_policy(policy_name, user_id)
 
-        with tempfile.NamedTemporaryFile(suffix='json') as f:
-            policy = generate_policy(policy_statements)
-            f.write(json.dumps(policy).encode())
-            f.flush()
+    def unset_user_policy(self, user_id):
+        # NOTE: Setting an empty policy removes the mapping
+        self._set_user_policy("", user_id)
 
-            subprocess.check_call(["mcli", "-q", "--no-color", "admin", "policy",
-                                   "add", self.alias, policy_name, f.name])
-            subprocess.check_call(["mcli", "-q", "--no-color", "admin", "policy", "set",
-                                   self.alias, policy_name, f"user={user_id}"])
+    def remove_policy(self, policy_name):
+        self._admin_request("DELETE", "remove-canned-policy", params={"name": policy_name})
 
     def remove_user_policy(self, policy_name, user_id):
-        assert self.alias is not None
-
-        subprocess.check_call(["mcli", "-q", "--no-color", "admin", "policy", "unset",
-                               self.alias, policy_name, f"user={user_id}"])
-
-        subprocess.check_call(["mcli", "-q", "--no-color", "admin", "policy", "remove",
-                               self.alias, policy_name])
+        self.unset_user_policy(user_id)
+        self.remove_policy(policy_name)
 
     @classmethod
     def create_valid_bucket_name(cls, base_name):
@@ -251,3 +537,53 @@ class MinioClient():
         check_bucket_name(name)
 
         return name
+
+
+class UserGroupsCache:
+    def __init__(self, ttl=None, url=config.MINIO_URL):
+        if ttl is None:
+            ttl = int(config.EXECUTOR_MINIO_GROUPS_CACHE_TTL)
+
+        # How long, in seconds, the groups of validated credentials are trusted for
+        self.ttl = ttl
+        self.url = url
+
+        self._lock = Lock()
+        self._entries = dict()
+
+    @classmethod
+    def _key(cls, access_key, secret_key):
+        # NOTE: Never keep the secret keys around
+        return (access_key, hashlib.sha256(secret_key.encode()).hexdigest())
+
+    def groups(self, access_key, secret_key):
+        key = self._key(access_key, secret_key)
+        now = time.monotonic()
+
+        with self._lock:
+            # Forget about the expired entries
+            self._entries = {k: e for k, e in self._entries.items() if e[0] > now}
+
+            if (entry := self._entries.get(key)) is not None:
+                return entry[1]
+
+        # NOTE: Invalid credentials raise a ValueError, and thus never get cached
+        client = MinioClient(url=self.url, user=access_key, secret_key=secret_key, alias=None,
+                             object_pool_bucket=None)
+        groups = set(client.groups_user_is_in())
+
+        with self._lock:
+            self._entries[key] = (now + self.ttl, groups)
+
+        return groups
+
+    def invalidate(self, access_key=None):
+        with self._lock:
+            if access_key is None:
+                self._entries.clear()
+            else:
+                self._entries = {k: e for k, e in self._entries.items() if k[0] != access_key}
+
+
+# Shared by all the job submissions
+user_groups_cache = UserGroupsCache()
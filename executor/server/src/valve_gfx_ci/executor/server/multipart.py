@@ -0,0 +1,121 @@
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Epilogue
+from threading import Event
+
+import tempfile
+
+
+class MultipartPart:
+    def __init__(self, stream, name, headers, filename=None):
+        self._stream = stream
+        self.name = name
+        self.headers = headers
+        self.filename = filename
+
+        self._buffer = bytearray()
+        self._complete = False
+        self._closed = Event()
+
+        # Temporary file holding the part, once spooled
+        self._spool = None
+
+    @property
+    def mimetype(self):
+        return self.headers.get("Content-Type", "").split(";")[0].strip()
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def _receive(self):
+        # NOTE: The events following the start of a part are its data, until the last one
+        event = self._stream.next_event()
+        self._buffer += event.data
+        self._complete = not event.more_data
+
+    def read(self, size=-1):
+        if self._spool is not None:
+            return self._spool.read(-1 if size is None else size)
+
+        if size is None or size < 0:
+            self.buffer()
+            size = len(self._buffer)
+
+        while not self._complete and len(self._buffer) < size:
+            self._receive()
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def buffer(self):
+        # Receive the rest of the part, so that the following parts may be read
+        while not self._complete:
+            self._receive()
+
+    def spool(self, max_memory_size=1024 * 1024):
+        # Receive the rest of the part into a temporary file, which only stays in memory while it is small
+        self._spool = tempfile.SpooledTemporaryFile(max_size=max_memory_size)
+        while True:
+            self._spool.write(self._buffer)
+            self._buffer.clear()
+
+            if self._complete:
+                break
+            self._receive()
+        self._spool.seek(0)
+
+    def drain(self):
+        while not self._complete:
+            self._receive()
+            self._buffer.clear()
+
+    def close(self):
+        # NOTE: Parts may be read by another thread than the one that received the request, which may be
+        # waiting for them to be closed before sending its response
+        self._closed.set()
+
+        if self._spool is not None:
+            self._spool.close()
+
+    def wait_closed(self, timeout=None):
+        return self._closed.wait(timeout)
+
+
+class MultipartStream:
+    def __init__(self, stream, boundary, chunk_size=64 * 1024):
+        if not boundary:
+            raise ValueError("The multipart boundary is missing")
+
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary)
+        self.chunk_size = chunk_size
+
+        self._done = False
+        self._current = None
+
+    def next_event(self):
+        # NOTE: Truncated bodies make the decoder raise a ValueError
+        while isinstance(event := self._decoder.next_event(), NeedData):
+            data = self._stream.read(self.chunk_size)
+            self._decoder.receive_data(data if len(data) > 0 else None)
+
+        return event
+
+    def __iter__(self):
+        # NOTE: Parts are received as they get read, so only the current one can be read
+        while not self._done:
+            if self._current is not None:
+                self._current.drain()
+
+            event = self.next_event()
+            if isinstance(event, (Field, File)):
+                self._current = MultipartPart(self, event.name, event.headers,
+                                              filename=getattr(event, "filename", None))
+                yield self._current
+            elif isinstance(event, Epilogue):
+                self._done = True
+
+    def drain(self):
+        # Receive the rest of the body, ignoring the parts that have not been read
+        for _ in self:
+            pass
@@ -0,0 +1,51 @@
+from collections import deque
+from threading import Lock
+
+from . import config
+
+
+class ReplayBuffer:
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = int(config.EXECUTOR_CONSOLE_REPLAY_BUFFER_SIZE)
+
+        # Maximum amount of bytes kept, the oldest messages getting dropped first
+        self.max_size = max_size
+
+        self._lock = Lock()
+        self._frames = deque()
+        self._size = 0
+        self._last_seq = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def last_seq(self):
+        return self._last_seq
+
+    def push(self, msg):
+        # Number the message, and keep its frame for as long as it fits in the buffer
+        with self._lock:
+            self._last_seq += 1
+            msg.seq = self._last_seq
+            frame = msg.frame
+
+            self._frames.append((msg.seq, frame))
+            self._size += len(frame)
+
+            while self._size > self.max_size:
+                _, dropped = self._frames.popleft()
+                self._size -= len(dropped)
+
+        return frame
+
+    def frames_after(self, seq):
+        # Returns the frames following the message `seq`, and how many of them are no longer in the buffer
+        seq = seq if seq is not None else 0
+        with self._lock:
+            frames = [frame for s, frame in self._frames if s > seq]
+            lost = max(0, self._last_seq - seq - len(frames))
+
+        return frames, lost
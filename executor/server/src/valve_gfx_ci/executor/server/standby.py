@@ -0,0 +1,47 @@
+from threading import Lock
+
+from . import config
+
+
+class HotStandbyBudget:
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = float(config.EXECUTOR_HOT_STANDBY_POWER_BUDGET)
+
+        # Power (in W) that the farm is allowed to spend on idle machines
+        self.budget = budget
+
+        self._lock = Lock()
+        self._machines = dict()
+
+    @property
+    def used(self):
+        with self._lock:
+            return sum(self._machines.values())
+
+    @property
+    def machines(self):
+        with self._lock:
+            return set(self._machines.keys())
+
+    def acquire(self, machine_id, power):
+        if power is None:
+            return False
+
+        with self._lock:
+            if machine_id in self._machines:
+                return True
+
+            if sum(self._machines.values()) + power > self.budget:
+                return False
+
+            self._machines[machine_id] = power
+            return True
+
+    def release(self, machine_id):
+        with self._lock:
+            self._machines.pop(machine_id, None)
+
+
+# Shared by all the executors of the farm
+hot_standby_budget = HotStandbyBudget()
@@ -0,0 +1,184 @@
+from unittest.mock import MagicMock, patch
+from urllib3 import encode_multipart_formdata
+from werkzeug.test import Client
+import json
+import io
+import os
+
+import pytest
+
+from server.app import app
+from server.executor import MachineState
+from server.jobtracker import JobTracker
+
+
+SIMPLE_JOB = """
+version: 1
+target:
+  tags: ["amdgpu"]
+console_patterns:
+  session_end:
+    regex: "session_end"
+deployment:
+  start:
+    kernel:
+      url: "kernel_url"
+      cmdline: "cmdline"
+"""
+
+
+def create_machine(machine_id):
+    machine = MagicMock(id=machine_id, tags={"amdgpu"}, is_retired=False)
+    machine.executor.state = MachineState.IDLE
+    machine.executor.health = MagicMock(score=1, retrain_threshold=0)
+    machine.executor.cache_affinity_hints.score.return_value = 0
+    return machine
+
+
+@pytest.fixture
+def mars():
+    mars = MagicMock(jobs=JobTracker(), known_machines=[create_machine("m1"), create_machine("m2")])
+    with app.app_context():
+        app.mars = mars
+    return mars
+
+
+@pytest.fixture
+def client(mars):
+    return Client(app)
+
+
+def test_post_job__invalid_request_gets_drained(client):
+    body, content_type = encode_multipart_formdata([
+        ("metadata", ("metadata", json.dumps({"version": 2}), "application/json")),
+        ("job", ("job", SIMPLE_JOB, "application/x-yaml")),
+        ("job_bucket_initial_state_tarball_file", ("tarball", os.urandom(256 * 1024), "application/octet-stream")),
+    ])
+    stream = io.BytesIO(body)
+
+    r = client.post("/api/v1/jobs", input_stream=stream, content_length=len(body), content_type=content_type)
+    assert r.status_code == 400
+    assert r.json == {"error": "Invalid request version 2"}
+    assert stream.tell() == len(body)
+
+
+def bulk_body(count, tarball_size):
+    fields = []
+    for i in range(count):
+        metadata = {"version": 1, "callback": {"host": "127.0.0.1", "port": 1234}}
+        fields.append((f"{i}/metadata", ("metadata", json.dumps(metadata), "application/json")))
+        fields.append((f"{i}/job", ("job", SIMPLE_JOB, "application/x-yaml")))
+        fields.append((f"{i}/job_bucket_initial_state_tarball_file",
+                       ("tarball", bytes([i]) * tarball_size, "application/octet-stream")))
+    return encode_multipart_formdata(fields)
+
+
+def test_post_jobs_bulk__tarballs_get_spooled_to_disk(client, mars):
+    body, content_type = bulk_body(count=2, tarball_size=2 * 1024 * 1024)
+
+    with patch("server.app.Executor.start_jobs") as start_jobs:
+        r = client.post("/api/v1/jobs/bulk", data=body, content_type=content_type)
+
+    assert r.status_code == 202
+    assert r.json["job_ids"] == [j.id for j in mars.jobs.jobs]
+    assert r.json["reattach_tokens"] == [j.reattach_token for j in mars.jobs.jobs]
+
+    reservations = start_jobs.call_args[0][0]
+    assert [e for e, _, _ in reservations] == [m.executor for m in mars.known_machines]
+    for i, (_, job_request, _) in enumerate(reservations):
+        tarball = job_request.job_bucket_initial_state_tarball_file
+        assert tarball._spool._rolled
+        assert len(tarball._buffer) == 0
+        assert tarball.read() == bytes([i]) * 2 * 1024 * 1024
+        tarball.close()
+
+
+def test_post_jobs_bulk__rejected_batch(client, mars):
+    body, content_type = bulk_body(count=3, tarball_size=1024)
+
+    with patch("server.app.Executor.start_jobs") as start_jobs:
+        r = client.post("/api/v1/jobs/bulk", data=body, content_type=content_type)
+
+    assert r.status_code == 409
+    assert r.json["error_msg"] == "Job 2: All machines matching the tags {'amdgpu'} are busy"
+    assert r.json["job_ids"] == []
+    start_jobs.assert_not_called()
+
+
+def test_post_jobs_bulk__invalid_part_name(client):
+    body, content_type = encode_multipart_formdata([("metadata", ("metadata", os.urandom(16), "application/json"))])
+
+    r = client.post("/api/v1/jobs/bulk", data=body, content_type=content_type)
+    assert r.status_code == 400
+    assert r.json == {"error": "The part metadata does not belong to any job of the batch"}
+
+
+def test_cancel_job_machine(client, mars):
+    machine = mars.known_machines[0]
+    mars.get_machine_by_id.return_value = machine
+
+    # Nothing to cancel
+    machine.executor.job_teardown = None
+    r = client.post("/api/v1/machine/m1/cancel_job")
+    assert r.status_code == 400
+    machine.executor.cancel_job.set.assert_not_called()
+
+    # The tear down of the last job is still running
+    machine.executor.job_teardown = MagicMock()
+    machine.executor.job_teardown.is_alive.return_value = True
+    r = client.post("/api/v1/machine/m1/cancel_job")
+    assert r.status_code == 200
+    machine.executor.job_teardown.cancel_job.set.assert_called_once_with()
+    machine.executor.cancel_job.set.assert_not_called()
+
+    # Running job
+    machine.executor.state = MachineState.RUNNING
+    r = client.post("/api/v1/machine/m1/cancel_job")
+    assert r.status_code == 200
+    machine.executor.cancel_job.set.assert_called_once_with()
+
+
+def test_get_job(client, mars):
+    job = mars.jobs.create(name="job", machine_id="m1")
+
+    r = client.get(f"/api/v1/job/{job.id}")
+    assert r.status_code == 200
+    assert r.json["id"] == job.id
+
+
+def test_get_job__unknown_id(client):
+    r = client.get("/api/v1/job/invalid")
+    assert r.status_code == 404
+    assert r.json == {"error": "Unknown job ID 'invalid'"}
+
+
+def test_reattach_job__unknown_id(client):
+    r = client.post("/api/v1/job/invalid/reattach", json={"callback": {"port": 1234}})
+    assert r.status_code == 404
+    assert r.json == {"error": "Unknown job ID 'invalid'"}
+
+
+def test_reattach_job(client, mars):
+    job = mars.jobs.create(name="job", machine_id="m1")
+    assert job.reattach_token not in client.get(f"/api/v1/job/{job.id}").get_data(as_text=True)
+
+    def reattach(**kwargs):
+        return client.post(f"/api/v1/job/{job.id}/reattach", json={"callback": {"host": "10.0.0.1", "port": 1234},
+                                                                   "last_seq": 42, **kwargs})
+
+    # Only the submitter of the job may reattach to it
+    for token in [None, 42, "invalid"]:
+        r = reattach(reattach_token=token)
+        assert r.status_code == 403
+        assert r.json == {"error": "Invalid reattach token"}
+
+    # The job does not have a console yet
+    r = reattach(reattach_token=job.reattach_token)
+    assert r.status_code == 409
+    assert r.json == {"error": f"The job {job.id} has no console to reattach to"}
+
+    job.console = MagicMock()
+    r = reattach(reattach_token=job.reattach_token)
+    assert r.status_code == 200
+    assert r.json == {"version": 1, "job_id": job.id}
+    job.console.reattach.assert_called_once_with(("10.0.0.1", 1234), last_seq=42)
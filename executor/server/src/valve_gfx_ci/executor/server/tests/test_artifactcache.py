@@ -0,0 +1,868 @@
+from unittest.mock import patch
+from dataclasses import asdict
+from threading import Event, Thread
+import hashlib
+import gzip
+import lzma
+import json
+import time
+import io
+
+import pytest
+import responses
+
+from server.artifactcache import BootArtifactCache, CachedArtifact, HashingReader, InFlightDownload
+from server.artifactcache import ArtifactPrefetcher, PrefetchRequest, PrefetchState
+import server.config as config
+
+
+class FakeMinio:
+    def __init__(self, objects=None):
+        self.url = "http://minio"
+        self.objects = objects if objects is not None else dict()
+        self.saved = []
+
+    def is_local_url(self, url):
+        return url.startswith(f"{self.url}/")
+
+    def boot_artifact_url(self, object_name):
+        return f"{self.url}/boot/{object_name}"
+
+    def boot_artifact_exists(self, object_name):
+        return object_name in self.objects
+
+    def save_boot_artifact(self, object_name, data, length=None):
+        if not isinstance(data, bytes):
+            buf = b""
+            while chunk := data.read(3):
+                buf += chunk
+            data = buf
+        self.objects[object_name] = data
+        self.saved.append(object_name)
+
+    def copy_boot_artifact(self, src_object_name, dst_object_name):
+        self.objects[dst_object_name] = self.objects[src_object_name]
+        self.saved.append(dst_object_name)
+
+    def open_boot_artifact(self, object_name):
+        class Response(io.BytesIO):
+            def release_conn(self):
+                pass
+
+        return Response(self.objects[object_name])
+
+    def load_boot_artifact(self, object_name):
+        return self.objects.get(object_name)
+
+    def remove_boot_artifact(self, object_name):
+        self.objects.pop(object_name, None)
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def fixed_size_chunks(blocks, size=4):
+    data = b"".join(blocks)
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+
+def test_CachedArtifact():
+    artifact = CachedArtifact(url="url", digest="1234", size=42)
+    assert artifact.object_name == "cas/1234"
+    assert artifact.validators == {}
+
+    artifact = CachedArtifact(url="url", digest="1234", size=42, etag='"etag"', last_modified="date")
+    assert artifact.validators == {"If-None-Match": '"etag"', "If-Modified-Since": "date"}
+
+
+def test_HashingReader():
+    reader = HashingReader([b"hello", b" ", b"world"])
+
+    assert reader.read(2) == b"he"
+    assert reader.read() == b"llo"
+    assert reader.read(10) == b" "
+    assert reader.read(None) == b"world"
+    assert reader.read() == b""
+
+    assert reader.size == 11
+    assert reader.digest == sha256(b"hello world")
+
+
+@patch("server.artifactcache.time.sleep")
+def test_InFlightDownload__throttle(sleep_mock):
+    # No limits
+    download = InFlightDownload()
+    assert list(download.throttle([b"a" * 10, b"b" * 10])) == [b"a" * 10, b"b" * 10]
+    sleep_mock.assert_not_called()
+
+    # Limited to 10 bytes per second
+    download = InFlightDownload(max_bandwidth=10)
+    chunks = download.throttle([b"a" * 10, b"b" * 10, b"c" * 10])
+    assert next(chunks) == b"a" * 10
+    assert next(chunks) == b"b" * 10
+    assert sleep_mock.call_args.args[0] == pytest.approx(1, abs=0.1)
+
+    # Lifting the limit
+    download.max_bandwidth = None
+    sleep_mock.reset_mock()
+    assert next(chunks) == b"c" * 10
+    assert list(chunks) == []
+    sleep_mock.assert_not_called()
+
+
+@patch("server.artifactcache.MinioClient")
+def test_BootArtifactCache__defaults(minio_mock):
+    cache = BootArtifactCache()
+    assert cache.max_size == int(config.EXECUTOR_ARTIFACT_CACHE_MAX_SIZE)
+
+    # The client is only created when needed
+    minio_mock.assert_not_called()
+    assert cache.minio == minio_mock.return_value
+    assert cache.minio == minio_mock.return_value
+    minio_mock.assert_called_once_with()
+
+
+def test_BootArtifactCache__local_urls():
+    cache = BootArtifactCache(minio=FakeMinio())
+    assert cache.acquire("http://minio/boot/kernel") == "http://minio/boot/kernel"
+
+    # Releasing non-cached artifacts is a no-op
+    cache.release("http://minio/boot/kernel")
+
+
+@responses.activate
+def test_BootArtifactCache__download_and_revalidate():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel",
+                  headers={"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+    local_url = cache.acquire("https://host/kernel")
+    assert local_url == f"http://minio/boot/cas/{sha256(b'kernel')}"
+    assert minio.objects[f"cas/{sha256(b'kernel')}"] == b"kernel"
+    assert minio.objects[f"chunks/{sha256(b'kernel')}"] == b"kernel"
+    assert cache.size == 12
+
+    # The staging object got removed
+    assert set(minio.objects) == {f"cas/{sha256(b'kernel')}", f"chunks/{sha256(b'kernel')}",
+                                  BootArtifactCache.INDEX_OBJECT_NAME}
+    assert "If-None-Match" not in responses.calls[0].request.headers
+
+    # The index got persisted
+    index = json.loads(minio.objects[BootArtifactCache.INDEX_OBJECT_NAME])
+    assert index["artifacts"]["https://host/kernel"]["digest"] == sha256(b'kernel')
+    assert index["artifacts"]["https://host/kernel"]["etag"] == '"v1"'
+
+    # Unchanged artifacts are revalidated, but not downloaded again
+    responses.replace(responses.GET, "https://host/kernel", status=304)
+    minio.saved.clear()
+    assert cache.acquire("https://host/kernel") == local_url
+    assert responses.calls[1].request.headers["If-None-Match"] == '"v1"'
+    assert responses.calls[1].request.headers["If-Modified-Since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    assert minio.saved == [BootArtifactCache.INDEX_OBJECT_NAME]
+
+    # Modified artifacts get downloaded again
+    responses.replace(responses.GET, "https://host/kernel", body=b"kernel2")
+    assert cache.acquire("https://host/kernel") == f"http://minio/boot/cas/{sha256(b'kernel2')}"
+
+    # The index is shared with new instances
+    cache2 = BootArtifactCache(minio=minio, max_size=1000)
+    assert cache2.artifacts["https://host/kernel"].digest == sha256(b'kernel2')
+
+
+@responses.activate
+def test_BootArtifactCache__deduplication():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    responses.add(responses.GET, "https://host1/kernel", body=b"kernel")
+    responses.add(responses.GET, "https://host2/kernel", body=b"kernel")
+
+    assert cache.acquire("https://host1/kernel") == cache.acquire("https://host2/kernel")
+    assert minio.saved.count(f"cas/{sha256(b'kernel')}") == 1
+    assert minio.saved.count(f"chunks/{sha256(b'kernel')}") == 1
+    assert cache.size == 12
+
+
+@responses.activate
+def test_BootArtifactCache__http_errors():
+    cache = BootArtifactCache(minio=FakeMinio(), max_size=1000)
+
+    responses.add(responses.GET, "https://host/kernel", status=404)
+    with pytest.raises(Exception):
+        cache.acquire("https://host/kernel")
+    assert cache.artifacts == {}
+
+
+@responses.activate
+def test_BootArtifactCache__pinned_digest():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+    digest = sha256(b"kernel")
+
+    # Wrong digest: The artifact is kept in the cache, but can be evicted
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel", headers={"ETag": '"v1"'})
+    with pytest.raises(ValueError) as exc:
+        cache.acquire("https://host/kernel", sha256="1234")
+    assert "does not match the expected sha256" in str(exc.value)
+    assert cache._in_use == {}
+
+    # Correct digest, in upper case
+    local_url = cache.acquire("https://host/kernel", sha256=digest.upper())
+    assert local_url == f"http://minio/boot/cas/{digest}"
+
+    # Already-cached digests are used without contacting the origin, whatever their URL
+    assert cache.acquire("https://host/kernel", sha256=digest) == local_url
+    assert cache.acquire("https://mirror/kernel", sha256=digest) == local_url
+    assert len(responses.calls) == 1
+    assert cache.artifacts["https://host/kernel"].etag == '"v1"'
+    assert cache.artifacts["https://mirror/kernel"].etag is None
+
+    # Revalidated artifacts must also match the expected digest
+    responses.replace(responses.GET, "https://host/kernel", status=304)
+    with pytest.raises(ValueError):
+        cache.acquire("https://host/kernel", sha256=sha256(b"other"))
+
+
+@responses.activate
+def test_BootArtifactCache__missing_objects():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel", headers={"ETag": '"v1"'})
+    cache.acquire("https://host/kernel")
+
+    # Objects removed behind our back get downloaded again, without revalidation
+    minio.objects.clear()
+    cache.acquire("https://host/kernel", sha256=sha256(b"kernel"))
+    assert "If-None-Match" not in responses.calls[1].request.headers
+    assert minio.objects[f"cas/{sha256(b'kernel')}"] == b"kernel"
+
+
+@responses.activate
+def test_BootArtifactCache__eviction():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=25)
+
+    for name in ["a", "b", "c"]:
+        responses.add(responses.GET, f"https://host/{name}", body=name.encode() * 5)
+
+    # Every artifact is stored both as chunks, and in full
+    url_a = cache.acquire("https://host/a")
+    url_b = cache.acquire("https://host/b")
+    assert cache.acquire("https://host/b") == url_b
+    assert cache.size == 20
+
+    # Artifacts in use cannot be evicted
+    url_c = cache.acquire("https://host/c")
+    assert cache.size == 30
+    assert set(cache.artifacts) == {"https://host/a", "https://host/b", "https://host/c"}
+
+    # Once released, the full copies of the least recently used artifacts get evicted first
+    cache.release(url_a)
+    cache.release(url_b)
+    cache.release(url_b)
+    cache.release(url_c)
+    cache.acquire("https://host/b")
+    assert set(cache.artifacts) == {"https://host/a", "https://host/b", "https://host/c"}
+    assert cache.materialized == {sha256(b'bbbbb'), sha256(b'ccccc')}
+    assert f"cas/{sha256(b'aaaaa')}" not in minio.objects
+    assert f"chunks/{sha256(b'aaaaa')}" in minio.objects
+    assert cache.size == 25
+
+    # Evicted copies get rebuilt from the chunks, without downloading the artifact again
+    responses.replace(responses.GET, "https://host/a", status=304)
+    assert cache.acquire("https://host/a") == url_a
+    assert minio.objects[f"cas/{sha256(b'aaaaa')}"] == b"aaaaa"
+    assert cache.materialized == {sha256(b'aaaaa'), sha256(b'bbbbb')}
+    assert cache.size == 25
+
+    # The artifacts get forgotten when removing their full copy is not enough
+    cache.release(url_a)
+    cache.release(url_b)
+    cache.max_size = 10
+    cache.acquire("https://host/b")
+    assert set(cache.artifacts) == {"https://host/b"}
+    assert set(minio.objects) == {f"cas/{sha256(b'bbbbb')}", f"chunks/{sha256(b'bbbbb')}",
+                                  BootArtifactCache.INDEX_OBJECT_NAME}
+    assert cache.size == 10
+
+
+@responses.activate
+@patch("server.artifactcache.content_defined_chunks", fixed_size_chunks)
+def test_BootArtifactCache__shared_chunks():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    responses.add(responses.GET, "https://host/v1", body=b"aaaabbbb")
+    responses.add(responses.GET, "https://host/v2", body=b"aaaacccc")
+
+    cache.release(cache.acquire("https://host/v1"))
+    cache.release(cache.acquire("https://host/v2"))
+    assert cache.chunks == {sha256(b"aaaabbbb"): [(sha256(b"aaaa"), 4), (sha256(b"bbbb"), 4)],
+                            sha256(b"aaaacccc"): [(sha256(b"aaaa"), 4), (sha256(b"cccc"), 4)]}
+    assert minio.saved.count(f"chunks/{sha256(b'aaaa')}") == 1
+    assert cache.size == 16 + 12
+
+    # The chunks survive a restart
+    cache2 = BootArtifactCache(minio=minio, max_size=1000)
+    assert cache2.chunks == cache.chunks
+    assert cache2.materialized == cache.materialized
+
+    # Chunks only get removed when no artifacts use them anymore
+    with cache._lock:
+        removals = cache._forget(sha256(b"aaaabbbb"))
+    cache._remove_objects(removals)
+    assert f"chunks/{sha256(b'aaaa')}" in minio.objects
+    assert f"chunks/{sha256(b'bbbb')}" not in minio.objects
+    assert cache.size == 8 + 8
+
+
+@responses.activate
+def test_BootArtifactCache__rebuild_failure():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel", headers={"ETag": '"v1"'})
+    cache.release(cache.acquire("https://host/kernel"))
+
+    # Artifacts that cannot be rebuilt get downloaded again
+    responses.replace(responses.GET, "https://host/kernel", status=304)
+    with cache._lock:
+        removals = cache._dematerialize(sha256(b"kernel"))
+    cache._remove_objects(removals)
+    del minio.objects[f"chunks/{sha256(b'kernel')}"]
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel")
+
+    assert cache.acquire("https://host/kernel") == f"http://minio/boot/cas/{sha256(b'kernel')}"
+    assert minio.objects[f"cas/{sha256(b'kernel')}"] == b"kernel"
+    assert cache._in_use == {sha256(b"kernel"): 1}
+
+    # Give up if it fails twice in a row
+    cache._download = lambda url, cached=None, in_flight=None: CachedArtifact(url=url, digest="1234", size=42)
+    with pytest.raises(KeyError):
+        cache.acquire("https://host/initrd")
+    assert cache._in_use == {sha256(b"kernel"): 1}
+
+
+@responses.activate
+def test_BootArtifactCache__ingest_failure():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel")
+    with patch.object(minio, "copy_boot_artifact", side_effect=ValueError("error")):
+        with pytest.raises(ValueError):
+            cache.acquire("https://host/kernel")
+
+    # The chunks got removed along with the staging object
+    assert minio.objects == {}
+    assert cache.artifacts == {}
+
+
+def test_BootArtifactCache__legacy_index():
+    artifact = CachedArtifact(url="https://host/kernel", digest="1234", size=42)
+    index = {"artifacts": {artifact.url: asdict(artifact)}}
+    minio = FakeMinio(objects={BootArtifactCache.INDEX_OBJECT_NAME: json.dumps(index).encode()})
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    # Artifacts stored before the introduction of chunks are stored in full
+    assert cache.materialized == {"1234"}
+    assert cache.chunks == {}
+    assert cache.size == 42
+
+    # ... and cannot be partially evicted
+    cache.max_size = 0
+    with cache._lock:
+        cache._evict()
+    assert cache.artifacts == {}
+
+
+def add_origin(url, data, etag='"v1"', ranges=True, index=None):
+    def serve(request):
+        headers = {"ETag": etag}
+        if ranges:
+            headers["Accept-Ranges"] = "bytes"
+
+        if ranges and (r := request.headers.get("Range")) and request.headers.get("If-Range") == etag:
+            start, end = [int(v) for v in r.split("=")[1].split("-")]
+            return (206, headers, data[start:end + 1])
+
+        return (200, headers, data)
+
+    responses.add_callback(responses.GET, url, callback=serve)
+
+    if index is None:
+        index = {"sha256": sha256(data), "size": len(data),
+                 "chunks": [[sha256(c), len(c)] for c in fixed_size_chunks([data])]}
+    if index is False:
+        responses.add(responses.GET, f"{url}.chunks.json", status=404)
+    else:
+        responses.add(responses.GET, f"{url}.chunks.json", json=index)
+
+
+def range_requests(url):
+    return [c.request.headers["Range"] for c in responses.calls
+            if c.request.url == url and "Range" in c.request.headers]
+
+
+@responses.activate
+@patch("server.artifactcache.content_defined_chunks", fixed_size_chunks)
+def test_BootArtifactCache__chunk_index():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    # Without an index, the artifact gets downloaded in full
+    add_origin("https://host/v1", b"aaaabbbbcccc", index=False)
+    cache.release(cache.acquire("https://host/v1"))
+    assert set(cache.chunks[sha256(b"aaaabbbbcccc")]) == {(sha256(c), 4) for c in [b"aaaa", b"bbbb", b"cccc"]}
+
+    # With an index, only the missing chunks get downloaded, with as few requests as possible
+    data = b"aaaaddddeeeebbbbffff"
+    add_origin("https://host/v2", data)
+    assert cache.acquire("https://host/v2") == f"http://minio/boot/cas/{sha256(data)}"
+    assert range_requests("https://host/v2") == ["bytes=4-11", "bytes=16-19"]
+    assert [c.request.headers["If-Range"] for c in responses.calls if "Range" in c.request.headers] == ['"v1"'] * 2
+    assert minio.objects[f"cas/{sha256(data)}"] == data
+    assert cache.chunks[sha256(data)] == [(sha256(c), 4) for c in [b"aaaa", b"dddd", b"eeee", b"bbbb", b"ffff"]]
+    assert cache.artifacts["https://host/v2"].etag == '"v1"'
+    assert cache._in_use == {sha256(data): 1}
+
+    # Artifacts we already have are not downloaded at all
+    add_origin("https://mirror/v2", data)
+    assert cache.acquire("https://mirror/v2") == f"http://minio/boot/cas/{sha256(data)}"
+    assert range_requests("https://mirror/v2") == []
+
+
+@responses.activate
+@patch("server.artifactcache.content_defined_chunks", fixed_size_chunks)
+def test_BootArtifactCache__chunk_index_fallbacks():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    def check_full_download(url, data):
+        assert cache.acquire(url) == f"http://minio/boot/cas/{sha256(data)}"
+        assert minio.objects[f"cas/{sha256(data)}"] == data
+        assert [c.request.headers.get("Range") for c in responses.calls if c.request.url == url][-1] is None
+
+    # Origins not supporting range requests
+    add_origin("https://host/no_ranges", b"no_ranges", ranges=False)
+    check_full_download("https://host/no_ranges", b"no_ranges")
+    assert "https://host/no_ranges.chunks.json" not in [c.request.url for c in responses.calls]
+
+    # Invalid indexes
+    add_origin("https://host/invalid", b"invalid", index={"chunks": []})
+    check_full_download("https://host/invalid", b"invalid")
+
+    # Indexes not matching the artifact
+    add_origin("https://host/wrong_digest", b"wrong_digest",
+               index={"sha256": sha256(b"other"), "size": 12, "chunks": [[sha256(b"wrong_digest"), 12]]})
+    check_full_download("https://host/wrong_digest", b"wrong_digest")
+    assert sha256(b"other") not in cache.chunks
+    assert f"chunks/{sha256(b'wrong_digest')}" not in minio.objects
+
+    add_origin("https://host/wrong_chunk", b"wrong_chunk",
+               index={"sha256": sha256(b"wrong_chunk"), "size": 11, "chunks": [[sha256(b"other"), 11]]})
+    check_full_download("https://host/wrong_chunk", b"wrong_chunk")
+
+    # Artifacts modified while fetching their chunks
+    bodies = [b"modified1", b"modified2"]
+
+    def serve_modified(request):
+        data = bodies.pop(0) if len(bodies) > 1 else bodies[0]
+        return (200, {"ETag": f'"{data.decode()}"', "Accept-Ranges": "bytes"}, data)
+
+    responses.add_callback(responses.GET, "https://host/modified", callback=serve_modified)
+    responses.add(responses.GET, "https://host/modified.chunks.json",
+                  json={"sha256": sha256(b"modified1"), "size": 9, "chunks": [[sha256(b"modified1"), 9]]})
+    check_full_download("https://host/modified", b"modified2")
+
+
+@patch("server.artifactcache.logger")
+def test_BootArtifactCache__invalid_index(logger_mock):
+    minio = FakeMinio(objects={BootArtifactCache.INDEX_OBJECT_NAME: b"invalid"})
+    cache = BootArtifactCache(minio=minio)
+
+    assert cache.artifacts == {}
+    logger_mock.error.assert_called_once()
+
+
+def test_BootArtifactCache__single_flight():
+    cache = BootArtifactCache(minio=FakeMinio(), max_size=1000)
+
+    download_started = Event()
+    download_done = Event()
+    downloads = []
+
+    def download(url, cached=None, in_flight=None):
+        downloads.append(url)
+        download_started.set()
+        download_done.wait()
+        return CachedArtifact(url=url, digest="1234", size=42)
+
+    cache._download = download
+    cache._materialize = lambda digest: None
+
+    results = []
+    threads = [Thread(target=lambda: results.append(cache.acquire("https://host/kernel"))) for _ in range(4)]
+    threads[0].start()
+    download_started.wait()
+    for t in threads[1:]:
+        t.start()
+
+    # Give some time for the other threads to join the download
+    time.sleep(0.1)
+    download_done.set()
+    for t in threads:
+        t.join()
+
+    assert downloads == ["https://host/kernel"]
+    assert results == ["http://minio/boot/cas/1234"] * 4
+    assert cache.is_cached("https://host/kernel")
+    assert cache._in_use == {"1234": 4}
+    assert cache._in_flight == {}
+
+
+def test_BootArtifactCache__single_flight_errors():
+    cache = BootArtifactCache(minio=FakeMinio(), max_size=1000)
+    cache._download = lambda url, cached=None, in_flight=None: 1 / 0
+
+    with pytest.raises(ZeroDivisionError):
+        cache.acquire("https://host/kernel")
+    assert cache._in_flight == {}
+
+
+class LockCheckingMinio(FakeMinio):
+    # Makes sure the cache does not hold its lock while waiting for MinIO
+    cache = None
+
+    def boot_artifact_exists(self, object_name):
+        assert not self.cache._lock.locked()
+        return super().boot_artifact_exists(object_name)
+
+    def save_boot_artifact(self, object_name, data, length=None):
+        assert not self.cache._lock.locked()
+        return super().save_boot_artifact(object_name, data, length=length)
+
+    def load_boot_artifact(self, object_name):
+        assert not self.cache._lock.locked()
+        return super().load_boot_artifact(object_name)
+
+    def remove_boot_artifact(self, object_name):
+        assert not self.cache._lock.locked()
+        return super().remove_boot_artifact(object_name)
+
+
+@responses.activate
+def test_BootArtifactCache__no_minio_io_under_the_lock():
+    minio = LockCheckingMinio()
+    cache = minio.cache = BootArtifactCache(minio=minio, max_size=1000)
+    digest = sha256(b"kernel")
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel", headers={"ETag": '"v1"'})
+    local_url = cache.acquire("https://host/kernel")
+
+    # Make the cache check MinIO for the full copy of the artifact
+    with cache._lock:
+        cache.chunks.pop(digest)
+    responses.replace(responses.GET, "https://host/kernel", status=304)
+    assert cache.acquire("https://host/kernel") == local_url
+    assert cache.acquire("https://mirror/kernel", sha256=digest) == local_url
+    assert json.loads(minio.objects[BootArtifactCache.INDEX_OBJECT_NAME])["artifacts"].keys() == \
+        {"https://host/kernel", "https://mirror/kernel"}
+
+    # Evicted artifacts get removed from MinIO after releasing the lock
+    for _ in range(3):
+        cache.release(local_url)
+    cache.max_size = 0
+    responses.add(responses.GET, "https://host/initrd", body=b"initrd")
+    initrd_url = cache.acquire("https://host/initrd")
+    assert f"cas/{digest}" not in minio.objects
+    assert cache.artifacts.keys() == {"https://host/initrd"}
+
+    # ... as does loading the index
+    cache2 = minio.cache = BootArtifactCache(minio=minio, max_size=1000)
+    assert cache2.acquire(initrd_url) == initrd_url
+    assert cache2.is_cached("https://host/initrd")
+
+
+def test_BootArtifactCache__removed_objects_stored_again_are_kept():
+    minio = FakeMinio(objects={"cas/1234": b"data", "cas/1234.gzip": b"gz", "chunks/5678": b"chunk"})
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    # The objects got stored again between their eviction and their removal
+    with cache._lock:
+        cache.materialized.add("1234")
+        cache.variants["1234"] = {"gzip": 2}
+        cache.chunks["1234"] = [("5678", 5)]
+    cache._remove_objects(["cas/1234", "cas/1234.gzip", "chunks/5678", "cas/4321", "chunks/8765"])
+    assert set(minio.objects) == {"cas/1234", "cas/1234.gzip", "chunks/5678"}
+
+    with cache._lock:
+        removals = cache._forget("1234")
+    cache._remove_objects(removals)
+    assert minio.objects == {}
+
+
+@responses.activate
+def test_BootArtifactCache__evicted_while_checking_minio():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+    digest = sha256(b"kernel")
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel", headers={"ETag": '"v1"'})
+    cache.release(cache.acquire("https://host/kernel"))
+
+    def check_then_evict(object_name):
+        del minio.boot_artifact_exists
+        exists = minio.boot_artifact_exists(object_name)
+        with cache._lock:
+            removals = cache._forget(digest)
+        cache._remove_objects(removals)
+        return exists
+
+    for kwargs in [{"sha256": digest}, {}]:
+        # Only keep the full copy of the artifact, which gets evicted right after we checked it exists
+        with cache._lock:
+            cache.chunks.pop(digest)
+        minio.boot_artifact_exists = check_then_evict
+
+        # The artifact gets downloaded again, without revalidation
+        calls = len(responses.calls)
+        assert cache.acquire("https://host/kernel", **kwargs) == f"http://minio/boot/cas/{digest}"
+        assert len(responses.calls) == calls + 1
+        assert "If-None-Match" not in responses.calls[-1].request.headers
+        cache.release(f"http://minio/boot/cas/{digest}")
+
+    assert not cache._is_available("1234")
+
+
+def test_BootArtifactCache__stale_index_snapshots():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+
+    with cache._lock:
+        old = cache._snapshot_index()
+        cache.variants["1234"] = {"gzip": 42}
+        new = cache._snapshot_index()
+
+    # Snapshots saved out of order never overwrite newer ones
+    cache._save_index(new)
+    cache._save_index(old)
+    assert json.loads(minio.objects[BootArtifactCache.INDEX_OBJECT_NAME])["variants"] == {"1234": {"gzip": 42}}
+    assert minio.saved == [BootArtifactCache.INDEX_OBJECT_NAME]
+
+
+def test_BootArtifactCache__lift_bandwidth_limit():
+    cache = BootArtifactCache(minio=FakeMinio(), max_size=1000)
+
+    download_started = Event()
+    download_done = Event()
+    in_flights = []
+
+    def download(url, cached=None, in_flight=None):
+        in_flights.append(in_flight)
+        download_started.set()
+        download_done.wait()
+        return CachedArtifact(url=url, digest="1234", size=42)
+
+    cache._download = download
+    cache._materialize = lambda digest: None
+
+    prefetch = Thread(target=cache.acquire, args=("https://host/kernel",), kwargs={"max_bandwidth": 1000})
+    prefetch.start()
+    download_started.wait()
+    assert in_flights[0].max_bandwidth == 1000
+
+    # Other prefetches do not lift the limit
+    other_prefetch = Thread(target=cache.acquire, args=("https://host/kernel",), kwargs={"max_bandwidth": 42})
+    other_prefetch.start()
+    time.sleep(0.1)
+    assert in_flights[0].max_bandwidth == 1000
+
+    # Jobs do
+    job = Thread(target=cache.acquire, args=("https://host/kernel",))
+    job.start()
+    time.sleep(0.1)
+    assert in_flights[0].max_bandwidth is None
+
+    download_done.set()
+    for t in [prefetch, other_prefetch, job]:
+        t.join()
+    assert len(in_flights) == 1
+
+
+# Prefetching
+
+
+def test_PrefetchRequest():
+    cache = BootArtifactCache(minio=FakeMinio(), max_size=1000)
+    request = PrefetchRequest(cache, "https://host/kernel", sha256="1234")
+
+    assert request.url == "https://host/kernel"
+    assert request.sha256 == "1234"
+    assert request.state == PrefetchState.QUEUED
+    assert request.error_msg is None
+    assert request.created_at == request.updated_at
+    assert request.is_pending
+    assert not request.is_cached
+
+    request.set_state(PrefetchState.FAILED, error_msg="error")
+    assert request.state == PrefetchState.FAILED
+    assert request.error_msg == "error"
+    assert not request.is_pending
+
+
+@patch("server.artifactcache.MinioClient")
+def test_ArtifactPrefetcher__defaults(minio_mock):
+    prefetcher = ArtifactPrefetcher()
+
+    assert prefetcher.max_bandwidth == int(config.EXECUTOR_ARTIFACT_PREFETCH_BANDWIDTH)
+    assert prefetcher.requests == []
+    assert prefetcher.daemon
+
+
+def test_ArtifactPrefetcher__prefetch():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+    prefetcher = ArtifactPrefetcher(cache=cache, max_bandwidth=0)
+    prefetcher.HISTORY_SIZE = 2
+
+    # Requests for the same pending artifact get merged
+    request1 = prefetcher.prefetch("https://host/kernel", sha256="1234")
+    assert prefetcher.prefetch("https://host/kernel") == request1
+    assert prefetcher.requests == [request1]
+
+    # Completed requests can be made again
+    request1.set_state(PrefetchState.WARM)
+    request2 = prefetcher.prefetch("https://host/kernel")
+    assert request2 != request1
+    assert prefetcher.requests == [request2]
+
+    # Only the most recent completed requests are kept
+    request2.set_state(PrefetchState.WARM)
+    request3 = prefetcher.prefetch("https://host/initrd")
+    request3.set_state(PrefetchState.WARM)
+    request4 = prefetcher.prefetch("https://host/other")
+    assert prefetcher.requests == [request3, request4]
+
+
+@responses.activate
+def test_ArtifactPrefetcher__process():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+    prefetcher = ArtifactPrefetcher(cache=cache, max_bandwidth=0)
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel")
+    request = prefetcher.prefetch("https://host/kernel")
+    prefetcher.process(request)
+    assert request.state == PrefetchState.WARM
+    assert request.is_cached
+
+    # Prefetched artifacts can be evicted
+    assert cache._in_use == {}
+
+    # Failures are reported
+    responses.add(responses.GET, "https://host/initrd", status=404)
+    request = prefetcher.prefetch("https://host/initrd")
+    prefetcher.process(request)
+    assert request.state == PrefetchState.FAILED
+    assert "404" in request.error_msg
+    assert not request.is_cached
+
+
+@responses.activate
+def test_ArtifactPrefetcher__run():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=1000)
+    prefetcher = ArtifactPrefetcher(cache=cache)
+    prefetcher.start()
+
+    responses.add(responses.GET, "https://host/kernel", body=b"kernel")
+    request = prefetcher.prefetch("https://host/kernel")
+
+    while request.is_pending:
+        time.sleep(0.01)
+    assert request.state == PrefetchState.WARM
+
+    # Wait for the queue to time out before stopping
+    time.sleep(1.1)
+    prefetcher.stop_event.set()
+    prefetcher.join()
+
+
+# Variants
+
+
+@responses.activate
+@patch.dict("server.compression.COMPRESSORS", {"gzip": ["gzip", "-c"]})
+def test_BootArtifactCache__variants():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=100000)
+
+    data = b"initramfs" * 1000
+    xz_data = lzma.compress(data)
+    digest = sha256(xz_data)
+    responses.add(responses.GET, "https://host/initramfs.xz", body=xz_data)
+    responses.add(responses.GET, "https://host/initramfs.gz", body=gzip.compress(data))
+
+    # Non-cached artifacts are left untouched
+    assert cache.acquire_variant("http://minio/boot/initramfs", "gzip") == "http://minio/boot/initramfs"
+
+    # Generate the variant
+    local_url = cache.acquire("https://host/initramfs.xz")
+    variant_url = cache.acquire_variant(local_url, "gzip")
+    assert variant_url == f"http://minio/boot/cas/{digest}.gzip"
+    assert gzip.decompress(minio.objects[f"cas/{digest}.gzip"]) == data
+    assert cache.variants == {digest: {"gzip": len(minio.objects[f"cas/{digest}.gzip"])}}
+    assert cache.size == 2 * len(xz_data) + len(minio.objects[f"cas/{digest}.gzip"])
+
+    # Variants are only generated once
+    minio.saved.clear()
+    assert cache.acquire_variant(local_url, "gzip") == variant_url
+    assert minio.saved == []
+
+    # Artifacts already using the format are used directly
+    gz_url = cache.acquire("https://host/initramfs.gz")
+    assert cache.acquire_variant(gz_url, "gzip") == gz_url
+    assert cache.acquire_variant(gz_url, "gzip") == gz_url
+
+    # The variants are part of the index
+    cache2 = BootArtifactCache(minio=minio, max_size=100000)
+    assert cache2.variants == cache.variants
+
+    # Releasing the variant releases the original
+    cache.release(variant_url)
+    cache.release(gz_url)
+    assert cache._in_use == {}
+
+    # Evicting the artifact evicts its variants
+    cache.max_size = 0
+    with cache._lock:
+        removals = cache._evict()
+    cache._remove_objects(removals)
+    assert cache.variants == {}
+    assert set(minio.objects) == {BootArtifactCache.INDEX_OBJECT_NAME}
+
+
+@responses.activate
+@patch.dict("server.compression.COMPRESSORS", {"gzip": ["gzip", "-c"]})
+def test_BootArtifactCache__variants_failure():
+    minio = FakeMinio()
+    cache = BootArtifactCache(minio=minio, max_size=100000)
+
+    responses.add(responses.GET, "https://host/initramfs.xz", body=lzma.compress(b"initramfs")[:-10])
+    local_url = cache.acquire("https://host/initramfs.xz")
+
+    with pytest.raises(ValueError):
+        cache.acquire_variant(local_url, "gzip")
+    assert cache.variants == {}
+    assert cache._in_flight == {}
+    assert not any([name.endswith(".gzip") for name in minio.objects])
+
+    # Nothing to clean up if the upload did not start
+    with patch("server.artifactcache.recompressed", side_effect=ValueError("error")):
+        with pytest.raises(ValueError):
+            cache.acquire_variant(local_url, "gzip")
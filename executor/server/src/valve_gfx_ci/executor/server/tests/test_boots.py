@@ -214,6 +214,19 @@ def test_ipxe_boot_script(mock_provisioner, mock_dnsmasq, tmp_path):
     service._gen_ipxe_boot_script.assert_called_once_with(machine.executor.boot_config_query(),
                                                           platform=platform)
 
+    # Check that machines in hot standby get the polling script when no jobs are set
+    service._gen_ipxe_boot_script = MagicMock()
+    service._gen_ipxe_standby_script = MagicMock()
+    machine.executor.boot_config_query.return_value = None
+    machine.executor.hot_standby = True
+    assert service.ipxe_boot_script(machine=machine) == service._gen_ipxe_standby_script.return_value
+    service._gen_ipxe_boot_script.assert_not_called()
+
+    # Check that machines not in hot standby get the default boot configuration
+    machine.executor.hot_standby = False
+    service.ipxe_boot_script(machine=machine)
+    service._gen_ipxe_boot_script.assert_called_once_with(service.default_boot_config, platform=None)
+
 
 def test_platform_cmdline():
     assert BootService._platform_cmdline() == "initrd=initrd"
@@ -227,3 +240,9 @@ def test_gen_ipxe_boot_script():
     assert "kernel /kernel platform_args cmdline\n" in script
     assert "initrd --name initrd /initrd\n" in script
     assert "boot\n" in script
+
+
+def test_gen_ipxe_standby_script():
+    script = BootService._gen_ipxe_standby_script(poll_period=3)
+    assert "sleep 3\n" in script
+    assert "chain --replace --autofree boot.ipxe?platform=${platform}&buildarch=${buildarch} || goto poll\n" in script
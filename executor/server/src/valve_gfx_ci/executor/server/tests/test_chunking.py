@@ -0,0 +1,89 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from server import chunking
+from server.chunking import ChunkIndex, content_defined_chunks, split_chunks, CHUNK_MIN_SIZE, CHUNK_MAX_SIZE
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def blocks(data, size=100000):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def test_content_defined_chunks():
+    data = os.urandom(8 * 1024 * 1024)
+
+    chunks = list(content_defined_chunks(blocks(data)))
+    assert b"".join(chunks) == data
+    assert all([CHUNK_MIN_SIZE <= len(c) <= CHUNK_MAX_SIZE for c in chunks[:-1]])
+    assert len(chunks) > 8
+
+    # The boundaries do not depend on how the data is being received
+    assert list(content_defined_chunks(blocks(data, size=12345))) == chunks
+
+    # Inserting data only affects the chunk it was inserted into
+    pos = len(chunks[0]) + len(chunks[1]) // 2
+    modified = list(content_defined_chunks(blocks(data[:pos] + b"hello world" + data[pos:])))
+    assert len(set(modified) - set(chunks)) == 1
+
+    # Data made only of marked bytes gets split at the minimum size, the others at the maximum size
+    marked = [b for b in range(256) if chunking._BOUNDARY_TABLE[b] == ord("1")]
+    unmarked = [b for b in range(256) if chunking._BOUNDARY_TABLE[b] == ord("0")]
+    sizes = [len(c) for c in content_defined_chunks([bytes([marked[0]]) * (2 * CHUNK_MIN_SIZE + 10)])]
+    assert sizes == [CHUNK_MIN_SIZE, CHUNK_MIN_SIZE, 10]
+    sizes = [len(c) for c in content_defined_chunks([bytes([unmarked[0]]) * (CHUNK_MAX_SIZE + 10)])]
+    assert sizes == [CHUNK_MAX_SIZE, 10]
+
+    assert list(content_defined_chunks([])) == []
+
+
+def test_split_chunks():
+    assert list(split_chunks([b"hel", b"lo wor", b"ld"], [2, 5, 4])) == [b"he", b"llo w", b"orld"]
+
+    with pytest.raises(ValueError) as exc:
+        list(split_chunks([b"hello"], [2, 5]))
+    assert "Got 3 bytes when expecting a chunk of 5 bytes" in str(exc.value)
+
+
+def test_ChunkIndex():
+    data = os.urandom(3 * 1024 * 1024)
+
+    index = ChunkIndex.from_stream(io.BytesIO(data))
+    assert index.sha256 == sha256(data)
+    assert index.size == len(data)
+    assert index.chunks == [(sha256(c), len(c)) for c in content_defined_chunks([data])]
+
+    offsets = list(index.offsets)
+    assert [o for o, _, _ in offsets] == [sum([s for _, s in index.chunks[:i]]) for i in range(len(index.chunks))]
+    for offset, digest, size in offsets:
+        assert sha256(data[offset:offset+size]) == digest
+
+    # Serialization
+    assert ChunkIndex.from_dict(index.to_dict()) == index
+    assert ChunkIndex.from_dict({"sha256": "ABCD", "size": "3", "chunks": [["EF", 1], ["01", "2"]]}) == \
+        ChunkIndex(sha256="abcd", size=3, chunks=[("ef", 1), ("01", 2)])
+
+
+@pytest.mark.parametrize("data", [
+    None,
+    {},
+    {"sha256": "abcd", "size": 3},
+    {"sha256": "abcd", "size": 3, "chunks": [["ef"]]},
+    {"sha256": "abcd", "size": "three", "chunks": []},
+])
+def test_ChunkIndex__invalid(data):
+    with pytest.raises(ValueError) as exc:
+        ChunkIndex.from_dict(data)
+    assert "Invalid chunk index" in str(exc.value)
+
+
+def test_ChunkIndex__size_mismatch():
+    with pytest.raises(ValueError) as exc:
+        ChunkIndex.from_dict({"sha256": "abcd", "size": 3, "chunks": [["ef", 2]]})
+    assert "The size of the chunks does not match the size of the artifact" in str(exc.value)
@@ -0,0 +1,84 @@
+from unittest.mock import patch
+import gzip
+import os
+import lzma
+import io
+
+import pytest
+
+from server.compression import detect_compression, decompressed, recompressed, PrefixedStream, HEADER_SIZE
+
+
+def test_detect_compression():
+    assert detect_compression(lzma.compress(b"hello")) == "xz"
+    assert detect_compression(gzip.compress(b"hello")) == "gzip"
+    assert detect_compression(b"BZh91AY") == "bzip2"
+    assert detect_compression(b"\x28\xb5\x2f\xfd\x00") == "zstd"
+    assert detect_compression(b"\x02\x21\x4c\x18\x00") == "lz4"
+    assert detect_compression(b"070701") is None
+    assert detect_compression(b"") is None
+
+
+def recompress(data, codec):
+    src = io.BytesIO(data)
+    with recompressed(src, codec, header=src.read(HEADER_SIZE), chunk_size=3) as stream:
+        return stream.read()
+
+
+@patch.dict("server.compression.COMPRESSORS", {"gzip": ["gzip", "-c"]})
+def test_recompressed():
+    data = b"hello world" * 1000
+
+    # From a compressed source
+    assert gzip.decompress(recompress(lzma.compress(data), "gzip")) == data
+
+    # From an uncompressed source
+    assert gzip.decompress(recompress(data, "gzip")) == data
+
+
+@patch.dict("server.compression.COMPRESSORS", {"gzip": ["gzip", "-c"]})
+def test_recompressed__invalid_source():
+    with pytest.raises(ValueError) as exc:
+        recompress(lzma.compress(b"hello world")[:-10], "gzip")
+    assert "The command 'xz -dc' failed with the exit code" in str(exc.value)
+
+
+@patch.dict("server.compression.COMPRESSORS", {"gzip": ["gzip", "-c"]})
+def test_recompressed__consumer_failure():
+    # Make the source bigger than the pipe's buffer, so that the feeder is still running
+    src = io.BytesIO(os.urandom(16 * 1024 * 1024))
+    with pytest.raises(ZeroDivisionError):
+        with recompressed(src, "gzip", header=src.read(HEADER_SIZE)):
+            1 / 0
+
+
+def test_recompressed__unsupported_codec():
+    with pytest.raises(ValueError) as exc:
+        with recompressed(io.BytesIO(b""), "brotli"):
+            pass  # pragma: nocover
+    assert "Unsupported compression format 'brotli'" in str(exc.value)
+
+
+def test_PrefixedStream():
+    stream = PrefixedStream(b"head", io.BytesIO(b"er and body"))
+    assert stream.read(2) == b"he"
+    assert stream.read(4) == b"ad"
+    assert stream.read(3) == b"er "
+    assert stream.read() == b"and body"
+
+    assert PrefixedStream(b"head", io.BytesIO(b"er")).read() == b"header"
+
+
+def test_decompressed():
+    data = b"hello world" * 1000
+    src = io.BytesIO(lzma.compress(data))
+
+    with decompressed(src, header=src.read(HEADER_SIZE)) as f:
+        assert f.read() == data
+
+
+def test_decompressed__unknown_format():
+    with pytest.raises(ValueError) as exc:
+        with decompressed(io.BytesIO(b""), header=b"hello"):
+            pass  # pragma: nocover
+    assert "Unknown compression format" in str(exc.value)
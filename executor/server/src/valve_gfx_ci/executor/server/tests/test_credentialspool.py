@@ -0,0 +1,162 @@
+from unittest.mock import MagicMock, call
+
+import time
+
+from server.credentialspool import CredentialsPool
+import server.config as config
+
+
+def test_CredentialsPool__user_names():
+    pool = CredentialsPool(MagicMock(), "52:54:00:11:22:0a")
+    assert len(pool.user_names) == int(config.EXECUTOR_CREDENTIALS_POOL_SIZE)
+
+    pool = CredentialsPool(MagicMock(), "52:54:00:11:22:0a", size=2)
+    assert pool.user_names == ["pool-52-54-00-11-22-0a-0", "pool-52-54-00-11-22-0a-1"]
+
+    # Nothing is ready until the users got recycled
+    assert pool.get() is None
+
+
+def test_CredentialsPool__recycle():
+    minio = MagicMock()
+    minio.groups_user_is_in.return_value = ["group1", "group2"]
+    pool = CredentialsPool(minio, "machine", size=1)
+
+    pool.recycle("pool-machine-0")
+
+    # The secret key got rotated, and the user removed from its groups
+    user_name, password = pool.get()
+    assert user_name == "pool-machine-0"
+    minio.add_user.assert_called_once_with("pool-machine-0", password)
+    minio.unset_user_policy.assert_called_once_with("pool-machine-0")
+    minio.remove_user_from_group.assert_has_calls([call("pool-machine-0", "group1"),
+                                                   call("pool-machine-0", "group2")])
+    assert pool.get() is None
+
+    # Recycling again generates a new secret key
+    pool.recycle("pool-machine-0")
+    assert pool.get()[1] != password
+
+
+def test_CredentialsPool__recycle__already_revoked():
+    minio = MagicMock()
+    pool = CredentialsPool(minio, "machine", size=1)
+
+    pool.recycle("pool-machine-0", revoked=True)
+
+    # Only the secret key got rotated
+    user_name, password = pool.get()
+    minio.add_user.assert_called_once_with("pool-machine-0", password)
+    minio.unset_user_policy.assert_not_called()
+    minio.groups_user_is_in.assert_not_called()
+
+
+def test_CredentialsPool__release():
+    minio = MagicMock()
+    minio.groups_user_is_in.return_value = ["group1"]
+    pool = CredentialsPool(minio, "machine", size=1)
+    pool._recycle.get_nowait()
+
+    # Only the users of the pool can be released
+    assert not pool.release("job-user")
+    assert pool._recycle.empty()
+
+    # The accesses of the previous job get revoked right away, the secret key gets rotated in the background
+    assert pool.release("pool-machine-0")
+    minio.unset_user_policy.assert_called_once_with("pool-machine-0")
+    minio.remove_user_from_group.assert_called_once_with("pool-machine-0", "group1")
+    minio.add_user.assert_not_called()
+    assert pool._recycle.get_nowait() == ("pool-machine-0", True)
+    assert pool.get() is None
+
+
+def test_CredentialsPool__release__failing_revoke():
+    minio = MagicMock()
+    minio.groups_user_is_in.return_value = ["group1"]
+    minio.unset_user_policy.side_effect = [ValueError("MinIO is down"), None]
+    pool = CredentialsPool(minio, "machine", size=1)
+    pool._recycle.get_nowait()
+
+    # The user is not ready until its accesses got revoked
+    assert pool.release("pool-machine-0")
+    minio.remove_user_from_group.assert_not_called()
+    assert pool.get() is None
+
+    # ... which the recycling tries again
+    user_name, revoked = pool._recycle.get_nowait()
+    assert (user_name, revoked) == ("pool-machine-0", False)
+    pool.recycle(user_name, revoked=revoked)
+
+    assert minio.unset_user_policy.call_count == 2
+    minio.remove_user_from_group.assert_called_once_with("pool-machine-0", "group1")
+    assert pool.get()[0] == "pool-machine-0"
+
+
+def test_CredentialsPool__run():
+    minio = MagicMock()
+    minio.groups_user_is_in.return_value = []
+    minio.add_user.side_effect = [ValueError("MinIO is down"), None, None]
+
+    pool = CredentialsPool(minio, "machine", size=1)
+    pool.RETRY_DELAY = 0
+    pool.start()
+
+    # The user gets recycled in the background, even after failures
+    while (credentials := pool.get()) is None:
+        time.sleep(0.01)
+    assert credentials[0] == "pool-machine-0"
+
+    pool.release(credentials[0])
+    while (new_credentials := pool.get()) is None:
+        time.sleep(0.01)
+    assert new_credentials[0] == "pool-machine-0"
+    assert minio.add_user.call_count == 3
+
+    # Wait for the queue to time out before stopping
+    time.sleep(1.1)
+    pool.stop_event.set()
+    pool.join()
+
+
+class FakeMinio:
+    # Rejects the operations on users that do not exist, like MinIO does
+    def __init__(self):
+        self.users = dict()
+
+    def _check_user(self, user_name):
+        if user_name not in self.users:
+            raise ValueError(f"The specified user does not exist: {user_name}")
+
+    def add_user(self, user_name, password):
+        self.users.setdefault(user_name, {"groups": set()})["password"] = password
+
+    def unset_user_policy(self, user_name):
+        self._check_user(user_name)
+
+    def groups_user_is_in(self, user_name):
+        self._check_user(user_name)
+        return list(self.users[user_name]["groups"])
+
+    def remove_user_from_group(self, user_name, group_name):
+        self._check_user(user_name)
+        self.users[user_name]["groups"].discard(group_name)
+
+
+def test_CredentialsPool__run__fresh_minio():
+    minio = FakeMinio()
+    pool = CredentialsPool(minio, "machine", size=2)
+    pool.start()
+
+    # The users get created, rather than failing to be revoked
+    try:
+        ready = set()
+        while len(ready) < 2:
+            if (credentials := pool.get()) is None:
+                time.sleep(0.01)
+                continue
+            ready.add(credentials)
+    finally:
+        pool.stop_event.set()
+        pool.join()
+
+    assert ready == {(name, minio.users[name]["password"]) for name in pool.user_names}
@@ -0,0 +1,362 @@
+from datetime import datetime, timedelta
+from threading import Barrier, Event
+from unittest.mock import MagicMock, patch, call
+
+import pytest
+
+import server.executor
+from server.executor import Executor, JobBucket, JobConsole, JobConsoleState, JobTeardown
+from server.garbagecollector import GarbageCollector
+from server.job import Job, Timeout
+from server.message import JobStatus, LogLevel
+from server.pdu import PDUState
+from server.standby import HotStandbyBudget
+
+
+WARM_REBOOT_JOB = """
+version: 1
+target:
+  id: "m1"
+timeouts:
+  first_console_activity:
+    milliseconds: 300
+    retries: 1
+  boot_cycle:
+    minutes: 1
+    retries: 2
+console_patterns:
+  session_end:
+    regex: "session_end"
+  session_reboot:
+    regex: "reboot_me"
+deployment:
+  start:
+    kernel:
+      url: "http://remote/kernel"
+      cmdline: "cmdline"
+  continue:
+    kernel:
+      url: "http://remote/kernel"
+      cmdline: "cmdline"
+    warm_reboot: "kexec {kernel_url}"
+"""
+
+
+# JobConsole
+
+
+def create_job_console():
+    job = Job.from_job(WARM_REBOOT_JOB)
+    with patch.object(JobConsole, "connect_to_salad", return_value=MagicMock()):
+        return JobConsole("m1", client_endpoint=None, console_patterns=job.console_patterns)
+
+
+def test_JobConsole__echo_of_typed_commands_is_not_activity():
+    console = create_job_console()
+
+    # Power-up garbage is not activity, a full line is
+    assert not console.match_console_patterns(b"\x00\xff")
+    assert console.match_console_patterns(b"Linux version\r\n")
+
+    # The echo of the command, prefixed by a prompt and split across reads, is not activity
+    console.reset_per_boot_state()
+    console.match_console_patterns(b"root@dut:~# ")
+    console.type_command("kexec http://cache/kernel")
+    console.salad_sock.send.assert_called_once_with(b"kexec http://cache/kernel\n")
+    assert not console.match_console_patterns(b"kexec http://cache")
+    assert not console.match_console_patterns(b"/kernel\r\n")
+
+    # What comes after it is
+    assert console.match_console_patterns(b"Linux version\r\n")
+
+    # A new boot forgets about the echo we were waiting for
+    console.type_command("kexec http://cache/kernel")
+    console.reset_per_boot_state()
+    assert console.match_console_patterns(b"Linux version\r\n")
+
+
+# Executor
+
+
+class FakeJobConsole:
+    # Simulates a DUT which asks to reboot at the end of its first boot, ignores the warm reboot command, then
+    # completes the job after getting power cycled
+    def __init__(self):
+        self.boots = 0
+        self.typed_commands = []
+        self.state = JobConsoleState.ACTIVE
+        self.needs_reboot = False
+        self.last_activity_from_machine = None
+        self.log = MagicMock()
+
+    def reset_per_boot_state(self):
+        self.boots += 1
+        self.needs_reboot = False
+        self.last_activity_from_machine = None
+
+        if self.boots == 1:
+            self.last_activity_from_machine = datetime.now()
+            self.needs_reboot = True
+        elif self.boots == 3:
+            self.last_activity_from_machine = datetime.now()
+            self.state = JobConsoleState.DUT_DONE
+
+    def type_command(self, cmd):
+        self.typed_commands.append(cmd)
+
+    def set_state(self, state):
+        self.state = state
+
+
+def create_executor(job_console):
+    executor = Executor.__new__(Executor)
+    executor.machine = MagicMock()
+    executor.stop_event = Event()
+    executor.cancel_job = Event()
+    executor.hot_standby = False
+    executor.job_console = job_console
+    executor.job_config = Job.from_job(WARM_REBOOT_JOB)
+    executor.remote_url_to_local_cache_mapping = {"http://remote/kernel": "http://cache/kernel"}
+    return executor
+
+
+def test_Executor_boot_loop__warm_reboot_falls_back_to_a_power_cycle():
+    job_console = FakeJobConsole()
+    executor = create_executor(job_console)
+    timeouts = executor.job_config.timeouts
+
+    executor._boot_loop(timeouts)
+
+    # The DUT got asked to reboot by itself once, without cutting its power
+    assert job_console.typed_commands == ["kexec http://cache/kernel"]
+    assert executor.machine.pdu_port.set.call_args_list == [
+        # First boot, ending with the DUT asking for a reboot
+        call(PDUState.OFF), call(PDUState.ON),
+        # Warm reboot, which never showed any console activity
+        call(PDUState.OFF),
+        # Power cycle, followed by the end of the job
+        call(PDUState.OFF), call(PDUState.ON), call(PDUState.OFF),
+        call(PDUState.OFF),
+    ]
+
+    assert job_console.boots == 3
+    assert timeouts.first_console_activity.retried == 1
+    assert timeouts.boot_cycle.retried == 1
+
+
+def test_Executor_boot_loop__no_warm_reboot_when_exceeding_the_boot_cycle_limit():
+    job_console = FakeJobConsole()
+    executor = create_executor(job_console)
+    timeouts = executor.job_config.timeouts
+    timeouts.boot_cycle.retries = 0
+
+    executor._boot_loop(timeouts)
+
+    assert job_console.typed_commands == []
+    assert job_console.state == JobConsoleState.DUT_DONE
+    assert executor.machine.pdu_port.set.call_args_list == [call(PDUState.OFF), call(PDUState.ON),
+                                                            call(PDUState.OFF), call(PDUState.OFF)]
+
+
+# Caching of the boot artifacts
+
+
+ARTIFACTS_JOB = """
+version: 1
+target:
+  id: "m1"
+console_patterns:
+  session_end:
+    regex: "session_end"
+deployment:
+  start:
+    kernel:
+      url: "http://remote/kernel"
+      sha256: "1234"
+      cmdline: "cmdline"
+    initramfs:
+      url: "http://remote/initramfs"
+      recompress: "zstd"
+  continue:
+    initramfs:
+      url: "http://remote/initramfs2"
+"""
+
+
+def create_caching_executor(job_bucket=None):
+    executor = create_executor(job_console=None)
+    executor.job_config = Job.from_job(ARTIFACTS_JOB)
+    executor.job_bucket = job_bucket
+    executor._cache_remote_artifact = MagicMock()
+    return executor
+
+
+def test_Executor_cache_remote_artifacts__deduplicates_the_urls():
+    executor = create_caching_executor()
+
+    executor._cache_remote_artifacts()
+
+    # The kernel is shared by both deployments, and only gets cached once
+    assert sorted(executor._cache_remote_artifact.call_args_list) == [
+        call("http://remote/initramfs", None, "zstd"),
+        call("http://remote/initramfs2", None, "zstd"),
+        call("http://remote/kernel", "1234", None),
+    ]
+
+
+def test_Executor_cache_remote_artifacts__errors_get_raised():
+    def cache_remote_artifact(url, sha256, recompress):
+        if url == "http://remote/kernel":
+            raise ValueError("The kernel is gone")
+
+    job_bucket = MagicMock()
+    executor = create_caching_executor(job_bucket=job_bucket)
+    executor._cache_remote_artifact.side_effect = cache_remote_artifact
+
+    with pytest.raises(ValueError, match="The kernel is gone"):
+        executor._cache_remote_artifacts()
+
+    # ... once all the other tasks are over
+    job_bucket.setup.assert_called_once_with()
+    assert executor._cache_remote_artifact.call_count == 3
+
+    job_bucket.setup.side_effect = ValueError("The tarball is corrupted")
+    executor._cache_remote_artifact.side_effect = None
+    with pytest.raises(ValueError, match="The tarball is corrupted"):
+        executor._cache_remote_artifacts()
+
+
+def test_Executor_cache_remote_artifacts__runs_concurrently_with_the_job_bucket_setup():
+    # All the tasks need to be running at the same time to get past the barrier
+    barrier = Barrier(4, timeout=5)
+    executor = create_caching_executor(job_bucket=MagicMock(setup=lambda: barrier.wait()))
+    executor._cache_remote_artifact.side_effect = lambda url, sha256, recompress: barrier.wait()
+
+    executor._cache_remote_artifacts()
+    assert not barrier.broken
+
+
+# Hot standby
+
+
+def create_standby_executor(off_for=timedelta(minutes=1)):
+    executor = create_executor(job_console=None)
+    executor.boot_config = "config"
+    executor.machine.id = "m1"
+    executor.machine.is_retired = False
+    executor.machine.hot_standby_power = 10
+    executor.machine.pdu_port.min_off_time = 5
+    executor.machine.pdu_port.last_shutdown = datetime.now() - off_for
+    return executor
+
+
+@patch("server.executor.hot_standby_budget", HotStandbyBudget(budget=100))
+def test_Executor_enter_hot_standby():
+    executor = create_standby_executor()
+
+    executor._enter_hot_standby()
+    assert executor.hot_standby
+    assert executor.boot_config is None
+    executor.machine.pdu_port.set.assert_called_once_with(PDUState.ON)
+
+    # Retired machines leave the hot standby, and get powered down
+    executor.machine.is_retired = True
+    executor._enter_hot_standby()
+    assert not executor.hot_standby
+    assert server.executor.hot_standby_budget.machines == set()
+    executor.machine.pdu_port.set.assert_called_with(PDUState.OFF)
+
+
+@patch("server.executor.hot_standby_budget", HotStandbyBudget(budget=100))
+def test_Executor_enter_hot_standby__waits_for_the_minimum_off_time():
+    executor = create_standby_executor(off_for=timedelta(seconds=1))
+
+    executor._enter_hot_standby()
+    assert not executor.hot_standby
+    assert server.executor.hot_standby_budget.machines == set()
+    executor.machine.pdu_port.set.assert_not_called()
+
+
+@patch("server.executor.hot_standby_budget", HotStandbyBudget(budget=100))
+def test_Executor_enter_hot_standby__power_up_failure():
+    executor = create_standby_executor()
+    executor.machine.pdu_port.set.side_effect = ValueError("The PDU is unreachable")
+
+    executor._enter_hot_standby()
+    assert not executor.hot_standby
+    assert server.executor.hot_standby_budget.machines == set()
+
+
+# JobTeardown
+
+
+def run_job_teardown(on_start=None, timeout=timedelta(minutes=1)):
+    job_console = MagicMock(state=JobConsoleState.TEAR_DOWN)
+    job_record = MagicMock()
+    teardown_timeout = Timeout("infra_teardown", timeout, retries=0)
+    teardown_timeout.start()
+
+    teardown = JobTeardown("m1", job_console, job_bucket=MagicMock(), job_record=job_record, status=JobStatus.PASS,
+                           timeout=teardown_timeout, stop_event=Event(), cancel_job=Event())
+    if on_start is not None:
+        on_start(teardown)
+    teardown.start()
+    teardown.join(5)
+
+    assert not teardown.is_alive()
+    job_console.close.assert_called_once_with()
+    job_record.finish.assert_called_once_with(JobStatus.PASS)
+    assert teardown.job_bucket is None
+
+    return teardown
+
+
+def test_JobTeardown__client_closed_the_console():
+    def on_start(teardown):
+        teardown.job_console.state = JobConsoleState.OVER
+
+    teardown = run_job_teardown(on_start=on_start)
+    assert not teardown.timeout.has_expired
+
+
+def test_JobTeardown__timeout():
+    teardown = run_job_teardown(timeout=timedelta(milliseconds=200))
+    assert teardown.timeout.started_at is None
+
+
+def test_JobTeardown__cancelled():
+    def on_start(teardown):
+        teardown.cancel_job.set()
+
+    teardown = run_job_teardown(on_start=on_start)
+    teardown.job_console.log.assert_any_call("The job got cancelled during its tear down\n", LogLevel.WARN)
+
+
+def test_JobTeardown__executor_stopping():
+    def on_start(teardown):
+        teardown.stop_event.set()
+
+    run_job_teardown(on_start=on_start)
+
+
+# JobBucket
+
+
+def test_JobBucket__name_collision_keeps_the_bucket_of_its_owner():
+    minio = MagicMock()
+    gc = GarbageCollector(minio=MagicMock())
+    gc.minio.list_buckets.return_value = ["job-m1-foo"]
+
+    owner = JobBucket(minio, "job-m1-foo", garbage_collector=gc)
+
+    # The next job with the same ID tries to create the bucket, while the previous one is still being torn down
+    minio.make_bucket.side_effect = ValueError("The bucket already exists")
+    with pytest.raises(ValueError):
+        JobBucket(minio, "job-m1-foo", garbage_collector=gc)
+
+    gc.sweep()
+    assert gc.pending_tasks == []
+
+    # The bucket only gets removed once its owner is done with it
+    owner.remove()
+    assert [t.bucket_name for t in gc.pending_tasks] == ["job-m1-foo"]
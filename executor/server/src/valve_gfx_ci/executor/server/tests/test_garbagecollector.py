@@ -0,0 +1,124 @@
+from unittest.mock import MagicMock, patch, call
+
+import time
+
+from server.garbagecollector import GarbageCollector
+from server.minioclient import MinioClient
+import server.config as config
+
+
+def test_GarbageCollector__defaults():
+    gc = GarbageCollector()
+    assert gc.rate_limit == float(config.EXECUTOR_GC_RATE_LIMIT)
+    assert gc.sweep_period == int(config.EXECUTOR_GC_SWEEP_PERIOD)
+
+    with patch("server.minioclient.Minio", autospec=True):
+        assert isinstance(gc.minio, MinioClient)
+
+
+def test_GarbageCollector__removals():
+    minio = MagicMock()
+    gc = GarbageCollector(minio=minio)
+
+    # Removals are only queued
+    gc.remove_bucket("job-bucket")
+    gc.remove_user("job-user")
+    gc.remove_policy("policy_job-user")
+    minio.assert_not_called()
+    assert [t.description for t in gc.pending_tasks] == ["Remove the bucket job-bucket", "Remove the user job-user",
+                                                         "Remove the policy policy_job-user"]
+
+    while (task := gc._next_task(timeout=0)) is not None:
+        gc.process(task)
+
+    minio.remove_bucket.assert_called_once_with("job-bucket")
+    minio.remove_user.assert_called_once_with("job-user")
+    minio.remove_policy.assert_called_once_with("policy_job-user")
+    assert gc.pending_tasks == []
+
+
+def test_GarbageCollector__retries():
+    minio = MagicMock()
+    minio.remove_bucket.side_effect = ValueError("MinIO is down")
+    gc = GarbageCollector(minio=minio)
+    gc.MAX_ATTEMPTS = 3
+
+    now = [1000]
+    with patch("server.garbagecollector.time.monotonic", side_effect=lambda: now[0]):
+        gc.remove_bucket("job-bucket")
+
+        # Failed tasks get re-scheduled later, with an exponential backoff
+        for attempt in range(1, 3):
+            task = gc._next_task(timeout=0)
+            gc.process(task)
+            assert task.attempts == attempt
+            assert task.due_at == now[0] + 2 ** (attempt - 1)
+            assert gc._next_task(timeout=0) is None
+            now[0] = task.due_at
+
+        # Give up after too many attempts
+        gc.process(gc._next_task(timeout=0))
+    assert gc.pending_tasks == []
+    assert minio.remove_bucket.call_count == 3
+
+
+def test_GarbageCollector__buckets_in_use():
+    minio = MagicMock()
+    minio.list_buckets.return_value = ["boot", "jobs", "job-orphan", "job-in-use", "job-reused"]
+    gc = GarbageCollector(minio=minio)
+
+    gc.register_bucket("job-in-use")
+    gc.register_bucket("job-reused")
+    gc.remove_bucket("job-reused")
+
+    # Only the job buckets that are not in use and not already queued get removed
+    gc.sweep()
+    assert [t.bucket_name for t in gc.pending_tasks] == ["job-reused", "job-orphan"]
+
+    # Buckets that got re-used since their removal was queued are left untouched
+    gc.register_bucket("job-reused")
+    while (task := gc._next_task(timeout=0)) is not None:
+        gc.process(task)
+    minio.remove_bucket.assert_called_once_with("job-orphan")
+
+    # Buckets stay in use until all their registrations are gone
+    minio.list_buckets.return_value = ["job-in-use"]
+    gc.register_bucket("job-in-use")
+    gc.unregister_bucket("job-in-use")
+    gc.sweep()
+    assert gc.pending_tasks == []
+    gc.unregister_bucket("job-in-use")
+    gc.unregister_bucket("job-in-use")
+    gc.sweep()
+    assert [t.bucket_name for t in gc.pending_tasks] == ["job-in-use"]
+    gc.process(gc._next_task(timeout=0))
+
+    # Listing failures are ignored
+    minio.list_buckets.side_effect = ValueError("MinIO is down")
+    gc.sweep()
+    assert gc.pending_tasks == []
+
+
+def test_GarbageCollector__run():
+    minio = MagicMock()
+    minio.list_buckets.return_value = ["job-orphan"]
+    gc = GarbageCollector(minio=minio, rate_limit=100, sweep_period=0.5)
+    gc.start()
+
+    # The orphan gets removed by the initial sweep
+    while minio.remove_bucket.call_count == 0:
+        time.sleep(0.01)
+
+    # Queued removals get processed
+    gc.remove_user("job-user")
+    while minio.remove_user.call_count == 0:
+        time.sleep(0.01)
+
+    # Periodic sweeps catch the buckets that got orphaned since then
+    while minio.remove_bucket.call_count < 2:
+        time.sleep(0.01)
+
+    gc.stop_event.set()
+    gc.join()
+
+    assert minio.remove_bucket.call_args_list[:2] == [call("job-orphan")] * 2
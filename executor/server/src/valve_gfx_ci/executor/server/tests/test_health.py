@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+from server.health import JobOutcome, MachineHealth
+from server.job import Timeout, Timeouts
+from server.message import JobStatus
+import server.config as config
+
+
+def test_JobOutcome__score():
+    assert JobOutcome(JobStatus.PASS).score == 1.0
+    assert JobOutcome(JobStatus.FAIL).score == 1.0
+    assert JobOutcome(JobStatus.PASS, boot_retries=1).score == 0.75
+    assert JobOutcome(JobStatus.WARN, boot_retries=1, timeouts_hit=1).score == 0.5
+    assert JobOutcome(JobStatus.COMPLETE, timeouts_hit=10).score == 0.0
+
+    for status in [JobStatus.INCOMPLETE, JobStatus.UNKNOWN, JobStatus.SETUP_FAIL]:
+        assert JobOutcome(status).score == 0.0
+
+
+def test_JobOutcome__from_timeouts():
+    timeouts = Timeouts({
+        "boot_cycle": Timeout(name="boot_cycle", timeout=timedelta(minutes=1), retries=3),
+        "console_activity": Timeout(name="console_activity", timeout=timedelta(minutes=1), retries=3),
+    })
+    timeouts.boot_cycle.retry()
+    timeouts.boot_cycle.retry()
+    timeouts.console_activity.retry()
+
+    outcome = JobOutcome.from_timeouts(JobStatus.PASS, timeouts)
+    assert outcome.status == JobStatus.PASS
+    assert outcome.boot_retries == 2
+    assert outcome.timeouts_hit == 1
+
+
+def test_MachineHealth__defaults():
+    health = MachineHealth()
+
+    assert health.window == int(config.EXECUTOR_HEALTH_WINDOW)
+    assert health.min_samples == int(config.EXECUTOR_HEALTH_MIN_SAMPLES)
+    assert health.retrain_threshold == float(config.EXECUTOR_HEALTH_RETRAIN_THRESHOLD)
+
+    assert health.samples == 0
+    assert health.score == 1.0
+    assert not health.needs_retraining
+
+
+def test_MachineHealth__lifecycle():
+    health = MachineHealth(window=4, min_samples=2, retrain_threshold=0.5)
+
+    health.report(JobOutcome(JobStatus.PASS))
+    health.report(JobOutcome(JobStatus.INCOMPLETE))
+    assert health.samples == 2
+    assert health.score == 0.5
+    assert not health.needs_retraining
+
+    health.report(JobOutcome(JobStatus.INCOMPLETE))
+    assert health.needs_retraining
+
+    # Only the last outcomes should be taken into account
+    for _ in range(4):
+        health.report(JobOutcome(JobStatus.PASS))
+    assert health.samples == 4
+    assert health.score == 1.0
+    assert not health.needs_retraining
+
+    health.reset()
+    assert health.samples == 0
+    assert health.score == 1.0
@@ -51,9 +51,15 @@ def test_Target_from_job__both_id_and_tags():
     target = Target.from_job(target_job)
     assert target.id == target_job['id']
     assert target.tags == target_job['tags']
+    assert target.cache_affinity
     assert str(target) == f"<Target: id={target.id}, tags={target.tags}>"
 
 
+def test_Target_from_job__no_cache_affinity():
+    target = Target.from_job({"tags": [], "cache_affinity": False})
+    assert not target.cache_affinity
+
+
 # Timeout
 
 
@@ -473,6 +479,59 @@ def test_Deployment():
     kernel_cmdline: cmdline>
 """
 
+
+def test_Deployment__container_images():
+    deployment = Deployment()
+    assert deployment.container_images == set()
+
+    deployment.update({"kernel": {"cmdline": ('b2c.container="-ti docker://registry/image:tag check" '
+                                              'b2c.container="docker://registry/other" console=ttyS0')}})
+    assert deployment.container_images == {"registry/image:tag", "registry/other"}
+
+
+def test_Deployment__sha256():
+    deployment = Deployment()
+    assert deployment.kernel_sha256 is None
+    assert deployment.initramfs_sha256 is None
+
+    deployment.update({"kernel": {"url": "kernel_url", "sha256": "kernel_sha"},
+                       "initramfs": {"url": "initrd_url", "sha256": "initrd_sha"}})
+    assert deployment.kernel_sha256 == "kernel_sha"
+    assert deployment.initramfs_sha256 == "initrd_sha"
+
+    # Changing the cmdline keeps the digests
+    deployment.update({"kernel": {"cmdline": "cmdline"}})
+    assert deployment.kernel_sha256 == "kernel_sha"
+
+    # Changing the URLs resets the digests
+    deployment.update({"kernel": {"url": "kernel_url2"}, "initramfs": {"url": "initrd_url2", "sha256": "sha2"}})
+    assert deployment.kernel_sha256 is None
+    assert deployment.initramfs_sha256 == "sha2"
+
+
+def test_Deployment__initramfs_recompress():
+    deployment = Deployment()
+    assert deployment.initramfs_recompress is None
+
+    deployment.update({"initramfs": {"url": "initrd_url", "recompress": "zstd"}})
+    assert deployment.initramfs_recompress == "zstd"
+
+    # The format is kept when only changing the URL
+    deployment.update({"initramfs": {"url": "initrd_url2"}})
+    assert deployment.initramfs_recompress == "zstd"
+
+
+def test_Deployment__warm_reboot_command():
+    deployment = Deployment()
+    assert deployment.warm_reboot is None
+    assert deployment.warm_reboot_command("kernel", "initrd") is None
+
+    deployment.update({"kernel": {"cmdline": "console=ttyS0"},
+                       "warm_reboot": "kexec -l {kernel_url} --initrd={initramfs_url} --append='{kernel_cmdline}' "
+                                      "&& echo ${HOME} && kexec -e"})
+    assert deployment.warm_reboot_command("http://kernel", "http://initrd") == \
+        "kexec -l http://kernel --initrd=http://initrd --append='console=ttyS0' && echo ${HOME} && kexec -e"
+
 # Job
 
 
@@ -539,6 +598,10 @@ deployment:
       cmdline: "my continue cmdline"
     initramfs:
       url: "initramfs_url 2"
+      recompress: lz4
+    warm_reboot:
+      - kexec
+      - -e
 """
     job = Job.from_job(override_job)
 
@@ -556,6 +619,12 @@ deployment:
     assert job.deployment_continue.initramfs_url == "initramfs_url 2"
     assert job.deployment_continue.kernel_cmdline == "my continue cmdline"
 
+    assert job.deployment_start.initramfs_recompress is None
+    assert job.deployment_continue.initramfs_recompress == "lz4"
+
+    assert job.deployment_start.warm_reboot is None
+    assert job.deployment_continue.warm_reboot == "kexec -e"
+
 
 class MockMachine:
     @property
@@ -628,6 +697,10 @@ def test_Job__sample(job_env):
     assert job.deployment_continue.initramfs_url == "testing-url/test-initramfs"
     assert job.deployment_continue.kernel_cmdline == 'b2c.container="docker://10.42.0.1:8001/infra/machine_registration:latest check" b2c.ntp_peer=10.42.0.1 b2c.pipefail b2c.cache_device=auto b2c.container="-v /container/tmp:/storage docker://10.42.0.1:8002/tests/mesa:12345 resume"'  # noqa: E501
 
+    assert job.cache_affinity_keys == {"testing-url/test-kernel", "testing-url/test-initramfs",
+                                       "10.42.0.1:8001/infra/machine_registration:latest",
+                                       "10.42.0.1:8002/tests/mesa:12345"}
+
 
 def test_Job__invalid_format():
     job = """
@@ -656,6 +729,29 @@ deployment:
     assert str(exc.value) == "{'console_patterns': {'reboot': ['Unknown field.']}}"
 
 
+def test_Job__invalid_recompress_format():
+    job = """
+version: 1
+target:
+  id: "b4:2e:99:f0:76:c6"
+console_patterns:
+  session_end:
+    regex: "session_end"
+deployment:
+  start:
+    kernel:
+      url: "kernel_url"
+    initramfs:
+      url: "initramfs_url"
+      recompress: brotli
+"""
+
+    with pytest.raises(ValueError) as exc:
+        Job.from_job(job)
+
+    assert "recompress" in str(exc.value)
+
+
 @patch('server.config.job_environment_vars')
 def test_Job__from_machine(job_env):
     job_env.return_value = {'NTP_PEER': '10.42.0.1'}
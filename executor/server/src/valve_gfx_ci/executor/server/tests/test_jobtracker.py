@@ -0,0 +1,75 @@
+import pytest
+
+from server.jobtracker import JobState, JobRecord, JobTracker, UnknownJobError
+from server.message import JobStatus
+import server.config as config
+
+
+def test_JobRecord__lifecycle():
+    job = JobRecord(name="my-job", machine_id="machine_id")
+
+    assert len(job.id) > 0
+    assert job.name == "my-job"
+    assert job.machine_id == "machine_id"
+    assert job.state == JobState.QUEUED
+    assert job.status is None
+    assert job.error_msg is None
+    assert job.created_at == job.updated_at
+    assert job.console is None
+    assert not job.is_finished
+    assert str(job) == f"<Job {job.id}: name=my-job, machine=machine_id, state=QUEUED>"
+
+    job.set_state(JobState.RUNNING)
+    assert job.state == JobState.RUNNING
+
+    with pytest.raises(ValueError) as exc:
+        job.set_state(JobState.SETUP)
+    assert "The state can only move forward" in str(exc.value)
+
+    job.console = "console"
+    job.finish(JobStatus.SETUP_FAIL, error_msg="error")
+    assert job.is_finished
+    assert job.console is None
+    assert job.status == JobStatus.SETUP_FAIL
+    assert job.error_msg == "error"
+
+    # Finishing a job twice does not change its status
+    job.finish(JobStatus.PASS)
+    assert job.status == JobStatus.SETUP_FAIL
+
+
+def test_JobRecord__custom_id():
+    assert JobRecord(name="name", machine_id="machine_id", job_id="toto").id == "toto"
+
+
+def test_JobTracker__defaults():
+    assert JobTracker().history_size == int(config.EXECUTOR_JOB_HISTORY_SIZE)
+
+
+def test_JobTracker__create_and_get():
+    tracker = JobTracker()
+
+    job = tracker.create(name="name", machine_id="machine_id")
+    assert tracker.get(job.id) == job
+    assert tracker.jobs == [job]
+
+    assert tracker.get("invalid") is None
+    with pytest.raises(UnknownJobError) as exc:
+        tracker.get("invalid", raise_if_missing=True)
+    assert "Unknown job ID 'invalid'" in str(exc.value)
+
+
+def test_JobTracker__history_size():
+    tracker = JobTracker(history_size=2)
+
+    job1 = tracker.create(name="job1", machine_id="machine_id")
+    job2 = tracker.create(name="job2", machine_id="machine_id")
+    job3 = tracker.create(name="job3", machine_id="machine_id")
+
+    # Active jobs are never forgotten
+    assert tracker.jobs == [job1, job2, job3]
+
+    job1.finish(JobStatus.PASS)
+    job2.finish(JobStatus.PASS)
+    job4 = tracker.create(name="job4", machine_id="machine_id")
+    assert tracker.jobs == [job3, job4]
@@ -2,8 +2,9 @@ from unittest.mock import MagicMock
 from datetime import datetime
 import logging
 import base64
+import struct
 
-from server.message import Message, MessageType, ControlMessage, JobIOMessage, SessionEndMessage, JobStatus
+from server.message import Message, MessageType, ControlMessage, JobIOMessage, SessionEndMessage, JobStatus, LogLevel
 import pytest
 
 
@@ -84,6 +85,19 @@ def test_Message_send_receive():
     assert recv_msg == send_msg
 
 
+def test_Message_seq():
+    msg = JobIOMessage(date=datetime(year=1970, month=1, day=1), payload="", seq=42)
+    expected_payload = b'{"msg_type": "job_io", "date": "1970-01-01T00:00:00", "payload": "", "seq": 42}'
+    assert msg.frame == struct.pack("!I", len(expected_payload)) + expected_payload
+
+    def side_effect(view, length):
+        data = msg.frame[4:] if length == len(expected_payload) else msg.frame[:4]
+        view[0:len(data)] = data
+        return len(data)
+
+    assert Message.next_message(MagicMock(recv_into=MagicMock(side_effect=side_effect))).seq == 42
+
+
 def test_Message_recv_helper():
     def side_effect(view, length):
         if length == 10:
@@ -102,3 +116,8 @@ def test_Message_recv_helper():
     with pytest.raises(EOFError) as exc:
         Message.recv(sock_mock, 42)
     assert "The connection got interrupted before receiving the end of the message" in str(exc.value)
+
+
+def test_Message_from_frame():
+    msg = ControlMessage.create("Hello world\n", severity=LogLevel.WARN)
+    assert Message.from_frame(msg.frame[4:]) == msg
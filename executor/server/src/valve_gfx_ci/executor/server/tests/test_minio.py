@@ -1,12 +1,18 @@
 from unittest.mock import call, patch, MagicMock
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
 import tarfile
+import hashlib
 import json
+import io
 
+from freezegun import freeze_time
 from minio.error import S3Error
+import responses
+import requests
 import pytest
 
-from server.minioclient import MinioClient, MinIOPolicyStatement, generate_policy
+from server.minioclient import MinioClient, MinIOPolicyStatement, UserGroupsCache, generate_policy
 import server.config as config
 
 
@@ -59,25 +65,15 @@ def test_client_instantiation__defaults(subproc_mock, minio_mock):
     minio_mock.assert_called_once_with(endpoint=urlparse(config.MINIO_URL).netloc,
                                        access_key=config.MINIO_ROOT_USER, secret_key=config.MINIO_ROOT_PASSWORD,
                                        secure=False)
-    subproc_mock.assert_called_once_with(['mcli', '-q', '--no-color', 'alias', 'set',
-                                          config.MINIO_ADMIN_ALIAS, config.MINIO_URL,
-                                          config.MINIO_ROOT_USER, config.MINIO_ROOT_PASSWORD])
+
+    # The alias only gets set when the commandline tool is needed
+    subproc_mock.assert_not_called()
 
 
 @patch("server.minioclient.Minio", autospec=True)
 @patch("subprocess.check_call")
 def test_client_instantiation__custom_params(subproc_mock, minio_mock):
     MinioClient(url="http://hello-world", user="accesskey", secret_key="secret_key", alias="toto")
-    minio_mock.assert_called_once_with(endpoint="hello-world", access_key="accesskey",
-                                       secret_key="secret_key", secure=False)
-    subproc_mock.assert_called_once_with(['mcli', '-q', '--no-color', 'alias', 'set',
-                                          "toto", "http://hello-world", "accesskey", "secret_key"])
-
-
-@patch("server.minioclient.Minio", autospec=True)
-@patch("subprocess.check_call")
-def test_client_instantiation__no_aliases(subproc_mock, minio_mock):
-    MinioClient(url="http://hello-world", user="accesskey", secret_key="secret_key", alias=None)
     minio_mock.assert_called_once_with(endpoint="hello-world", access_key="accesskey",
                                        secret_key="secret_key", secure=False)
     subproc_mock.assert_not_called()
@@ -87,11 +83,23 @@ def test_client_instantiation__no_aliases(subproc_mock, minio_mock):
 @patch("subprocess.check_call")
 def test_client_remove_alias(subproc_mock, minio_mock):
     client = MinioClient(url="http://hello-world", user="accesskey", secret_key="secret_key", alias="toto")
-    subproc_mock.assert_called_once_with(['mcli', '-q', '--no-color', 'alias', 'set',
-                                          "toto", "http://hello-world", "accesskey", "secret_key"])
+
+    # Nothing to remove when the alias has not been used
+    client.remove_alias()
+    subproc_mock.assert_not_called()
+
+    client.add_user("user", "password")
+    subproc_mock.assert_has_calls([
+        call(['mcli', '-q', '--no-color', 'alias', 'set', "toto", "http://hello-world", "accesskey", "secret_key"]),
+        call(['mcli', '-q', '--no-color', 'admin', 'user', 'add', 'toto', 'user', 'password'])])
+
+    # The alias gets set only once
+    client.add_user("user2", "password")
+    assert subproc_mock.call_count == 3
 
     client.remove_alias()
     subproc_mock.assert_called_with(['mcli', '-q', '--no-color', 'alias', 'rm', "toto"])
+    assert subproc_mock.call_count == 4
 
 
 @patch("subprocess.check_call")
@@ -106,70 +114,325 @@ def test_is_local_url(subproc_mock):
     assert minio.is_local_url("http://hello-world/toto")
 
 
-class MockStream:
-    def iter_content(self, _):
-        yield b'hello world'
+@patch("server.minioclient.Minio", autospec=True)
+@patch("subprocess.check_call")
+def test_boot_artifacts(subproc_mock, minio_mock):
+    client = MinioClient(url="http://hello-world")
+
+    assert client.boot_artifact_url("cas/1234") == "http://hello-world/boot/cas/1234"
+
+    # Existence
+    assert client.boot_artifact_exists("cas/1234")
+    client._client.stat_object.assert_called_once_with("boot", "cas/1234")
+
+    client._client.stat_object.side_effect = S3Error('code', 'message', 'resource', 'request_id', 'host_id',
+                                                     'response')
+    assert not client.boot_artifact_exists("cas/1234")
+
+    # Saving
+    f = MagicMock()
+    client.save_boot_artifact("cas/1234", f, length=42)
+    client._client.put_object.assert_called_once_with("boot", "cas/1234", f, 42)
+
+    client.save_boot_artifact("cas/index.json", b"hello")
+    args = client._client.put_object.call_args.args
+    assert args[0:2] == ("boot", "cas/index.json")
+    assert args[2].read() == b"hello"
+    assert args[3] == 5
+
+    # Streaming
+    client.save_boot_artifact("cas/staging", f)
+    client._client.put_object.assert_called_with("boot", "cas/staging", f, -1,
+                                                 part_size=MinioClient.BOOT_ARTIFACT_PART_SIZE,
+                                                 num_parallel_uploads=MinioClient.BOOT_ARTIFACT_PARALLEL_UPLOADS)
+
+    # Copying
+    client.copy_boot_artifact("cas/staging", "cas/1234")
+    args = client._client.copy_object.call_args.args
+    assert args[0:2] == ("boot", "cas/1234")
+    assert (args[2].bucket_name, args[2].object_name) == ("boot", "cas/staging")
+
+    # Loading
+    response = client._client.get_object.return_value
+    response.read.return_value = b"data"
+    assert client.load_boot_artifact("cas/index.json") == b"data"
+    client._client.get_object.assert_called_once_with("boot", "cas/index.json")
+    response.close.assert_called_once_with()
+    response.release_conn.assert_called_once_with()
+
+    client._client.get_object.side_effect = S3Error('code', 'message', 'resource', 'request_id', 'host_id',
+                                                    'response')
+    assert client.load_boot_artifact("cas/index.json") is None
+
+    # Removal
+    client.remove_boot_artifact("cas/1234")
+    client._client.remove_object.assert_called_once_with("boot", "cas/1234")
+
+
+@patch("server.minioclient.Minio", autospec=True)
+@patch("subprocess.check_call")
+def test_build_mc_attrs_str(subproc_mock, minio_mock):
+    client = MinioClient()
 
-    def raise_for_status(self):
-        pass
+    member = MagicMock(spec=tarfile.TarInfo)
+    member.mode = 0o777
+    member.get_info.return_value = {
+        'gid': 1,
+        'gname': 'group',
+        'mtime': 42,
+        'uid': 2,
+        'uname': 'frank'
+    }
+
+    assert client._build_mc_attrs_str(member) == 'gid:1/gname:group/mode:2384495103/mtime:42/uid:2/uname:frank'
+
+
+def create_archive(files):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        dir_info = tarfile.TarInfo("dir")
+        dir_info.type = tarfile.DIRTYPE
+        tar.addfile(dir_info)
 
-    def __enter__(self):
-        return self
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o777
+            info.mtime = 42
+            info.uid, info.uname = 2, "frank"
+            info.gid, info.gname = 1, "group"
+            tar.addfile(info, io.BytesIO(data))
 
-    def __exit__(self, *args):
-        pass
+    archive.seek(0)
+    return archive
 
 
-@patch("server.minioclient.requests.get", return_value=MockStream())
 @patch("server.minioclient.Minio", autospec=True)
-@patch("server.minioclient.tempfile.NamedTemporaryFile", autospec=True)
 @patch("subprocess.check_call")
-def test_save_boot_artifact(subproc_mock, named_temp_mock, minio_mock, get_mock):
+def test_extract_archive(subproc_mock, minio_mock):
     client = MinioClient()
+    client.ARCHIVE_SMALL_MEMBER_SIZE = 10
 
-    named_temp_mock().__enter__().name = "/tmp/temp_file"
-    client.save_boot_artifact("https://toto.com/path", "/toto/path")
+    uploads = dict()
 
-    client._client.fput_object.assert_called_once_with("boot", "/toto/path", "/tmp/temp_file")
+    def put_object(bucket_name, object_name, data, length, **kwargs):
+        uploads[object_name] = (bucket_name, data.read(length), kwargs)
+    client._client.put_object.side_effect = put_object
+
+    files = {f"small{i}": f"small{i}".encode() for i in range(100)}
+    files["dir/large"] = b"large" * 10
+    client.extract_archive(create_archive(files), "bucket")
+
+    # The directory got ignored, the small members got uploaded concurrently, and the large ones streamed
+    metadata = {'X-Amz-Meta-Mc-Attrs': 'gid:1/gname:group/mode:33279/mtime:42/uid:2/uname:frank'}
+    assert uploads == {name: ("bucket", data, {"metadata": metadata}) for name, data in files.items()
+                       if name != "dir/large"} | {
+        "dir/large": ("bucket", b"large" * 10, {"num_parallel_uploads": 1, "metadata": metadata})
+    }
+
+
+@patch("server.minioclient.Minio", autospec=True)
+@patch.dict("server.compression.DECOMPRESSORS", {"zstd": (b"\x28\xb5\x2f\xfd", ["tail", "-c", "+5"])})
+def test_extract_archive__piped_decompression(minio_mock):
+    client = MinioClient()
+
+    uploads = dict()
+
+    def put_object(bucket_name, object_name, data, length, **kwargs):
+        uploads[object_name] = data.read(length)
+    client._client.put_object.side_effect = put_object
+
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode="w") as tar:
+        info = tarfile.TarInfo("file")
+        info.size = 7
+        tar.addfile(info, io.BytesIO(b"content"))
+
+    # Add some more padding at the end of the archive, which needs to be read for the decompressor to complete
+    tarball.write(b"\0" * 1024 * 1024)
+
+    # NOTE: Fake the zstd compression by prepending its magic number to a tarball, which the fake decompressor removes
+    client.extract_archive(io.BytesIO(b"\x28\xb5\x2f\xfd" + tarball.getvalue()), "bucket")
+
+    assert uploads == {"file": b"content"}
 
 
 @patch("server.minioclient.Minio", autospec=True)
-@patch("server.minioclient.TarFile.open", autospec=True)
 @patch("subprocess.check_call")
-def test_extract_archive(subproc_mock, tarfile_mock, minio_mock):
+def test_extract_archive__upload_failure(subproc_mock, minio_mock):
     client = MinioClient()
+    client._client.put_object.side_effect = S3Error('code', 'message', 'resource', 'request_id', 'host_id',
+                                                    'response')
 
-    archive_mock = tarfile_mock.return_value.__enter__.return_value
-    file_obj = MagicMock()
+    with pytest.raises(S3Error):
+        client.extract_archive(create_archive({f"file{i}": b"data" for i in range(100)}), "bucket")
 
-    member1 = MagicMock(spec=tarfile.TarInfo)
-    member1.isfile = MagicMock(return_value=True)
-    member1.size.return_value = 42
-    member1.mode = 0o777
-    member1.get_info.return_value = {
-        'gid': 1,
-        'gname': 'group',
-        'mtime': 42,
-        'uid': 2,
-        'uname': 'frank'
-    }
+    # Uploads stop at the first failure
+    assert client._client.put_object.call_count < 100
 
-    members = [member1, MagicMock(isfile=MagicMock(return_value=False)), None]
-    members[0].name = "toto"
-    archive_mock.next = MagicMock(side_effect=members)
 
-    client.extract_archive(file_obj, "bucket/rootpath")
+@patch("server.minioclient.Minio", autospec=True)
+@patch("subprocess.check_call")
+def test_extract_archive__object_pool(subproc_mock, minio_mock):
+    client = MinioClient(object_pool_bucket="objects")
+    client.OBJECT_POOL_MIN_SIZE = 5
+    client.ARCHIVE_SMALL_MEMBER_SIZE = 10
 
-    tarfile_mock.assert_called_once_with(fileobj=file_obj, mode='r')
-    archive_mock.extractfile.assert_called_once_with(members[0])
+    # The pool already contains "shared" and "large"
+    pool = {hashlib.sha256(b"shared").hexdigest(), hashlib.sha256(b"large" * 10).hexdigest()}
+    uploads = dict()
+    copies = dict()
 
-    client._client.put_object.assert_called_once_with(
-        "bucket/rootpath",
-        "toto",
-        archive_mock.extractfile(),
-        members[0].size,
-        num_parallel_uploads=1,
-        metadata={'X-Amz-Meta-Mc-Attrs': 'gid:1/gname:group/mode:2384495103/mtime:42/uid:2/uname:frank'})
+    def put_object(bucket_name, object_name, data, length, **kwargs):
+        if bucket_name == "objects":
+            pool.add(object_name)
+        uploads[(bucket_name, object_name)] = data.read(length)
+    client._client.put_object.side_effect = put_object
+
+    def copy_object(bucket_name, object_name, source, metadata, metadata_directive):
+        assert metadata_directive == "REPLACE"
+        if source.object_name not in pool:
+            raise S3Error('NoSuchKey', 'message', 'resource', 'request_id', 'host_id', 'response')
+        copies[object_name] = (bucket_name, source.bucket_name, source.object_name, metadata)
+    client._client.copy_object.side_effect = copy_object
+
+    files = {"tiny": b"tiny", "shared": b"shared", "new": b"new-data", "dir/large": b"large" * 10}
+    client.extract_archive(create_archive(files), "bucket")
+
+    # Only the tiny file and the new content got uploaded
+    assert uploads == {("bucket", "tiny"): b"tiny", ("objects", hashlib.sha256(b"new-data").hexdigest()): b"new-data"}
+
+    metadata = {'X-Amz-Meta-Mc-Attrs': 'gid:1/gname:group/mode:33279/mtime:42/uid:2/uname:frank'}
+    assert copies == {name: ("bucket", "objects", hashlib.sha256(data).hexdigest(), metadata)
+                      for name, data in files.items() if name != "tiny"}
+
+
+@patch("server.minioclient.Minio", autospec=True)
+@patch("subprocess.check_call")
+def test_extract_archive__object_pool_failure(subproc_mock, minio_mock):
+    client = MinioClient(object_pool_bucket="objects")
+    client.OBJECT_POOL_MIN_SIZE = 5
+    client._client.copy_object.side_effect = S3Error('NoSuchBucket', 'message', 'resource', 'request_id',
+                                                     'host_id', 'response')
+
+    with pytest.raises(S3Error):
+        client.extract_archive(create_archive({"file": b"content"}), "bucket")
+
+    client._client.put_object.assert_not_called()
+
+
+@patch("server.minioclient.Minio", autospec=True)
+def test_lookup_object_pool(minio_mock):
+    client = MinioClient(object_pool_bucket="objects")
+    client.OBJECT_POOL_MIN_SIZE = 10
+
+    now = datetime.now(timezone.utc)
+    pool = {"a" * 64: now, "b" * 64: now, "d" * 64: now - timedelta(days=2)}
+
+    def stat_object(bucket_name, object_name):
+        assert bucket_name == "objects"
+        if object_name not in pool:
+            raise S3Error('NoSuchKey', 'message', 'resource', 'request_id', 'host_id', 'response')
+        return MagicMock(last_modified=pool[object_name])
+    client._client.stat_object.side_effect = stat_object
+
+    # Objects too small to be in the pool are not looked up
+    assert client.lookup_object_pool([("a" * 64, 10), ("b" * 64, 9), ("c" * 64, 20)]) == {"a" * 64}
+    assert client._client.stat_object.call_count == 2
+    client._client.copy_object.assert_not_called()
+
+    # Old objects get refreshed, so that they do not expire before getting used
+    assert client.lookup_object_pool([("d" * 64, 10)]) == {"d" * 64}
+    bucket_name, object_name, source = client._client.copy_object.call_args.args
+    assert (bucket_name, object_name) == ("objects", "d" * 64)
+    assert (source.bucket_name, source.object_name) == ("objects", "d" * 64)
+    assert client._client.copy_object.call_args.kwargs["metadata_directive"] == "REPLACE"
+
+    # ... unless they expired meanwhile
+    client._client.copy_object.side_effect = S3Error('NoSuchKey', 'message', 'resource', 'request_id', 'host_id',
+                                                     'response')
+    assert client.lookup_object_pool([("d" * 64, 10)]) == set()
+
+    with pytest.raises(ValueError, match="Invalid sha256 digest: ../secret"):
+        client.lookup_object_pool([("../secret", 10)])
+
+    client._client.stat_object.side_effect = S3Error('AccessDenied', 'message', 'resource', 'request_id',
+                                                     'host_id', 'response')
+    with pytest.raises(S3Error):
+        client.lookup_object_pool([("a" * 64, 10)])
+
+    # Nothing is available when the pool is disabled
+    assert MinioClient(object_pool_bucket="").lookup_object_pool([("a" * 64, 10)]) == set()
+
+
+def test_parse_archive_manifest():
+    members = MinioClient.parse_archive_manifest({"files": [
+        {"path": "dir/file", "sha256": "a" * 64, "size": 42, "mode": 0o755, "mtime": 1234,
+         "uid": 2, "uname": "frank", "gid": 1, "gname": "group"},
+        {"path": "other", "sha256": "b" * 64},
+    ]})
+
+    assert [(m.name, m.size, m.mode, m.mtime, m.uid, m.uname, m.gid, m.gname, d) for m, d in members] == [
+        ("dir/file", 42, 0o755, 1234, 2, "frank", 1, "group", "a" * 64),
+        ("other", 0, 0o644, 0, 0, "", 0, "", "b" * 64),
+    ]
+    assert all(m.isreg() for m, _ in members)
+
+
+@pytest.mark.parametrize("manifest,error", [
+    ([], "The manifest does not contain a list of files"),
+    ({"files": {}}, "The manifest does not contain a list of files"),
+    ({"files": ["file"]}, "Invalid file in the manifest: file"),
+    ({"files": [{"sha256": "a" * 64}]}, "Invalid path in the manifest: None"),
+    ({"files": [{"path": "", "sha256": "a" * 64}]}, "Invalid path in the manifest: "),
+    ({"files": [{"path": "/etc/passwd", "sha256": "a" * 64}]}, "Invalid path in the manifest: /etc/passwd"),
+    ({"files": [{"path": "dir/../../file", "sha256": "a" * 64}]}, "Invalid path in the manifest: dir/../../file"),
+    ({"files": [{"path": "file", "sha256": "A" * 64}]}, "Invalid sha256 digest for the file file"),
+    ({"files": [{"path": "file", "sha256": "a" * 64, "size": "big"}]}, "Invalid attributes for the file file"),
+    ({"files": [{"path": "file", "sha256": "a" * 64, "mode": None}]}, "Invalid attributes for the file file"),
+])
+def test_parse_archive_manifest__invalid(manifest, error):
+    with pytest.raises(ValueError, match=error):
+        MinioClient.parse_archive_manifest(manifest)
+
+
+@patch("server.minioclient.Minio", autospec=True)
+def test_seed_from_object_pool(minio_mock):
+    client = MinioClient(object_pool_bucket="objects")
+
+    members = MinioClient.parse_archive_manifest({"files": [
+        {"path": f"file{i}", "sha256": f"{i:064x}", "mode": 0o777, "mtime": 42,
+         "uid": 2, "uname": "frank", "gid": 1, "gname": "group"} for i in range(20)
+    ]})
+    client.seed_from_object_pool("bucket", members)
+
+    metadata = {'X-Amz-Meta-Mc-Attrs': 'gid:1/gname:group/mode:33279/mtime:42/uid:2/uname:frank'}
+    copies = sorted([(c.args[0], c.args[1], c.args[2].bucket_name, c.args[2].object_name, c.kwargs["metadata"])
+                     for c in client._client.copy_object.call_args_list])
+    assert copies == sorted([("bucket", f"file{i}", "objects", f"{i:064x}", metadata) for i in range(20)])
+
+
+@patch("server.minioclient.Minio", autospec=True)
+def test_seed_from_object_pool__failures(minio_mock):
+    members = MinioClient.parse_archive_manifest({"files": [{"path": "file", "sha256": "a" * 64}]})
+
+    # Nothing to seed
+    MinioClient(object_pool_bucket="").seed_from_object_pool("bucket", [])
+
+    with pytest.raises(ValueError, match="as it is disabled"):
+        MinioClient(object_pool_bucket="").seed_from_object_pool("bucket", members)
+
+    # The content expired since the client looked it up
+    client = MinioClient(object_pool_bucket="objects")
+    client._client.copy_object.side_effect = S3Error('NoSuchKey', 'message', 'resource', 'request_id', 'host_id',
+                                                     'response')
+    with pytest.raises(ValueError, match="The content of file is no longer in the object pool"):
+        client.seed_from_object_pool("bucket", members)
+
+    client._client.copy_object.side_effect = S3Error('AccessDenied', 'message', 'resource', 'request_id',
+                                                     'host_id', 'response')
+    with pytest.raises(S3Error):
+        client.seed_from_object_pool("bucket", members)
 
 
 @patch("server.minioclient.Minio", autospec=True)
@@ -190,13 +453,44 @@ def test_make_bucket(subproc_mock, minio_mock):
 
 
 @patch("server.minioclient.Minio", autospec=True)
-@patch("subprocess.check_call")
-def test_remove_bucket(subproc_mock, minio_mock):
+def test_list_buckets(minio_mock):
+    client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
+    bucket = MagicMock()
+    bucket.name = "job-bucket"
+    client._client.list_buckets.return_value = [bucket]
+
+    assert client.list_buckets() == ["job-bucket"]
+
+
+@patch("server.minioclient.Minio", autospec=True)
+def test_remove_bucket(minio_mock):
     client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
+    client._client.list_objects.return_value = [MagicMock(object_name="obj1"), MagicMock(object_name="dir/obj2")]
+
+    removed = []
+
+    def remove_objects(bucket_name, objects):
+        for o in objects:
+            removed.append(o._name)
+            yield from ()
+    client._client.remove_objects.side_effect = remove_objects
+
     client.remove_bucket('test-id')
-    subproc_mock.assert_has_calls([
-        call(['mcli', '-q', '--no-color', 'alias', 'set', 'local', 'http://test.invalid', 'test', 'test']),
-        call(['mcli', '-q', '--no-color', 'rb', '--force', 'local/test-id'])])
+
+    client._client.list_objects.assert_called_once_with('test-id', recursive=True)
+    assert removed == ["obj1", "dir/obj2"]
+    client._client.remove_bucket.assert_called_once_with('test-id')
+
+
+@patch("server.minioclient.Minio", autospec=True)
+def test_remove_bucket__failure(minio_mock):
+    client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
+    client._client.remove_objects.return_value = iter([MagicMock(message="Access denied")])
+
+    with pytest.raises(ValueError, match="Access denied"):
+        client.remove_bucket('test-id')
+
+    client._client.remove_bucket.assert_not_called()
 
 
 @patch("server.minioclient.Minio", autospec=True)
@@ -210,72 +504,155 @@ def test_minio_add_user(subproc_mock, minio_mock):
     ])
 
 
-@patch("server.minioclient.Minio", autospec=True)
-@patch("subprocess.check_call")
-def test_minio_remove_user(subproc_mock, minio_mock):
+ADMIN_URL = "http://test.invalid/minio/admin/v3"
+
+
+@responses.activate
+def test_minio_admin_request__signature():
+    responses.add(responses.DELETE, f"{ADMIN_URL}/remove-user?accessKey=user%2Fname")
+
+    client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
+    with freeze_time("2024-01-02 03:04:05"):
+        client.remove_user('user/name')
+
+    request = responses.calls[0].request
+    assert request.url == f"{ADMIN_URL}/remove-user?accessKey=user%2Fname"
+    assert request.headers["x-amz-date"] == "20240102T030405Z"
+    assert request.headers["x-amz-content-sha256"] == hashlib.sha256(b"").hexdigest()
+    assert request.headers["Authorization"] == (
+        "AWS4-HMAC-SHA256 Credential=test/20240102/us-east-1/s3/aws4_request, "
+        "SignedHeaders=host;x-amz-content-sha256;x-amz-date, "
+        "Signature=afe38f8049139a943c988aeb94bfd49bd67ce7c8a4d0a7bbb54e646612754cbe")
+
+
+@responses.activate
+def test_minio_admin_request__errors():
+    client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
+
+    responses.add(responses.GET, f"{ADMIN_URL}/user-info", status=403,
+                  json={"Code": "InvalidAccessKeyId", "Message": "The access key ID you provided does not exist"})
+    with pytest.raises(ValueError, match="Invalid credentials"):
+        client.groups_user_is_in()
+
+    responses.replace(responses.GET, f"{ADMIN_URL}/user-info", status=403,
+                      json={"Code": "AccessDenied", "Message": "Access Denied."})
+    with pytest.raises(requests.HTTPError):
+        client.groups_user_is_in()
+
+    responses.replace(responses.GET, f"{ADMIN_URL}/user-info", status=403, body="Forbidden")
+    with pytest.raises(requests.HTTPError):
+        client.groups_user_is_in()
+
+
+@responses.activate
+def test_minio_remove_user():
+    responses.add(responses.DELETE, f"{ADMIN_URL}/remove-user?accessKey=username")
+
     client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
     client.remove_user('username')
-    subproc_mock.assert_has_calls([
-        call(['mcli', '-q', '--no-color', 'alias', 'set', 'local', 'http://test.invalid', 'test', 'test']),
-        call(['mcli', '-q', '--no-color', 'admin', 'user', 'remove', 'local', 'username']),
-    ])
 
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_minio_groups_user_is_in():
+    responses.add(responses.GET, f"{ADMIN_URL}/user-info?accessKey=test",
+                  json={"status": "enabled", "memberOf": ["group1", "group2"]})
+    responses.add(responses.GET, f"{ADMIN_URL}/user-info?accessKey=username",
+                  json={"status": "enabled", "memberOf": None})
 
-@patch("server.minioclient.Minio", autospec=True)
-@patch("subprocess.check_call")
-@patch("subprocess.check_output", return_value="""{"status": "success", "accessKey": "username",
-    "userStatus": "enabled", "memberOf": ["group1", "group2"]}""")
-def test_minio_groups_user_is_in(subproc_mock, _, minio_mock):
     client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
     assert client.groups_user_is_in() == ["group1", "group2"]
-    assert client.groups_user_is_in('username') == ["group1", "group2"]
-    subproc_mock.assert_has_calls([
-        call(['mcli', '-q', '--no-color', '--json', 'admin', 'user', 'info', 'local', 'test']),
-        call(['mcli', '-q', '--no-color', '--json', 'admin', 'user', 'info', 'local', 'username'])
-    ])
+    assert client.groups_user_is_in('username') == []
 
 
-@patch("server.minioclient.Minio", autospec=True)
-@patch("subprocess.check_call")
-def test_minio_add_user_to_group(subproc_mock, minio_mock):
+@responses.activate
+def test_minio_add_user_to_group():
+    responses.add(responses.PUT, f"{ADMIN_URL}/update-group-members")
+
     client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
     client.add_user_to_group('username', 'groupname')
-    subproc_mock.assert_has_calls([
-        call(['mcli', '-q', '--no-color', 'alias', 'set', 'local', 'http://test.invalid', 'test', 'test']),
-        call(['mcli', '-q', '--no-color', 'admin', 'group', 'add', 'local', 'groupname', 'username']),
-    ])
 
+    assert json.loads(responses.calls[0].request.body) == {"group": "groupname", "members": ["username"],
+                                                           "isRemove": False}
+
+    client.remove_user_from_group('username', 'groupname')
+    assert json.loads(responses.calls[1].request.body) == {"group": "groupname", "members": ["username"],
+                                                           "isRemove": True}
 
-@patch("subprocess.check_call")
-@patch("server.minioclient.tempfile.NamedTemporaryFile", autospec=True)
-def test_minio_add_user_policy_add(named_temp_mock, subproc_mock):
-    temp_mock = MagicMock()
-    temp_mock.name = '/tmp/temp_file'
-    named_temp_mock.return_value.__enter__.return_value = temp_mock
+
+@responses.activate
+def test_minio_add_user_policy_add():
+    responses.add(responses.PUT, f"{ADMIN_URL}/add-canned-policy?name=policy_name")
+    responses.add(responses.PUT, (f"{ADMIN_URL}/set-user-or-group-policy?isGroup=false&policyName=policy_name"
+                                  "&userOrGroup=username"))
 
     policy_statements = [MinIOPolicyStatement(['bucket'])]
-    expected_policy = generate_policy(policy_statements)
 
     client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
     client.apply_user_policy('policy_name', 'username', policy_statements=policy_statements)
 
-    temp_mock.write.assert_called_once_with(json.dumps(expected_policy).encode())
+    assert json.loads(responses.calls[0].request.body) == generate_policy(policy_statements)
+    assert len(responses.calls) == 2
 
-    subproc_mock.assert_has_calls([
-        call(['mcli', '-q', '--no-color', 'alias', 'set', 'local', 'http://test.invalid', 'test', 'test']),
-        call(['mcli', '-q', '--no-color', 'admin', 'policy', 'add', 'local', 'policy_name', '/tmp/temp_file']),
-        call(['mcli', '-q', '--no-color', 'admin', 'policy', 'set', 'local', 'policy_name', 'user=username'])])
 
+@responses.activate
+def test_minio_remove_user_policy():
+    responses.add(responses.PUT, f"{ADMIN_URL}/set-user-or-group-policy?isGroup=false&policyName=&userOrGroup=username")
+    responses.add(responses.DELETE, f"{ADMIN_URL}/remove-canned-policy?name=policy_name")
 
-@patch("subprocess.check_call")
-def test_minio_remove_user_policy(subproc_mock):
     client = MinioClient(url='http://test.invalid', user='test', secret_key='test', alias="local")
     client.remove_user_policy('policy_name', 'username')
 
-    subproc_mock.assert_has_calls([
-        call(['mcli', '-q', '--no-color', 'alias', 'set', 'local', 'http://test.invalid', 'test', 'test']),
-        call(['mcli', '-q', '--no-color', 'admin', 'policy', 'unset', 'local', 'policy_name', 'user=username']),
-        call(['mcli', '-q', '--no-color', 'admin', 'policy', 'remove', 'local', 'policy_name'])])
+    assert [c.request.method for c in responses.calls] == ["PUT", "DELETE"]
+
+
+@responses.activate
+def test_UserGroupsCache():
+    assert UserGroupsCache().ttl == int(config.EXECUTOR_MINIO_GROUPS_CACHE_TTL)
+
+    cache = UserGroupsCache(ttl=60, url='http://test.invalid')
+    responses.add(responses.GET, f"{ADMIN_URL}/user-info?accessKey=user",
+                  json={"status": "enabled", "memberOf": ["group1"]})
+    responses.add(responses.GET, f"{ADMIN_URL}/user-info?accessKey=user2",
+                  json={"status": "enabled", "memberOf": ["group2"]})
+
+    with freeze_time("2024-01-01 00:00:00") as frozen_time:
+        # The groups get cached
+        assert cache.groups("user", "secret") == {"group1"}
+        assert cache.groups("user", "secret") == {"group1"}
+        assert cache.groups("user2", "secret") == {"group2"}
+        assert len(responses.calls) == 2
+
+        # Different secret keys are checked separately
+        assert cache.groups("user", "other secret") == {"group1"}
+        assert len(responses.calls) == 3
+
+        # Entries expire
+        frozen_time.tick(61)
+        assert cache.groups("user", "secret") == {"group1"}
+        assert cache.groups("user2", "secret") == {"group2"}
+        assert len(responses.calls) == 5
+
+        # Entries can be invalidated per user
+        cache.invalidate("user")
+        assert cache.groups("user", "secret") == {"group1"}
+        assert cache.groups("user2", "secret") == {"group2"}
+        assert len(responses.calls) == 6
+
+        # ... or all at once
+        cache.invalidate()
+        assert cache.groups("user2", "secret") == {"group2"}
+        assert len(responses.calls) == 7
+
+    # Invalid credentials are not cached
+    responses.replace(responses.GET, f"{ADMIN_URL}/user-info?accessKey=user", status=403,
+                      json={"Code": "InvalidAccessKeyId"})
+    cache.invalidate()
+    for i in range(2):
+        with pytest.raises(ValueError):
+            cache.groups("user", "secret")
+    assert len(responses.calls) == 9
 
 
 def test_create_valid_bucket_name():
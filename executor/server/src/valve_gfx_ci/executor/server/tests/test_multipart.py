@@ -0,0 +1,132 @@
+from threading import Thread
+from tarfile import TarFile, TarInfo
+from urllib3 import encode_multipart_formdata
+import io
+
+import pytest
+
+from server.multipart import MultipartStream
+
+
+def encode(fields):
+    body, content_type = encode_multipart_formdata(fields)
+    return io.BytesIO(body), content_type.split("boundary=")[1].encode()
+
+
+def test_MultipartStream():
+    stream, boundary = encode([
+        ("metadata", ("metadata", b'{"version": 1}', "application/json")),
+        ("field", "value"),
+        ("skipped", ("skipped", b"skipped" * 100, "application/octet-stream")),
+        ("tarball", ("tarball", b"0123456789" * 1000, "application/octet-stream; charset=binary")),
+    ])
+    parts = iter(MultipartStream(stream, boundary, chunk_size=7))
+
+    part = next(parts)
+    assert part.name == "metadata"
+    assert part.filename == "metadata"
+    assert part.mimetype == "application/json"
+    assert part.read() == b'{"version": 1}'
+    assert part.read() == b""
+
+    # Fields without a file name
+    part = next(parts)
+    assert part.name == "field"
+    assert part.filename is None
+    assert part.mimetype == ""
+    part.buffer()
+    assert part.read(2) == b"va"
+    assert part.read(None) == b"lue"
+
+    # Parts that do not get read are skipped
+    assert next(parts).name == "skipped"
+
+    part = next(parts)
+    assert part.name == "tarball"
+    assert part.mimetype == "application/octet-stream"
+    assert part.read(15) == b"012345678901234"
+    assert part.read(20) == b"56789012345678901234"
+    part.drain()
+    assert part.read() == b""
+
+    assert list(parts) == []
+
+
+def test_MultipartStream__drain():
+    stream, boundary = encode([("a", ("a", b"a" * 1000, "text/plain")), ("b", ("b", b"b" * 1000, "text/plain"))])
+    parts = MultipartStream(stream, boundary, chunk_size=100)
+
+    assert next(iter(parts)).read(10) == b"a" * 10
+    parts.drain()
+    assert stream.read() == b""
+    assert list(parts) == []
+
+
+def test_MultipartStream__invalid():
+    with pytest.raises(ValueError) as exc:
+        MultipartStream(io.BytesIO(b""), b"")
+    assert "The multipart boundary is missing" in str(exc.value)
+
+    # Truncated bodies
+    stream, boundary = encode([("a", ("a", b"a" * 1000, "text/plain"))])
+    stream = io.BytesIO(stream.getvalue()[:500])
+    with pytest.raises(ValueError):
+        next(iter(MultipartStream(stream, boundary))).read()
+
+
+def test_MultipartPart__close():
+    stream, boundary = encode([("a", ("a", b"a", "text/plain"))])
+    part = next(iter(MultipartStream(stream, boundary)))
+
+    assert not part.closed
+    assert not part.wait_closed(timeout=0.01)
+
+    closer = Thread(target=part.close)
+    closer.start()
+    assert part.wait_closed(timeout=1)
+    assert part.closed
+    closer.join()
+
+
+def test_MultipartPart__tar_stream():
+    archive = io.BytesIO()
+    with TarFile.open(fileobj=archive, mode="w:gz") as tar:
+        for name in ["a", "b"]:
+            data = name.encode() * 100000
+            info = TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    stream, boundary = encode([("tarball", ("tarball", archive.getvalue(), "application/octet-stream"))])
+    part = next(iter(MultipartStream(stream, boundary, chunk_size=1000)))
+
+    # The archive can be extracted without being seekable
+    members = dict()
+    with TarFile.open(fileobj=part, mode="r|*") as tar:
+        while (member := tar.next()) is not None:
+            members[member.name] = tar.extractfile(member).read()
+    assert members == {"a": b"a" * 100000, "b": b"b" * 100000}
+
+
+def test_MultipartPart__spool():
+    stream, boundary = encode([("small", ("small", b"s" * 10, "text/plain")),
+                               ("large", ("large", b"0123456789" * 1000, "application/octet-stream"))])
+    parts = iter(MultipartStream(stream, boundary, chunk_size=100))
+
+    # Small parts stay in memory
+    part = next(parts)
+    assert part.read(2) == b"ss"
+    part.spool(max_memory_size=1000)
+    assert not part._spool._rolled
+    assert part.read() == b"s" * 8
+
+    # Large ones get written to disk, rather than buffered
+    part = next(parts)
+    part.spool(max_memory_size=1000)
+    assert part._spool._rolled
+    assert len(part._buffer) == 0
+    assert part.read(15) == b"012345678901234"
+    assert part.read(None) == (b"0123456789" * 1000)[15:]
+
+    part.close()
+    assert part._spool.closed
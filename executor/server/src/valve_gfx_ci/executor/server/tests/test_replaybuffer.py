@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from server.message import JobIOMessage, ControlMessage
+from server.replaybuffer import ReplayBuffer
+import server.config as config
+
+
+def test_ReplayBuffer__default_size():
+    assert ReplayBuffer().max_size == int(config.EXECUTOR_CONSOLE_REPLAY_BUFFER_SIZE)
+
+
+def test_ReplayBuffer__push():
+    buf = ReplayBuffer(max_size=1024)
+    assert buf.last_seq == 0
+    assert buf.frames_after(None) == ([], 0)
+
+    msgs = [JobIOMessage.create(b"hello"), ControlMessage.create("world")]
+    frames = [buf.push(msg) for msg in msgs]
+
+    # The messages got numbered, and their frames include the sequence number
+    assert [msg.seq for msg in msgs] == [1, 2]
+    assert frames == [msg.frame for msg in msgs]
+    assert buf.last_seq == 2
+    assert buf.size == sum([len(f) for f in frames])
+
+    # Clients resume from the last message they received
+    assert buf.frames_after(None) == (frames, 0)
+    assert buf.frames_after(0) == (frames, 0)
+    assert buf.frames_after(1) == (frames[1:], 0)
+    assert buf.frames_after(2) == ([], 0)
+
+
+def test_ReplayBuffer__overflow():
+    # NOTE: Keep the sequence numbers on one digit, so that all the frames have the same size
+    msgs = [JobIOMessage(payload="x" * 100, date=datetime(2000, 1, 1)) for _ in range(9)]
+    frame_size = len(JobIOMessage(payload="x" * 100, date=datetime(2000, 1, 1), seq=1).frame)
+
+    buf = ReplayBuffer(max_size=3 * frame_size)
+    frames = [buf.push(msg) for msg in msgs]
+
+    # Only the last 3 messages are kept
+    assert buf.size == 3 * frame_size
+    assert buf.frames_after(0) == (frames[-3:], 6)
+    assert buf.frames_after(5) == (frames[-3:], 1)
+    assert buf.frames_after(6) == (frames[-3:], 0)
+    assert buf.frames_after(7) == (frames[-2:], 0)
@@ -0,0 +1,37 @@
+from server.standby import HotStandbyBudget
+import server.config as config
+
+
+def test_HotStandbyBudget__defaults():
+    budget = HotStandbyBudget()
+    assert budget.budget == float(config.EXECUTOR_HOT_STANDBY_POWER_BUDGET)
+    assert budget.used == 0
+    assert budget.machines == set()
+
+    # The hot standby is disabled by default
+    assert not budget.acquire("machine1", power=1)
+
+
+def test_HotStandbyBudget__acquire_release():
+    budget = HotStandbyBudget(budget=50)
+
+    # Machines without a known power consumption are never kept warm
+    assert not budget.acquire("machine0", power=None)
+
+    assert budget.acquire("machine1", power=20)
+    assert budget.acquire("machine2", power=30)
+    assert budget.used == 50
+    assert budget.machines == {"machine1", "machine2"}
+
+    # Acquiring twice does not consume more power
+    assert budget.acquire("machine1", power=20)
+    assert budget.used == 50
+
+    # No more power available
+    assert not budget.acquire("machine3", power=1)
+
+    budget.release("machine1")
+    budget.release("machine1")
+    assert budget.used == 30
+    assert budget.acquire("machine3", power=1)
+    assert budget.machines == {"machine2", "machine3"}